@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Step response analysis of recorded calibration runs.
+
+Every change of the 0xC1 setpoint is a step. The response samples (by default meas_voltage of STATUS_MEAS_U_I) are
+assigned to the step before them with one sorted search, the step response is normalized to the step size and the
+first crossings of the low and high threshold are found with reductions over the sample groups. step_responses() runs
+no Python loop per step or per frame, so captures with millions of frames are analysed in seconds.
+
+settled_points() feeds the response of every setpoint hold sample by sample through settle.SettleDetector, so the
+points match those the online sweep took. It loops in Python until the hold settled, which is fine for the few holds
+of a sweep but not for bulk analysis of long captures.
+
+Per step:
+    latency:    Time from the setpoint change until the response crossed the low threshold (10% of the step)
+    rise_time:  Time between the low and the high threshold crossing (10% to 90% of the step)
+    overshoot:  Maximum excursion beyond the new setpoint, relative to the step size
+
+Usage:
+    with CaptureReader("run.btecap") as capture:
+        steps = step_responses(decode_capture(capture))
+    summarize(steps)
+"""
+
+import numpy as np
+
+from bulk_codec import decode_capture
+
+
+SETPOINT_SIGNAL = ("SET_REF_SWITCH_CTRL_RI", "set_ref")
+RESPONSE_SIGNAL = ("STATUS_MEAS_U_I", "meas_voltage")
+
+
+def time_series(signals, message, signal):
+    """Timestamps and values of one signal in time order."""
+    try:
+        columns = signals[message]
+    except KeyError:
+        raise ValueError("Capture contains no {} frames".format(message)) from None
+    timestamps = columns["timestamp"]
+    values = columns[signal].astype(np.float64)
+    if len(timestamps) > 1 and np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind="stable")
+        timestamps, values = timestamps[order], values[order]
+    return timestamps, values
+
+
+def find_steps(timestamps, setpoints, min_step=0.0):
+    """ Setpoint changes of a setpoint time series.
+
+    :param min_step: Changes of at most this size are ignored
+    :return: Tuple of arrays (time of the change, old setpoint, new setpoint)
+    """
+    change = np.flatnonzero(np.abs(np.diff(setpoints)) > min_step) + 1
+    return timestamps[change], setpoints[change - 1], setpoints[change]
+
+
+def _first_crossing(progress, timestamps, starts, stops, level):
+    """ Interpolated time of the first sample per group with progress >= level, NaN if there is none.
+
+    The samples of group k are progress[starts[k]:stops[k]].
+    """
+    n = len(progress)
+    nonempty = stops > starts
+    candidates = np.where(progress >= level, np.arange(n), n)
+    first = np.full(len(starts), n)
+    if n:
+        first[nonempty] = np.minimum.reduceat(candidates, starts[nonempty])
+    found = nonempty & (first < stops)
+
+    crossing = np.full(len(starts), np.nan)
+    index = first[found]
+    crossing[found] = timestamps[index]
+    # Linear interpolation with the sample before, if it belongs to the same group
+    inner = index > starts[found]
+    before = index[inner] - 1
+    p0, p1 = progress[before], progress[index[inner]]
+    t0, t1 = timestamps[before], timestamps[index[inner]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.clip((level - p0) / (p1 - p0), 0.0, 1.0)
+    crossing[np.flatnonzero(found)[inner]] = t0 + fraction * (t1 - t0)
+    return crossing
+
+
+def step_responses(signals, setpoint=SETPOINT_SIGNAL, response=RESPONSE_SIGNAL, low=0.1, high=0.9, min_step=1.0):
+    """ Latency, rise time and overshoot of every setpoint step.
+
+    :param signals: Decoded capture, see bulk_codec.decode_capture()
+    :param setpoint: Tuple of message name and signal name of the setpoint
+    :param response: Tuple of message name and signal name of the measured response
+    :param low: Threshold of the latency and start of the rise time, relative to the step size
+    :param high: End of the rise time, relative to the step size
+    :param min_step: Minimum setpoint change counted as step
+    :return: Dictionary of arrays with one entry per step: time, old, new, samples, latency, rise_time, overshoot.
+             Values are NaN if the response did not reach the threshold before the next step.
+    """
+    set_time, set_value = time_series(signals, *setpoint)
+    resp_time, resp_value = time_series(signals, *response)
+    step_time, old, new = find_steps(set_time, set_value, min_step)
+
+    # Responses from one step to the next belong to the step, the last step ends with the capture
+    starts = np.searchsorted(resp_time, step_time, side="left")
+    stops = np.append(starts[1:], len(resp_time))
+    first, last = (starts[0], stops[-1]) if len(starts) else (0, 0)
+
+    # Sample-wise progress towards the new setpoint, 0 at the old and 1 at the new setpoint
+    group = np.repeat(np.arange(len(starts)), stops - starts)
+    progress = (resp_value[first:last] - old[group]) / (new - old)[group]
+    times = resp_time[first:last]
+    starts, stops = starts - first, stops - first
+
+    t_low = _first_crossing(progress, times, starts, stops, low)
+    t_high = _first_crossing(progress, times, starts, stops, high)
+
+    overshoot = np.full(len(starts), np.nan)
+    nonempty = stops > starts
+    if len(progress):
+        overshoot[nonempty] = np.maximum(np.maximum.reduceat(progress, starts[nonempty]) - 1.0, 0.0)
+    overshoot[np.isnan(t_high)] = np.nan
+
+    return {"time": step_time,
+            "old": old,
+            "new": new,
+            "samples": stops - starts,
+            "latency": t_low - step_time,
+            "rise_time": t_high - t_low,
+            "overshoot": overshoot}
+
+
+def settled_points(signals, setpoint=SETPOINT_SIGNAL, response=RESPONSE_SIGNAL, window=0.1, tolerance=0.5,
+                   slope_tolerance=5.0, setpoint_tolerance=None, max_dwell=0.5, min_step=1.0, min_samples=3):
+    """ Settled response of every setpoint hold, the calibration points of a recorded sweep.
+
+    A hold lasts from one setpoint change to the next. Its response is fed through a settle.SettleDetector with the
+    criteria of the online sweep (the defaults are those of tas_protocol.macroBTE_Calibrate800V_Adaptive), and the
+    point is the window at the first settled sample, as taken by the sequencer when it advanced. A point that does
+    not settle within max_dwell yields the window at that time, flagged as not settled. Like the sequencer, the dwell
+    of a point counts from the sample that ended the previous point. Holds end as soon as the point settled, so a
+    fixed fraction of the hold would still contain the approach ramp.
+
+    :param window: Length of the settle window in seconds
+    :param tolerance: Maximum standard deviation within the window
+    :param slope_tolerance: Maximum drift within the window per second
+    :param setpoint_tolerance: Maximum distance of the settled mean from the setpoint, defaults to 40 % of the median
+        setpoint step like the online sweep
+    :param max_dwell: Maximum dwell of a point in seconds, None to feed every hold to its end
+    :param min_samples: Holds with fewer response samples are dropped
+    :return: Dictionary of arrays with one entry per hold: setpoint, mean, std, samples (fed until the point was
+             taken), settled, start, end (time the point was taken)
+    """
+    from settle import SettleDetector
+
+    names = ("setpoint", "mean", "std", "samples", "settled", "start", "end")
+    set_time, set_value = time_series(signals, *setpoint)
+    resp_time, resp_value = time_series(signals, *response)
+    if not len(set_time):
+        return {name: np.empty(0) for name in names}
+
+    begin = np.concatenate([[0], np.flatnonzero(np.abs(np.diff(set_value)) > min_step) + 1])
+    setpoints = set_value[begin]
+    start_time = set_time[begin]
+    starts = np.searchsorted(resp_time, start_time, side="left")
+    stops = np.append(starts[1:], len(resp_time))
+    if setpoint_tolerance is None and len(setpoints) > 1:
+        setpoint_tolerance = 0.4 * float(np.median(np.abs(np.diff(setpoints))))
+
+    detector = SettleDetector(window, tolerance, slope_tolerance)
+    points = {name: [] for name in names}
+    previous_end = None
+    for target, t_start, first, last in zip(setpoints.tolist(), start_time.tolist(), starts.tolist(), stops.tolist()):
+        if last - first < max(min_samples, 2):
+            continue
+        detector.reset()
+        settled = False
+        point_start = resp_time[first] if previous_end is None else previous_end
+        for samples, (t, y) in enumerate(zip(resp_time[first:last].tolist(), resp_value[first:last].tolist()), 1):
+            detector.update(t, y)
+            if detector.settled_at(target, setpoint_tolerance):
+                settled = True
+                break
+            if max_dwell is not None and t - point_start >= max_dwell:
+                break
+        previous_end = t
+        points["setpoint"].append(target)
+        points["mean"].append(detector.mean)
+        points["std"].append(np.sqrt(detector.variance))
+        points["samples"].append(samples)
+        points["settled"].append(settled)
+        points["start"].append(t_start)
+        points["end"].append(t)
+    return {name: np.array(values, dtype=bool if name == "settled" else None) for name, values in points.items()}
+
+
+def distribution(values, percentiles=(50, 90, 99)):
+    """Statistics of one result array, NaN entries are counted as missing."""
+    values = np.asarray(values, dtype=np.float64)
+    valid = values[~np.isnan(values)]
+    result = {"count": int(len(valid)), "missing": int(len(values) - len(valid))}
+    if len(valid):
+        result.update(mean=float(valid.mean()), std=float(valid.std()), min=float(valid.min()),
+                      max=float(valid.max()))
+        for percentile, value in zip(percentiles, np.percentile(valid, percentiles)):
+            result["p{}".format(percentile)] = float(value)
+    return result
+
+
+def summarize(steps):
+    """Distributions of latency, rise time and overshoot of step_responses()."""
+    return {name: distribution(steps[name]) for name in ("latency", "rise_time", "overshoot")}
+
+
+def analyse_capture(capture, **kwargs):
+    """ Step response summary of a capture.CaptureReader.
+
+    :param kwargs: Arguments of step_responses()
+    :return: Tuple of the per-step arrays and their summary
+    """
+    steps = step_responses(decode_capture(capture), **kwargs)
+    return steps, summarize(steps)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Benchmarks of message encoding, macro generation, bulk decoding and bus round trips.
+
+Every case is timed in batches of calls with the garbage collector disabled, the throughput and mean latency are
+reported from the batch times. A second pass times every call on its own for the p50 and p99, less the overhead of
+reading the clock. A separate pass under tracemalloc measures the memory allocated within one call (peak) and the
+blocks still alive after the calls, so timing is not distorted by tracing.
+
+Results are written as JSON. With --compare the results are checked against an earlier run and the script exits
+with status 1 if a case lost more throughput or gained more p50 latency than the threshold, or gained more p99
+latency than the wider tail threshold.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --compare bench.json --threshold 0.15
+    python benchmark.py --filter load_set --quick
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import logging
+
+import can
+
+import messages as msg
+import tas_protocol as tas
+
+
+SCHEMA_VERSION = 2         # 2: p50 and p99 of single calls instead of batch means
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Case:
+    """ One benchmark case.
+
+    :param name: Name of the case in the results
+    :param func: Function called once per measured call
+    :param frames: Number of CAN frames handled by one call
+    :param setup: Optional function returning the state passed to func, cleanup(state) is called afterwards
+    """
+
+    def __init__(self, name, func, frames=1, setup=None, cleanup=None):
+        self.name = name
+        self.func = func
+        self.frames = frames
+        self.setup = setup
+        self.cleanup = cleanup
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100.0 * (len(values) - 1)))))
+    return values[index]
+
+
+def _clock_overhead(samples=1000):
+    """Median duration of an empty pair of perf_counter_ns() calls in ns."""
+    clock = time.perf_counter_ns
+    durations = []
+    for _ in range(samples):
+        start = clock()
+        durations.append(clock() - start)
+    return _percentile(durations, 50)
+
+
+def measure(case, batches=200, calls=50, warmup=5):
+    """ Time a case and count its allocations.
+
+    :param batches: Number of timed batches for the throughput, also the number of batches timed call by call for
+                    the percentiles
+    :param calls: Calls per batch
+    :param warmup: Untimed batches before the measurement
+    :return: Dictionary of the results
+    """
+    state = case.setup() if case.setup else None
+    func = case.func if state is None else (lambda: case.func(state))
+    try:
+        for _ in range(warmup * calls):
+            func()
+
+        clock = time.perf_counter_ns
+        overhead = _clock_overhead()
+        total_ns = 0
+        samples = []
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in range(batches):
+                start = clock()
+                for _ in range(calls):
+                    func()
+                total_ns += clock() - start
+            for _ in range(batches * calls):
+                start = clock()
+                func()
+                samples.append(max(clock() - start - overhead, 0))
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            peak_bytes = 0
+            for _ in range(calls):
+                base, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                func()
+                peak_bytes += tracemalloc.get_traced_memory()[1] - base
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        retained = sum(stat.count_diff for stat in after.compare_to(before, "lineno") if stat.count_diff > 0)
+    finally:
+        if case.cleanup and state is not None:
+            case.cleanup(state)
+
+    return {"frames_per_call": case.frames,
+            "calls": batches * calls,
+            "frames_per_s": case.frames * batches * calls / (total_ns / 1e9),
+            "p50_us": _percentile(samples, 50) / 1e3,
+            "p99_us": _percentile(samples, 99) / 1e3,
+            "mean_us": total_ns / (batches * calls) / 1e3,
+            "alloc_bytes_per_call": peak_bytes / calls,
+            "retained_blocks_per_call": retained / calls}
+
+
+"""
+
+    B E N C H M A R K   C A S E S
+
+"""
+
+def _encode_cases():
+    yield Case("load_message", lambda: msg.load_message(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=1400))
+    yield Case("load_message_by_id", lambda: msg.load_message(0x150, op_lim_u_mn=0, op_lim_u_mx=1400))
+    yield Case("load_clearance", lambda: msg.load_clearance(1))
+    yield Case("load_set_rst_stop", lambda: msg.load_set_rst_stop(1))
+    yield Case("load_set_slope_u_i", lambda: msg.load_set_slope_u_i(200, 200))
+    yield Case("load_set_slope_pwr_filter", lambda: msg.load_set_slope_pwr_filter(200, 0))
+    for name in ("u", "i", "pwr"):
+        for kind in ("op", "pr"):
+            function = getattr(msg, "load_set_{}_lim_{}".format(kind, name))
+            yield Case(function.__name__, lambda function=function: function(-500, 500))
+    yield Case("set_register_ref_switch_ctrl_ri",
+               lambda: tas.set_register_ref_switch_ctrl_ri(400.0, tas.SWITCH_ON, tas.CTRL_VOLTAGE, set_ri=0.25))
+
+
+def _macro_cases():
+    frames = len(list(tas.macroBTE_Initialization((200, 200, 200), (0, 600, 200), (0, 600, 200))))
+    yield Case("macroBTE_Initialization",
+               lambda: list(tas.macroBTE_Initialization((200, 200, 200), (0, 600, 200), (0, 600, 200))),
+               frames=frames)
+
+
+def _decode_cases(frames=100000):
+    try:
+        import numpy as np
+        from bulk_codec import decode_frames, encode_ref_switch_ctrl_ri
+    except ImportError:
+        logging.warning("numpy not available, bulk decode benchmarks skipped")
+        return
+
+    def setup():
+        random = np.random.default_rng(0)
+        ids = random.choice(np.array(sorted(msg.CODECS_BY_ID), dtype=np.uint32), frames)
+        payloads = random.integers(0, 256, (frames, 8), dtype=np.uint8)
+        payloads[ids == 0xC1] = encode_ref_switch_ctrl_ri(400.0, tas.SWITCH_ON, tas.CTRL_VOLTAGE)
+        return ids, payloads, np.arange(frames, dtype=np.float64) * 1e-4
+
+    yield Case("bulk_decode", lambda state: decode_frames(*state), frames=frames, setup=setup)
+    yield Case("decode_message", lambda message: msg.decode_message(message),
+               setup=lambda: msg.load_message(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=1400))
+
+
+def _round_trip_cases(channel="benchmark"):
+    def setup():
+        return (can.interface.Bus(bustype="virtual", channel=channel),
+                can.interface.Bus(bustype="virtual", channel=channel),
+                msg.load_message(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=1400))
+
+    def round_trip(state):
+        tx, rx, message = state
+        tx.send(message)
+        if rx.recv(1.0) is None:
+            raise RuntimeError("Frame lost on the virtual bus")
+
+    def cleanup(state):
+        state[0].shutdown()
+        state[1].shutdown()
+
+    yield Case("virtual_round_trip", round_trip, setup=setup, cleanup=cleanup)
+
+
+def all_cases():
+    for cases in (_encode_cases(), _macro_cases(), _decode_cases(), _round_trip_cases()):
+        yield from cases
+
+
+"""
+
+    R E S U L T S
+
+"""
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {"schema": SCHEMA_VERSION,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "python_can": can.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform()}
+
+
+TAIL_THRESHOLD = 0.5       # The p99 of single calls varies a lot between runs on shared machines
+
+
+def compare(baseline, results, threshold=0.1, tail_threshold=TAIL_THRESHOLD):
+    """ Cases of results that regressed against baseline.
+
+    Throughput and the median latency decide with threshold. The p99 latency is only a regression beyond the wider
+    tail_threshold, a few slow calls must not fail a run.
+    :param threshold: Allowed relative loss of throughput and gain of p50 latency
+    :param tail_threshold: Allowed relative gain of p99 latency
+    :return: List of (case, metric, baseline value, new value) tuples
+    """
+    regressions = []
+    for name, new in results["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        if new["frames_per_s"] < old["frames_per_s"] * (1.0 - threshold):
+            regressions.append((name, "frames_per_s", old["frames_per_s"], new["frames_per_s"]))
+        # Before schema 2 the percentiles were taken over batch means, they are not comparable
+        if baseline.get("schema") != results.get("schema"):
+            continue
+        for metric, allowed in (("p50_us", threshold), ("p99_us", tail_threshold)):
+            if new[metric] > old[metric] * (1.0 + allowed):
+                regressions.append((name, metric, old[metric], new[metric]))
+    return regressions
+
+
+"""Import budget of the console entry point, scripted line tooling calls it many times a day."""
+IMPORT_BUDGET_MS = 60.0
+IMPORT_STATEMENT = "import calibration; calibration.main(['version'])"
+LAZY_MODULES = ("can", "numpy", "yaml", "asyncio", "sqlite3")     # Only loaded by the commands that use them
+
+
+def import_profile(statement=IMPORT_STATEMENT, runs=5):
+    """ Import cost of a statement in fresh interpreters, from python -X importtime.
+
+    Only modules imported by the statement are counted, not the ones loaded at interpreter startup.
+    :return: Dictionary with the smallest import time in ms over the runs and the modules imported by the statement
+    """
+    code = "import sys; _before = set(sys.modules); {}; print(' '.join(sorted(set(sys.modules) - _before)))".format(
+        statement)
+    best = None
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=BASE_DIR,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        modules = set(process.stdout.split("\n")[-2].split())
+        total_us = 0
+        for line in process.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|", 2)
+            # Top level entries of the import tree are not indented
+            if cumulative.strip().isdigit() and not name[1:].startswith(" ") and name.strip() in modules:
+                total_us += int(cumulative)
+        if best is None or total_us < best:
+            best = total_us
+    return {"statement": statement, "import_ms": best / 1000.0, "modules": sorted(modules)}
+
+
+def check_import_budget(budget_ms=IMPORT_BUDGET_MS, statement=IMPORT_STATEMENT):
+    """ Check the import time of the entry point against the budget and that no lazy module is loaded eagerly.
+
+    :return: Tuple of the profile and the list of violations
+    """
+    profile = import_profile(statement)
+    violations = []
+    if profile["import_ms"] > budget_ms:
+        violations.append("import time {:.1f} ms exceeds the budget of {:.1f} ms".format(profile["import_ms"],
+                                                                                    budget_ms))
+    eager = sorted(module for module in LAZY_MODULES if module in profile["modules"])
+    if eager:
+        violations.append("{} imported eagerly".format(", ".join(eager)))
+    return profile, violations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the BTE calibration hot paths")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--compare", default=None, metavar="BASELINE", help="Compare against an earlier result file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Allowed relative regression of throughput and p50 latency, default 0.1")
+    parser.add_argument("--tail-threshold", type=float, default=TAIL_THRESHOLD,
+                        help="Allowed relative regression of p99 latency, default {}".format(TAIL_THRESHOLD))
+    parser.add_argument("--filter", default=None, help="Only run cases containing this text")
+    parser.add_argument("--quick", action="store_true", default=False, help="Fewer batches for a fast check")
+    parser.add_argument("--import-budget", type=float, nargs="?", const=IMPORT_BUDGET_MS, default=None, metavar="MS",
+                        help="Only check the import time of calibration.py version against MS, default {}".format(
+                            IMPORT_BUDGET_MS))
+    args = parser.parse_args(argv)
+
+    if args.import_budget is not None:
+        profile, violations = check_import_budget(args.import_budget)
+        print("{}: {:.1f} ms for {} modules (budget {:.1f} ms)".format(profile["statement"], profile["import_ms"],
+                                                                     len(profile["modules"]), args.import_budget))
+        for violation in violations:
+            print("IMPORT BUDGET {}".format(violation))
+        return 1 if violations else 0
+
+    batches = 20 if args.quick else 200
+    results = dict(environment(), results={})
+    print("{:35} {:>14} {:>10} {:>10} {:>12} {:>8}".format("case", "frames/s", "p50 us", "p99 us", "alloc bytes",
+                                                          "retained"))
+    for case in all_cases():
+        if args.filter and args.filter not in case.name:
+            continue
+        # Bulk cases handle many frames per call, fewer calls keep the runtime comparable
+        calls = 50 if case.frames < 1000 else 2
+        result = measure(case, batches=batches if case.frames < 1000 else max(5, batches // 20), calls=calls)
+        results["results"][case.name] = result
+        print("{:35} {:14.0f} {:10.2f} {:10.2f} {:12.0f} {:8.1f}".format(
+            case.name, result["frames_per_s"], result["p50_us"], result["p99_us"],
+            result["alloc_bytes_per_call"], result["retained_blocks_per_call"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("schema") != SCHEMA_VERSION:
+            print("Baseline {} has schema {}, latency percentiles are not compared".format(args.compare,
+                                                                                  baseline.get("schema")))
+        regressions = compare(baseline, results, args.threshold, args.tail_threshold)
+        for name, metric, old, new in regressions:
+            print("REGRESSION {}: {} {:.2f} -> {:.2f}".format(name, metric, old, new))
+        if regressions:
+            return 1
+        print("No regressions against {} ({})".format(args.compare, baseline.get("commit")))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Vectorized decoding of recorded CAN frames with NumPy.
+
+The signal layouts of the codecs registered in messages.py are translated into NumPy operations: byte aligned
+signals into a structured dtype, bit fields and truncated floats into shifts and masks of the 64 bit payload word.
+All frames of a capture are grouped by arbitration id with one sort, every group is then decoded with a single view of
+its payload bytes, so millions of frames are decoded without a Python loop per frame.
+
+The decoder of a message is built on first use from the codec registered at that time, so messages registered later,
+e.g. from a DBC file, are decoded as well. Signals are physical values like those of messages.decode_message():
+signals with a factor or offset are scaled and returned as float64, the others keep their raw type.
+
+Usage:
+    with CaptureReader("run.btecap") as capture:
+        signals = decode_capture(capture)
+    signals["SET_REF_SWITCH_CTRL_RI"]["set_ctrl"]
+"""
+
+import re
+
+import numpy as np
+
+import messages as msg
+
+
+"""Struct format characters and their NumPy equivalent (without byte order)."""
+_STRUCT_TO_NUMPY = {"b": "i1", "B": "u1", "?": "?",
+                    "h": "i2", "H": "u2", "i": "i4", "I": "u4", "l": "i4", "L": "u4",
+                    "q": "i8", "Q": "u8", "e": "f2", "f": "f4", "d": "f8"}
+
+_FORMAT_ITEM = re.compile(r"(\d*)([xcbB?hHiIlLqQefds])")
+
+
+def dtype_from_format(msg_fmt, fields, itemsize=8):
+    """ Structured dtype equivalent to a little- or big-endian struct format.
+
+    :param msg_fmt: struct format of the message description, e.g. "<ff"
+    :param fields: Names of the struct items in order
+    :param itemsize: Size of one payload row, 8 for classic CAN
+    :return: numpy.dtype
+    """
+    order = "<"
+    if msg_fmt[:1] in "<>!=@":
+        order = ">" if msg_fmt[0] in ">!" else "<"
+        msg_fmt = msg_fmt[1:]
+
+    names, formats, offsets = [], [], []
+    offset = 0
+    fields = iter(fields)
+    for count, char in _FORMAT_ITEM.findall(msg_fmt):
+        count = int(count) if count else 1
+        if char == "x":
+            offset += count
+            continue
+        if char == "s":
+            names.append(next(fields))
+            formats.append(("u1", count))
+            offsets.append(offset)
+            offset += count
+            continue
+        for _ in range(count):
+            dtype = np.dtype(order + _STRUCT_TO_NUMPY[char])
+            names.append(next(fields))
+            formats.append(dtype)
+            offsets.append(offset)
+            offset += dtype.itemsize
+    return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": max(itemsize, offset)})
+
+
+class MessageDecoder:
+    """ Vectorized decoder of the signals of one messages.MessageCodec.
+
+    :param codec: Compiled codec of the message, its signal layouts are decoded
+    """
+
+    __slots__ = ("codec", "dtype", "bit_fields")
+
+    def __init__(self, codec):
+        self.codec = codec
+        names, formats, offsets = [], [], []
+        bit_fields = []
+        for layout in codec.layouts:
+            code = _aligned_dtype(layout)
+            if code is None:
+                bit_fields.append(layout.name)
+                continue
+            names.append(layout.name)
+            formats.append(np.dtype(code))
+            offsets.append(layout.start_bit // 8)
+        self.dtype = np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": 8})
+        self.bit_fields = frozenset(bit_fields)
+
+    def decode(self, payloads):
+        """ Signals of payloads of this message.
+
+        :param payloads: Contiguous uint8 array of shape (N, 8)
+        :return: Dictionary of signal name to array in the order of the signal layouts
+        """
+        rows = payloads.view(self.dtype).reshape(-1)
+        words = payloads.view("<u8").reshape(-1) if self.bit_fields else None
+        signals = {}
+        for layout in self.codec.layouts:
+            if layout.name in self.bit_fields:
+                values = _bit_field(words, layout)
+            else:
+                values = rows[layout.name]
+            if layout.factor != 1 or layout.offset != 0:
+                values = values * np.float64(layout.factor) + layout.offset
+            signals[layout.name] = values
+        return signals
+
+
+def _aligned_dtype(layout):
+    """NumPy type of a signal that fills whole bytes with a NumPy size, None if it is decoded as bit field."""
+    if layout.start_bit % 8 or layout.length not in (8, 16, 32, 64):
+        return None
+    if layout.type == "float":
+        return "<f{}".format(layout.length // 8) if layout.length > 8 else None
+    return "<{}{}".format("i" if layout.type == "signed" else "u", layout.length // 8)
+
+
+def _bit_field(words, layout):
+    raw = words >> np.uint64(layout.start_bit)
+    if layout.length < 64:
+        raw = raw & np.uint64((1 << layout.length) - 1)
+    if layout.type == "float":
+        # Upper bits of an IEEE float, the dropped mantissa bits are zero
+        return (raw << np.uint64(32 - layout.length)).astype(np.uint32).view(np.float32)
+    if layout.type == "float_low":
+        # Lower bits of an IEEE float, sign and exponent are zero
+        return raw.astype(np.uint32).view(np.float32)
+    if layout.type == "signed":
+        sign = np.uint64(1 << (layout.length - 1))
+        return (raw ^ sign).astype(np.int64) - np.int64(sign)
+    return raw
+
+
+"""Decoder per arbitration id, built from the codec registered when the id is first decoded."""
+_DECODERS = {}
+
+
+def message_decoder(msg_id):
+    """ Vectorized decoder of a registered message, rebuilt when the codec of the id was replaced.
+
+    :return: MessageDecoder, None for unknown message ids
+    """
+    codec = msg.CODECS_BY_ID.get(msg_id)
+    if codec is None:
+        return None
+    decoder = _DECODERS.get(msg_id)
+    if decoder is None or decoder.codec is not codec:
+        decoder = _DECODERS[msg_id] = MessageDecoder(codec)
+    return decoder
+
+
+def decode_frames(ids, payloads, timestamps=None):
+    """ Decode a batch of frames into columnar signal arrays.
+
+    :param ids: Array of arbitration ids, shape (N,)
+    :param payloads: Array of payload bytes, shape (N, 8)
+    :param timestamps: Optional array of timestamps, shape (N,)
+    :return: Dictionary of message name to dictionary of signal name to array. Every message also contains
+             "index" (row in the input) and "timestamp" if timestamps were given. Unknown ids are skipped.
+    """
+    ids = np.asarray(ids)
+    payloads = np.asarray(payloads, dtype=np.uint8)
+    if payloads.ndim != 2 or payloads.shape[1] != 8:
+        raise ValueError("Payloads must have the shape (N, 8)")
+
+    order = np.argsort(ids, kind="stable")
+    unique_ids, starts = np.unique(ids[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+
+    result = {}
+    for msg_id, start, stop in zip(unique_ids.tolist(), starts, stops):
+        decoder = message_decoder(msg_id)
+        if decoder is None:
+            continue
+        index = order[start:stop]
+        signals = decoder.decode(np.ascontiguousarray(payloads[index]))
+        signals["index"] = index
+        if timestamps is not None:
+            signals["timestamp"] = np.asarray(timestamps)[index]
+        result[decoder.codec.msg_name] = signals
+    return result
+
+
+def decode_capture(capture):
+    """Decode all records of a capture.CaptureReader."""
+    records = capture.array()
+    return decode_frames(records["arbitration_id"], records["data"], records["timestamp"])
+
+
+def encode_ref_switch_ctrl_ri(set_ref, set_switch, set_ctrl, rst_q=0, rst_e=0, set_ri=0.0):
+    """ Vectorized encoding of SET_REF_SWITCH_CTRL_RI (0xC1) payloads.
+
+    All parameters accept scalars or arrays, they are broadcast against each other.
+    :return: Contiguous uint8 array of shape (N, 8), one payload per row
+    """
+    set_ref, set_switch, set_ctrl, rst_q, rst_e, set_ri = np.broadcast_arrays(
+        np.atleast_1d(set_ref), set_switch, set_ctrl, rst_q, rst_e, set_ri)
+    frames = np.zeros(len(set_ref), dtype=dtype_from_format(msg.SET_REF_SWITCH_CTRL_RI["msg_fmt"],
+                                                            msg.SET_REF_SWITCH_CTRL_RI["msg_fields"]))
+    frames["set_ref"] = set_ref
+    frames["reg_ctrl"] = ((np.asarray(set_switch, dtype=np.uint8) & 0x07)
+                          | (np.asarray(set_ctrl, dtype=np.uint8) & 0x07) << 3
+                          | (np.asarray(rst_q, dtype=np.uint8) & 0x01) << 6
+                          | (np.asarray(rst_e, dtype=np.uint8) & 0x01) << 7)
+    ri = np.asarray(set_ri, dtype=np.float32).view(np.uint32)
+    frames["set_ri"] = np.stack([ri & 0xFF, (ri >> 8) & 0xFF, (ri >> 16) & 0xFF], axis=-1)
+    return frames.view(np.uint8).reshape(-1, 8)
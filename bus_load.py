@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Bus load planning of the periodic message schedule.
+
+The worst-case length of a classic CAN frame including stuff bits and interframe space is computed from the DLC of
+the message description, together with the declared "freq" this gives the bus utilization at the selected bitrate.
+Schedules above the allowed utilization are rejected with ScheduleError.
+
+Messages with the same or harmonic periods are all due at the same moment if they are started together, which
+causes transmit bursts: the frames queue up in the controller and the low priority ones are delayed by arbitration.
+The planner therefore assigns a phase offset to every periodic message. On a grid of slots of one frame time within
+the hyperperiod, the messages are placed one after another (highest rate first) at the offset whose busiest slot
+is the least occupied.
+
+Usage:
+    plan = plan_schedule([msg.SET_REF_SWITCH_CTRL_RI, msg.SET_OP_LIM_U, msg.SET_OP_LIM_I], tas.CAN_BITRATE,
+                         external=[msg.STATUS_MEAS_U_I, msg.STATUS_SYSTEM])
+    scheduler.apply_plan(plan)
+"""
+
+import collections
+import math
+import logging
+
+import messages as msg
+
+
+logger = logging.getLogger("calibration.bus_load")
+
+
+MAX_UTILIZATION = 0.7           # Utilization leaving headroom for retransmissions and event driven frames
+MAX_HYPERPERIOD_US = 10000000   # Larger hyperperiods are cut, the phases are then planned on this window
+
+
+class ScheduleError(ValueError):
+    """Raised if a schedule does not fit on the bus."""
+    pass
+
+
+def frame_bits(dlc, extended=False):
+    """ Worst-case number of bits of a classic CAN data frame.
+
+    Contains the frame with the maximum number of stuff bits (one after every four bits of the stuffed region from
+    SOF to CRC) plus the 3 bit interframe space.
+
+    :param dlc: Number of data bytes
+    :param extended: Whether the frame has an extended (29 bit) id
+    """
+    stuffed = (54 if extended else 34) + 8 * dlc       # SOF, arbitration, control, data and CRC field
+    return stuffed + 13 + (stuffed - 1) // 4            # CRC delimiter, ACK, EOF and IFS are not stuffed
+
+
+def frame_time(dlc, bitrate, extended=False):
+    """Worst-case transmission time of a frame in seconds."""
+    return frame_bits(dlc, extended) / bitrate
+
+
+"""Planned periodic message, phase is the offset of the first transmission within the hyperperiod in seconds"""
+PlannedMessage = collections.namedtuple("PlannedMessage", "msg_id msg_name dlc freq frame_time utilization phase")
+
+
+class BusLoadPlan:
+    """Result of plan_schedule()."""
+
+    def __init__(self, bitrate, messages, external, hyperperiod, peak_burst, unstaggered_peak_burst):
+        self.bitrate = bitrate
+        self.messages = messages                # msg_id -> PlannedMessage of the own periodic messages
+        self.external = external                # msg_id -> PlannedMessage of messages sent by other nodes
+        self.hyperperiod = hyperperiod
+        self.peak_burst = peak_burst            # Maximum number of frames due within one frame time
+        self.unstaggered_peak_burst = unstaggered_peak_burst
+
+    @property
+    def utilization(self):
+        return (sum(entry.utilization for entry in self.messages.values())
+                + sum(entry.utilization for entry in self.external.values()))
+
+    def phase(self, msg_id):
+        """Planned phase of a message in seconds, None if the message is not part of the plan."""
+        entry = self.messages.get(msg_id)
+        return entry.phase if entry is not None else None
+
+    def as_dict(self):
+        return {"bitrate": self.bitrate,
+                "utilization": self.utilization,
+                "hyperperiod": self.hyperperiod,
+                "peak_burst": self.peak_burst,
+                "unstaggered_peak_burst": self.unstaggered_peak_burst,
+                "messages": [entry._asdict() for entry in self.messages.values()],
+                "external": [entry._asdict() for entry in self.external.values()]}
+
+
+def _entries(messages, bitrate, extended):
+    for item in messages:
+        msg_info, freq = item if isinstance(item, tuple) else (item, None)
+        codec = msg.get_codec(msg_info)
+        freq = freq or codec.freq
+        if not freq:
+            raise ScheduleError("No transmission rate declared for 0x{:X}".format(codec.msg_id))
+        duration = frame_time(codec.dlc, bitrate, extended)
+        yield PlannedMessage(codec.msg_id, codec.msg_name, codec.dlc, freq, duration, duration * freq, 0.0)
+
+
+def _lcm(a, b):
+    return a * b // math.gcd(a, b)
+
+
+def plan_schedule(messages, bitrate, external=(), max_utilization=MAX_UTILIZATION, extended=False):
+    """ Check a periodic schedule against the bus capacity and assign phase offsets.
+
+    :param messages: Own periodic messages, as message descriptions, names or ids, or (message, freq) tuples
+    :param bitrate: Bitrate of the bus in bit/s, e.g. tas.CAN_BITRATES["500K"]
+    :param external: Periodic messages of other nodes (e.g. the status messages of the BTE), counted in the
+                     utilization only
+    :param max_utilization: Maximum allowed bus utilization
+    :param extended: Whether the own messages use extended ids
+    :raises ScheduleError: If the utilization exceeds max_utilization
+    :return: BusLoadPlan
+    """
+    planned = list(_entries(messages, bitrate, extended))
+    others = list(_entries(external, bitrate, False))
+    utilization = sum(entry.utilization for entry in planned + others)
+    if utilization > max_utilization:
+        raise ScheduleError("Bus utilization {:.1%} at {} bit/s exceeds the allowed {:.1%}".format(
+            utilization, bitrate, max_utilization))
+    if not planned:
+        return BusLoadPlan(bitrate, {}, {entry.msg_id: entry for entry in others}, 0.0, 0, 0)
+
+    # Integer microsecond grid, one slot holds the longest planned frame
+    periods = {entry.msg_id: max(1, int(round(1e6 / entry.freq))) for entry in planned}
+    slot = max(1, int(math.ceil(max(entry.frame_time for entry in planned) * 1e6)))
+    hyperperiod = 1
+    for period in periods.values():
+        hyperperiod = _lcm(hyperperiod, period)
+    if hyperperiod > MAX_HYPERPERIOD_US:
+        logger.warning("Hyperperiod of %d us cut to %d us", hyperperiod, MAX_HYPERPERIOD_US)
+        hyperperiod = MAX_HYPERPERIOD_US
+    # The last slot is partial if the hyperperiod is no multiple of the slot, frames past the end wrap around in time
+    slots = [0] * -(-hyperperiod // slot)
+    unstaggered = collections.Counter()
+
+    result = {}
+    for entry in sorted(planned, key=lambda entry: (-entry.freq, entry.msg_id)):
+        period = periods[entry.msg_id]
+        occurrences = range(0, hyperperiod, period)
+        for start in occurrences:
+            unstaggered[start // slot] += 1
+
+        best_phase, best_cost = 0, None
+        for phase in range(0, period, slot):
+            cost = max(slots[(phase + start) % hyperperiod // slot] for start in occurrences)
+            if best_cost is None or cost < best_cost:
+                best_phase, best_cost = phase, cost
+                if cost == 0:
+                    break
+        for start in occurrences:
+            slots[(best_phase + start) % hyperperiod // slot] += 1
+        result[entry.msg_id] = entry._replace(phase=best_phase / 1e6)
+
+    plan = BusLoadPlan(bitrate, result, {entry.msg_id: entry for entry in others}, hyperperiod / 1e6,
+                       max(slots), max(unstaggered.values()))
+    logger.debug("Bus load plan at %d bit/s: utilization %.1f %%, peak burst %d (unstaggered %d)", bitrate,
+                 100 * plan.utilization, plan.peak_burst, plan.unstaggered_peak_burst)
+    return plan
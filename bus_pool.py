@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Pool of open CAN bus connections for long-running processes.
+
+Opening a channel of a hardware interface takes noticeable time. The pool keeps every bus open after a session and
+hands it to the next session on the same interface, channel and bitrate. A bus is leased by one session at a time;
+before it is handed out again its state is reset:
+    - periodic tasks of the interface are stopped and the acceptance filters are opened again
+    - the transmit queue is flushed and frames still queued for reception are drained
+
+A bus in error state (bus-off) or released after a CAN error is shut down and opened again on the next lease.
+Bus-off is read from BusABC.state. Interfaces that do not report their state (e.g. Kvaser with python-can 3.x) always
+look active, on them a bus-off is only noticed when the session ends with a CanError.
+
+Usage:
+    pool = BusPool()
+    with pool.lease("kvaser", 0, 500000) as bus:
+        CalibrationRunner.run_session(bus, session)
+    pool.close()
+"""
+
+import atexit
+import collections
+import contextlib
+import threading
+import time
+import logging
+
+import can
+
+
+logger = logging.getLogger("calibration.bus_pool")
+
+
+BusKey = collections.namedtuple("BusKey", "interface channel bitrate")
+
+
+class BusBusy(can.CanError):
+    """The bus is leased by another session for longer than the timeout."""
+
+
+def open_bus(key):
+    """Default factory of the pool."""
+    return can.interface.Bus(bustype=key.interface, channel=key.channel, bitrate=key.bitrate)
+
+
+def bus_off(bus):
+    """ Whether the controller of a bus left the bus, e.g. after too many errors.
+
+    Only interfaces that override BusABC.state report it, for the others this is always False. A state that can not
+    be read because of an interface error counts as bus-off, the bus is reconnected.
+    """
+    try:
+        return bus.state == can.BusState.ERROR
+    except NotImplementedError:
+        return False
+    except can.CanError:
+        return True
+
+
+class _Entry:
+    __slots__ = ("key", "bus", "leased", "failed", "opened")
+
+    def __init__(self, key):
+        self.key = key
+        self.bus = None
+        self.leased = False
+        self.failed = False         # Released after a CAN error, reconnect before the next lease
+        self.opened = None
+
+
+class BusPool:
+    """ Open CAN buses keyed by interface, channel and bitrate.
+
+    :param factory: Function factory(BusKey) -> can.BusABC opening a bus, default open_bus()
+    :param max_drain: Maximum number of received frames discarded when a bus is reset
+    """
+
+    def __init__(self, factory=open_bus, max_drain=100000):
+        self._factory = factory
+        self.max_drain = max_drain
+        self._entries = {}
+        self._by_bus = {}
+        self._condition = threading.Condition()
+        self.statistics = collections.Counter()     # opened, reused, reconnected, discarded, drained
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        with self._condition:
+            return sum(1 for entry in self._entries.values() if entry.bus is not None)
+
+    def acquire(self, interface, channel, bitrate=None, timeout=None):
+        """ Lease the bus of a channel, it is opened on first use and reconnected after bus-off.
+
+        :param timeout: Maximum time to wait for a bus leased by another session, None waits forever
+        :raises BusBusy: The bus is still leased after the timeout
+        :return: can.BusABC, give it back with release()
+        """
+        key = BusKey(interface, channel, bitrate)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(key)
+            while entry.leased:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise BusBusy("Bus {} is in use by another session".format(key))
+                self._condition.wait(remaining)
+            entry.leased = True
+
+        # Opening and resetting may block on the hardware, the lease keeps other sessions away meanwhile
+        try:
+            self._prepare(entry)
+        except BaseException:
+            with self._condition:
+                entry.leased = False
+                self._condition.notify_all()
+            raise
+        return entry.bus
+
+    def release(self, bus, failed=False):
+        """ Give a leased bus back to the pool.
+
+        Releasing a bus twice, or a bus that was discarded, closed with the pool or never leased, does nothing, so
+        cleanup code can not hide the error that ended a session.
+        :param failed: The session ended with a CAN error, the bus is reconnected before the next lease
+        """
+        with self._condition:
+            entry = self._by_bus.get(id(bus))
+            if entry is None or entry.bus is not bus:
+                logger.debug("Bus %s is not leased from the pool, release ignored", bus)
+                return
+            entry.failed = entry.failed or failed
+            entry.leased = False
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def lease(self, interface, channel, bitrate=None, timeout=None):
+        """Context manager of acquire() and release(), a CAN error in the block marks the bus for reconnection."""
+        bus = self.acquire(interface, channel, bitrate, timeout)
+        failed = False
+        try:
+            yield bus
+        except can.CanError:
+            failed = True
+            raise
+        finally:
+            self.release(bus, failed=failed or bus_off(bus))
+
+    def discard(self, bus):
+        """Shut down a bus and remove it from the pool, the next lease of its channel opens it again."""
+        with self._condition:
+            entry = self._by_bus.pop(id(bus), None)
+            if entry is None:
+                return
+            entry.bus = None
+            entry.failed = False
+            # The next lease of the channel opens a new bus, a session waiting for it must not wait for the release
+            entry.leased = False
+            self._condition.notify_all()
+        self._shutdown(bus)
+        self.statistics["discarded"] += 1
+
+    def close(self):
+        """Shut down all buses, leased ones included."""
+        with self._condition:
+            buses = [entry.bus for entry in self._entries.values() if entry.bus is not None]
+            self._entries.clear()
+            self._by_bus.clear()
+            self._condition.notify_all()
+        for bus in buses:
+            self._shutdown(bus)
+
+    def reset(self, bus):
+        """ Bring a bus into the state of a fresh connection.
+
+        :return: Number of drained frames
+        """
+        bus.stop_all_periodic_tasks()
+        bus.set_filters(None)
+        bus.flush_tx_buffer()
+        drained = 0
+        while drained < self.max_drain and bus.recv(0) is not None:
+            drained += 1
+        if drained:
+            logger.debug("%d frames drained from %s", drained, bus.channel_info)
+        self.statistics["drained"] += drained
+        return drained
+
+    def _prepare(self, entry):
+        if entry.bus is not None and (entry.failed or bus_off(entry.bus)):
+            logger.warning("Bus %s is reconnected after %s", entry.key, "an error" if entry.failed else "bus-off")
+            with self._condition:
+                self._by_bus.pop(id(entry.bus), None)
+            self._shutdown(entry.bus)
+            entry.bus = None
+            self.statistics["reconnected"] += 1
+        entry.failed = False
+
+        if entry.bus is not None:
+            try:
+                self.reset(entry.bus)
+                self.statistics["reused"] += 1
+                return
+            except can.CanError:
+                logger.warning("Reset of bus %s failed, it is reconnected", entry.key, exc_info=True)
+                with self._condition:
+                    self._by_bus.pop(id(entry.bus), None)
+                self._shutdown(entry.bus)
+                entry.bus = None
+                self.statistics["reconnected"] += 1
+
+        start = time.perf_counter()
+        bus = self._factory(entry.key)
+        entry.opened = time.time()
+        with self._condition:
+            entry.bus = bus
+            self._by_bus[id(bus)] = entry
+        self.statistics["opened"] += 1
+        logger.info("Bus %s opened in %.1f ms", entry.key, 1000 * (time.perf_counter() - start))
+
+    @staticmethod
+    def _shutdown(bus):
+        try:
+            bus.shutdown()
+        except Exception as e:
+            logger.warning("Shutdown of bus %s failed: %s", bus, e)
+
+
+"""Pool of the process, used by multi_unit.calibrate_units() and sessions.open_device()."""
+BUS_POOL = BusPool()
+atexit.register(BUS_POOL.close)
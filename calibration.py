@@ -3,24 +3,32 @@
 #
 
 """
-Comment style description of the script's purpose.
+Console entry point of the BTE calibration tool: initializes and calibrates BTE units over CAN, replays recorded
+captures and session journals and analyses the step responses of captures.
 
-FILE_STRUCTURE: main.py: Contains general program parts like console argument handling, filesystem jobs, CAN interface handling.
-				calibration.py: Contains basic information, required for the calibration process. E.g. writing the calibration protocol
-								sending messages,
-				messages.py: Provides message details, generates messages and converts message data back into raw values.
+FILE_STRUCTURE: calibration.py: Console entry point, argument handling and logging configuration.
+                sessions.py: Contains the calibration sessions and the CAN interface handling.
+                messages.py: Provides message details, generates messages and converts message data back into raw values.
+
+Commands:
+    version:       Show software version
+    calibrate:     Initialize or calibrate units, the default command (see calibrate --help)
+    replay:        Replay recorded captures as decoded messages, or show the state of session journals, e.g.
+                   whether an interrupted sweep can be resumed
+    analyse:       Step response statistics of recorded captures
 
 Arguments:
     --version:     Show software version
-    --debug:        Activates debugging messages into a logfile
+    --debug:       Activates debugging messages into a logfile (calibrate)
 
+The CAN backend, NumPy and the YAML logging configuration are only imported by the commands that use them, so
+calling the tool for its version or a journal state is cheap. benchmark.py --import-budget checks this.
 """
 
 #TODO: Check argument list items exists and raise an error if not. (Bitrate, Device)
 
 
 import sys, os, argparse
-import can
 import logging
 
 
@@ -29,41 +37,17 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_DIR = os.path.join(BASE_DIR, "cfg")
 LOOPBACK_DEVICE = True      # Second interface channel for sw-testing
 
+COMMANDS = ("version", "calibrate", "replay", "analyse")
+
 """Enviroment variable to get a default logging configuration file."""
 #env_key = "LOG_CFG"
 #print(os.getenv(env_key, None))
 
-if os.path.exists(os.path.join(CONFIG_DIR, "logging.yaml")):
-    import yaml
-    import logging.config
-
-    with open(os.path.join(CONFIG_DIR, "logging.yaml"), "rt") as f:
-        config = yaml.safe_load(f.read())
-        logging.config.dictConfig(config)
-else:
-    print("no logging config file found")
-    frm = logging.Formatter("[{levelname:8}] {asctime} : [FROM: {module} <- {funcName}] : [{name}] -> {message}",
-                            "%d.%m.%Y %H:%M:%S", style="{")
-    # Setup for file logging
-    logfile_name = __file__[:-3] + ".log"
-    fh = logging.FileHandler(filename=logfile_name, mode='w', delay=True)
-    fh.setFormatter(frm)
-    fh.setLevel(logging.WARNING)
-    # Setup for console logging
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(frm)
-    ch.setLevel(logging.DEBUG)
-    # logger.addHandler(fh) # activated via console command
-    #logger.addHandler(ch)
-
 logger = logging.getLogger("calibration")
 #logger.setLevel(logging.DEBUG)
 # Configure module logger object
 
 
-import tas_protocol as tas  # Initialized here to make the logger objects working at module level
-
-
 class InvalidArguments(Exception):
     """Used for provided invalid console arguments."""
     pass
@@ -73,89 +57,334 @@ def dummyA(*args, **kwargs):
     pass
 
 
+def setup_logging(debug=False):
+    """ Configure logging from cfg/logging.yaml, or write warnings into a logfile next to the script.
 
-def main():
-    logger.info("*** BTE Calibration Tool ***\n")
-    appRunning = True
-    logger_can = logging.getLogger('canlogger')
-    logger_can.debug("CAN LOGGER created")
-
-    """
-        W R I T E   C O D E   H E R E
+    :param debug: Write debugging messages into the logfile as well
     """
+    if os.path.exists(os.path.join(CONFIG_DIR, "logging.yaml")):
+        import yaml
+        from logging.config import dictConfig
 
-    l = can.CSVWriter(filename="test.csv")
-    while appRunning:
-        try:
+        with open(os.path.join(CONFIG_DIR, "logging.yaml"), "rt") as f:
+            config = yaml.safe_load(f.read())
+            dictConfig(config)
+    else:
+        print("no logging config file found")
+        frm = logging.Formatter("[{levelname:8}] {asctime} : [FROM: {module} <- {funcName}] : [{name}] -> {message}",
+                                "%d.%m.%Y %H:%M:%S", style="{")
+        # Setup for file logging
+        logfile_name = __file__[:-3] + ".log"
+        fh = logging.FileHandler(filename=logfile_name, mode='w', delay=True)
+        fh.setFormatter(frm)
+        fh.setLevel(logging.DEBUG if debug else logging.WARNING)
+        # Setup for console logging
+        ch = logging.StreamHandler(sys.stdout)
+        ch.setFormatter(frm)
+        ch.setLevel(logging.DEBUG)
+        if debug:
+            logger.addHandler(fh)
+            logger.setLevel(logging.DEBUG)
+        #logger.addHandler(ch)
 
-            for msg in tas.macroBTE_Initialization(slope_u_i_pwr=(200,200,200),
-                                                   limit_mn_u_i_pwr=(0,600,200),
-                                                   limit_mx_u_i_pwr=(0,600,200)):
-                logger_can.info(msg)
-                can_device.send(msg)
+    logger.debug("Base directory: %s", BASE_DIR)
+    logger.debug("Log configuration directory: %s", CONFIG_DIR)
 
 
-            for msg in lp_device:
-                print(msg)
+"""
 
+    C O M M A N D S
 
-            appRunning = False
-            logger.info("Program will quit here")
+"""
 
-        except can.CanError as e:
-            logger.error("Error occurred while CAN interface was active. %s", e)
 
-        except KeyboardInterrupt:
-            logger.info("User quit program!")
-            appRunning = False
+def command_version(args):
+    print("BTE Calibration Tool - v{}".format(SW_VERION))
+    return 0
 
-    print("Program exit")
 
+def command_calibrate(args):
+    """Calibrate the units given by --unit, or initialize the device of the CAN configuration without units."""
+    setup_logging(args.debug)
+    try:
+        if args.dbc:
+            from dbc import load_dbc
+            load_dbc(args.dbc).register()
+        if args.metrics or args.metrics_port is not None:
+            from metrics import METRICS
+            METRICS.enable()
+            if args.metrics_port is not None:
+                METRICS.serve(args.metrics_port)
+            if args.metrics:
+                import atexit
+                atexit.register(METRICS.dump, args.metrics)
+
+        import tas_protocol as tas
+        from multi_unit import UnitSpec
+        interface = "virtual" if args.simulate else args.interface or tas.CAN_INTERFACE
+        units = [UnitSpec.parse(unit, interface=interface) for unit in args.units]
+    except (InvalidArguments, ValueError, OSError) as e:
+        logger.error("Invalid argument provided: %s", e)
+        return 1
+
+    import sessions
+
+    if not units:
+        from bus_pool import BUS_POOL
+        # Leased like the buses of the units, a bus opened before by the same process is reused
+        devices = sessions.open_device(LOOPBACK_DEVICE, pool=BUS_POOL)
+        if devices is None:
+            return 1
+        ok = sessions.run_device_session(*devices, metadata={"sw_version": SW_VERION}, pool=BUS_POOL)
+        return 0 if ok else 1
+
+    import functools
+    from multi_unit import calibrate_units
+
+    if args.sweep:
+        session = functools.partial(sessions.calibrate_bte, journal_dir=args.journal_dir)
+    else:
+        session = sessions.initialize_bte
+    store = None
+    progress = None
+    if args.store:
+        from result_store import ResultStore
+        store = ResultStore(args.store)
+        # Results are queued to the background writer as soon as a unit finished
+        progress = lambda result, snapshot: store.submit(result, metadata={"sw_version": SW_VERION})
+    try:
+        if args.simulate:
+            from simulator import SimulatorFarm
+            with SimulatorFarm([unit.channel for unit in units]):
+                results = calibrate_units(units, session, progress=progress)
+        else:
+            results = calibrate_units(units, session, progress=progress)
+    finally:
+        # Results still queued for the writer thread are written before the process exits
+        if store is not None:
+            store.close()
+    for result in results:
+        print("{}: {}".format(result.serial, "OK" if result.ok else result.error))
+        if result.ok and result.result:
+            print("    time saved: {:.2f} s, voltage fit: {}".format(result.result["settle"]["time_saved"],
+                                                                    result.result["fit"].get("voltage")))
+    return 0 if all(result.ok for result in results) else 1
+
+
+def command_replay(args):
+    """Print the decoded messages of captures and the state of session journals as rebuilt on resume."""
+    import json
+    from capture import MAGIC
+    from journal import replay
+    from fit import CalibrationFit
+
+    status = 0
+    states = []
+    for filename in args.files:
+        if _is_capture(filename, MAGIC):
+            try:
+                states.append(_replay_capture(filename, args.frames))
+            except Exception as e:
+                logger.error("Capture %s can not be replayed: %r", filename, e)
+                status = 1
+            continue
+        try:
+            state = replay(filename)
+        except (ValueError, OSError) as e:
+            logger.error("Journal %s can not be replayed: %s", filename, e)
+            status = 1
+            continue
+        if state is None:
+            logger.error("Journal %s does not exist", filename)
+            status = 1
+            continue
+        if state.done:
+            fit = state.result.get("fit", {})
+        else:
+            fit = CalibrationFit.from_state(state.fit).coefficients() if state.fit is not None else {}
+        states.append({"journal": filename,
+                       "records": state.records,
+                       "sweep": state.session.get("sweep") if state.session else None,
+                       "points": state.points if args.points else state.completed_points,
+                       "done": state.done,
+                       "fit": fit})
+
+    if args.json:
+        print(json.dumps(states, indent=2))
+        return status
+    for entry in states:
+        if "capture" in entry:
+            _print_capture(entry)
+            continue
+        points = entry["points"] if isinstance(entry["points"], int) else len(entry["points"])
+        print("{}: {} records, {} points, {}".format(entry["journal"], entry["records"], points,
+                                                     "done" if entry["done"] else "resumable"))
+        voltage = entry["fit"].get("voltage")
+        if voltage:
+            print("    voltage gain {:.6f}, offset {:.4f}".format(voltage["gain"], voltage["offset"]))
+        if args.points:
+            for index, point in enumerate(entry["points"]):
+                print("    {:3d} setpoint {:8.2f} mean {:10.4f} std {:.4f} dwell {:.3f} s{}".format(
+                    index, point["setpoint"], point["mean"], point["std"], point["dwell"],
+                    "" if point["settled"] else " (not settled)"))
+    return status
+
+
+def _is_capture(filename, magic):
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(magic)) == magic
+    except OSError:
+        return False
 
-if __name__ == "__main__":
 
-    logger.debug("Base directory: %s", BASE_DIR)
-    logger.debug("Log configuration directory: %s", CONFIG_DIR)
+def _replay_capture(filename, frames=False):
+    """ Decode all frames of a capture with bulk_codec, unknown ids are left out.
 
-    # Read console arguments
-    parser = argparse.ArgumentParser()
+    :param frames: Also list every decoded frame in the recorded order
+    :return: Dictionary with the signal statistics per message and optionally the frames
+    """
+    from capture import CaptureReader
+    from bulk_codec import decode_capture
+
+    with CaptureReader(filename) as capture:
+        decoded = decode_capture(capture)
+        entry = {"capture": filename, "metadata": capture.metadata, "records": len(capture), "messages": {}}
+    rows = []
+    for name, signals in decoded.items():
+        names = [signal for signal in signals if signal not in ("index", "timestamp")]
+        entry["messages"][name] = {
+            "count": int(len(signals["index"])),
+            "first": float(signals["timestamp"].min()),
+            "last": float(signals["timestamp"].max()),
+            "signals": {signal: {"min": float(signals[signal].min()), "max": float(signals[signal].max()),
+                                 "mean": float(signals[signal].mean())} for signal in names}}
+        if frames:
+            values = list(zip(*(signals[signal].tolist() for signal in names)))
+            rows.extend((index, timestamp, name, dict(zip(names, row)))
+                        for index, timestamp, row in zip(signals["index"].tolist(), signals["timestamp"].tolist(),
+                                                         values))
+    if frames:
+        entry["frames"] = [{"timestamp": timestamp, "msg_name": name, "signals": values}
+                           for _, timestamp, name, values in sorted(rows, key=lambda row: row[0])]
+    return entry
+
+
+def _print_capture(entry):
+    decoded = sum(message["count"] for message in entry["messages"].values())
+    print("{}: {} records, {} decoded".format(entry["capture"], entry["records"], decoded))
+    for name, message in sorted(entry["messages"].items()):
+        print("    {:28} {:8d} frames {:14.6f} .. {:14.6f} s".format(name, message["count"], message["first"],
+                                                                   message["last"]))
+        for signal, values in message["signals"].items():
+            print("        {:24} min {:12.4f} max {:12.4f} mean {:12.4f}".format(signal, values["min"], values["max"],
+                                                                             values["mean"]))
+    for frame in entry.get("frames", ()):
+        print("    {:14.6f} {:28} {}".format(frame["timestamp"], frame["msg_name"], " ".join(
+            "{}={}".format(signal, value) for signal, value in frame["signals"].items())))
+
+
+def command_analyse(args):
+    """Print the step response statistics of captures."""
+    import json
+    from capture import CaptureReader
+    from analysis import analyse_capture
+
+    status = 0
+    summaries = {}
+    for filename in args.captures:
+        try:
+            with CaptureReader(filename) as capture:
+                steps, summary = analyse_capture(capture, low=args.low, high=args.high, min_step=args.min_step)
+        except Exception as e:
+            logger.error("Capture %s can not be analysed: %r", filename, e)
+            status = 1
+            continue
+        summary["steps"] = int(len(steps["time"]))
+        summaries[filename] = summary
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+        return status
+    for filename, summary in summaries.items():
+        print("{}: {} steps".format(filename, summary["steps"]))
+        for name in ("latency", "rise_time", "overshoot"):
+            values = summary[name]
+            if values["count"]:
+                print("    {:10} p50 {:10.4f} p90 {:10.4f} p99 {:10.4f} max {:10.4f} ({} missing)".format(
+                    name, values["p50"], values["p90"], values["p99"], values["max"], values["missing"]))
+            else:
+                print("    {:10} no values ({} missing)".format(name, values["missing"]))
+    return status
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="BTE Calibration Tool")
     parser.add_argument("--version", action="store_true", default=False, dest="sw_version",
                         help="Print software version")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    version = commands.add_parser("version", help="Print software version")
+    version.set_defaults(func=command_version)
+
+    calibrate = commands.add_parser("calibrate", help="Initialize or calibrate units (default command)")
+    calibrate.set_defaults(func=command_calibrate)
+    calibrate.add_argument("--debug", action="store_true", default=False,
+                           help="Activates debugging messages into a logfile")
+    calibrate.add_argument("--unit", action="append", default=[], dest="units", metavar="CHANNEL:SERIAL",
+                           help="Calibrate several units in parallel, one CAN channel per unit")
+    calibrate.add_argument("--interface", default=None,
+                           help="CAN interface used for the units, e.g. virtual for sw-testing")
+    calibrate.add_argument("--simulate", action="store_true", default=False,
+                           help="Calibrate simulated units on virtual buses instead of hardware")
+    calibrate.add_argument("--sweep", action="store_true", default=False,
+                           help="Run the 800V calibration sweep with settle detection on the units")
+    calibrate.add_argument("--journal-dir", default=None, metavar="DIR",
+                           help="Journal every unit of the sweep into DIR and resume interrupted sessions from it")
+    calibrate.add_argument("--store", default=None, metavar="DATABASE",
+                           help="Store the results of the units in a SQLite database")
+    calibrate.add_argument("--dbc", default=None, metavar="FILE",
+                           help="Load the message descriptions from a DBC file instead of the built-in ones")
+    calibrate.add_argument("--metrics", default=None, metavar="FILE",
+                           help="Record per message id metrics and write a JSON snapshot to FILE on exit")
+    calibrate.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+                           help="Record metrics and serve them in Prometheus text format on localhost:PORT/metrics")
     #TODO: Add location to CAN logfile
-    args = parser.parse_args()
-    try:
-        if args.sw_version:
-            print("BTE Calibration Tool - v{}".format(SW_VERION))
-            sys.exit(0)
 
-    except InvalidArguments as e:
-        logger.error("Invalid argument provided")
-        sys.exit(1)
-
-    """Create a CAN device based on available configuration methodes.
-    Only the root directory can be used to load the interface configuration. 
-    Otherwise an error is raised when creating the can.Bus() object.
+    replay = commands.add_parser("replay", help="Replay captures as decoded messages, or show the state of journals",
+                                 description="Captures are decoded with the message descriptions and summarised per "
+                                             "message, journals are replayed to the state a resumed sweep starts "
+                                             "from. The frames are not sent onto a bus.")
+    replay.set_defaults(func=command_replay)
+    replay.add_argument("files", nargs="+", metavar="CAPTURE|JOURNAL")
+    replay.add_argument("--frames", action="store_true", default=False,
+                        help="List every decoded frame of the captures in the recorded order")
+    replay.add_argument("--points", action="store_true", default=False, help="List the completed points of journals")
+    replay.add_argument("--json", action="store_true", default=False, help="Print the result as JSON")
+
+    analyse = commands.add_parser("analyse", help="Step response statistics of captures")
+    analyse.set_defaults(func=command_analyse)
+    analyse.add_argument("captures", nargs="+", metavar="CAPTURE")
+    analyse.add_argument("--low", type=float, default=0.1, help="Latency threshold relative to the step size")
+    analyse.add_argument("--high", type=float, default=0.9, help="End of the rise time relative to the step size")
+    analyse.add_argument("--min-step", type=float, default=1.0, help="Minimum setpoint change counted as step")
+    analyse.add_argument("--json", action="store_true", default=False, help="Print the statistics as JSON")
+    return parser
+
+
+def main(argv=None):
+    """ Run a command, see COMMANDS.
+
+    Arguments without command are passed to calibrate, so the options of earlier versions keep working.
     """
-    try:
-        if os.path.exists("can.ini"):
-            logger.debug("Loading CAN device settings from file")
-            can.util.load_file_config()
-            can_device = can.Bus()
-        else:
-            logger.warning("CAN device configuration file not found")
-            can.rc["interface"] = tas.CAN_INTERFACE
-            can.rc["channel"] = tas.CAN_CHANNEL
-            can.rc["bitrate"] = tas.CAN_BITRATE
-            can_device = can.interface.Bus()
-    except can.CanError as e:
-            logger.error("Failure during creating CAN device %s", e)
-    else:
-        logger.info("CAN device created: %s", can_device)
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help", "--version")):
+        argv.insert(0, "calibrate")
+    args = build_parser().parse_args(argv)
+    if args.sw_version:
+        return command_version(args)
+    return args.func(args)
 
-    if LOOPBACK_DEVICE:
-        lp_device = can.interface.Bus(bustype=tas.CAN_DEVICES["kvaser"],
-                                      channel=1,
-                                      bitrate=tas.CAN_BITRATES["500K"])
-        logger.debug("Loopback-Interface: %s", lp_device)
 
-    main()
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Compact binary capture format for CAN traffic.
+
+FILE_STRUCTURE: header:  magic, version, record size, metadata length, metadata (JSON)
+                records: fixed size records, see RECORD_FORMAT
+                footer:  JSON index of the record blocks (time range and ids per block) and of the arbitration ids
+                trailer: offset and length of the footer, closing magic
+
+The writer only appends. Records are collected in a buffer and written in chunks, the footer is written when the
+capture is stopped. A capture without footer (e.g. after a crash) can still be read, the reader then scans all blocks.
+The reader maps the file into memory and only touches the blocks that contain the requested id or time window.
+"""
+
+import json
+import mmap
+import struct
+import logging
+
+import can
+
+
+logger = logging.getLogger("calibration.capture")
+
+
+MAGIC = b"BTECAP01"
+TRAILER_MAGIC = b"BTEIDX01"
+VERSION = 1
+
+HEADER_FORMAT = struct.Struct("<8sHHI")             # magic, version, record size, metadata length
+RECORD_FORMAT = struct.Struct("<dIBB8s2x")          # timestamp, arbitration id, dlc, flags, data
+TRAILER_FORMAT = struct.Struct("<QI8s")             # footer offset, footer length, magic
+
+BLOCK_RECORDS = 65536                               # Records per index block
+
+FLAG_EXTENDED = 0x01
+FLAG_REMOTE = 0x02
+FLAG_ERROR = 0x04
+FLAG_RX = 0x08
+
+"""NumPy dtype equivalent to RECORD_FORMAT, used for zero-copy views of a capture."""
+RECORD_DTYPE_SPEC = {"names": ["timestamp", "arbitration_id", "dlc", "flags", "data"],
+                     "formats": ["<f8", "<u4", "u1", "u1", ("u1", 8)],
+                     "offsets": [0, 8, 12, 13, 14],
+                     "itemsize": RECORD_FORMAT.size}
+
+
+def message_flags(msg):
+    flags = 0
+    if msg.is_extended_id:
+        flags |= FLAG_EXTENDED
+    if msg.is_remote_frame:
+        flags |= FLAG_REMOTE
+    if msg.is_error_frame:
+        flags |= FLAG_ERROR
+    if getattr(msg, "is_rx", True):
+        flags |= FLAG_RX
+    return flags
+
+
+class _Block:
+    """Index entry of BLOCK_RECORDS consecutive records."""
+
+    __slots__ = ("start", "count", "t_min", "t_max", "ids")
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.t_min = float("inf")
+        self.t_max = float("-inf")
+        self.ids = set()
+
+    def as_list(self):
+        return [self.start, self.count, self.t_min, self.t_max, sorted(self.ids)]
+
+
+class CaptureWriter(can.Listener):
+    """ Writes received frames into a binary capture, usable as listener of a can.Notifier.
+
+    :param filename: Path of the capture file
+    :param metadata: JSON serializable dictionary stored in the header, e.g. unit serial and channel
+    :param flush_records: Number of records buffered before they are written to the file
+    """
+
+    def __init__(self, filename, metadata=None, flush_records=1024):
+        self.filename = filename
+        meta = json.dumps(metadata or {}).encode("utf-8")
+        self._file = open(filename, "wb")
+        self._file.write(HEADER_FORMAT.pack(MAGIC, VERSION, RECORD_FORMAT.size, len(meta)) + meta)
+        self._buffer = bytearray(RECORD_FORMAT.size * flush_records)
+        self._flush_records = flush_records
+        self._buffered = 0
+        self._count = 0
+        self._blocks = [_Block(0)]
+        self._ids = {}
+
+    def on_message_received(self, msg):
+        self.write(msg.timestamp, msg.arbitration_id, msg.dlc, message_flags(msg), bytes(msg.data))
+
+    def write(self, timestamp, arbitration_id, dlc, flags, data):
+        """Append one record."""
+        RECORD_FORMAT.pack_into(self._buffer, self._buffered * RECORD_FORMAT.size,
+                                timestamp, arbitration_id, dlc, flags, data)
+        self._buffered += 1
+
+        block = self._blocks[-1]
+        if block.count == BLOCK_RECORDS:
+            block = _Block(self._count)
+            self._blocks.append(block)
+        block.count += 1
+        if timestamp < block.t_min:
+            block.t_min = timestamp
+        if timestamp > block.t_max:
+            block.t_max = timestamp
+        block.ids.add(arbitration_id)
+
+        entry = self._ids.get(arbitration_id)
+        if entry is None:
+            self._ids[arbitration_id] = [1, timestamp, timestamp]
+        else:
+            entry[0] += 1
+            entry[2] = timestamp
+        self._count += 1
+
+        if self._buffered == self._flush_records:
+            self.flush()
+
+    def write_batch(self, batch):
+        """Append a ring_buffer.FrameBatch with the flags recorded by the ring buffer."""
+        data = batch.data
+        for index, (timestamp, msg_id, dlc, flags) in enumerate(zip(batch.timestamps, batch.ids, batch.dlcs,
+                                                                     batch.flags)):
+            self.write(timestamp, msg_id, dlc, flags, data[index * 8:index * 8 + 8])
+
+    def flush(self):
+        if self._buffered:
+            self._file.write(memoryview(self._buffer)[:self._buffered * RECORD_FORMAT.size])
+            self._buffered = 0
+        self._file.flush()
+
+    def stop(self):
+        """Write the remaining records and the footer index, then close the file."""
+        if self._file.closed:
+            return
+        self.flush()
+        footer = json.dumps({"count": self._count,
+                             "block_records": BLOCK_RECORDS,
+                             "blocks": [block.as_list() for block in self._blocks if block.count],
+                             "ids": {str(msg_id): entry for msg_id, entry in self._ids.items()}
+                             }).encode("utf-8")
+        offset = self._file.tell()
+        self._file.write(footer)
+        self._file.write(TRAILER_FORMAT.pack(offset, len(footer), TRAILER_MAGIC))
+        self._file.close()
+        logger.debug("Capture %s closed with %d records", self.filename, self._count)
+
+
+class CaptureReader:
+    """ Memory mapped reader of a binary capture.
+
+    Usage:
+        with CaptureReader("run.btecap") as capture:
+            for timestamp, msg_id, dlc, flags, data in capture.records(arbitration_id=0xC1, start=10.0, end=20.0):
+                ...
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, meta_len = HEADER_FORMAT.unpack_from(self._mm, 0)
+        if magic != MAGIC or record_size != RECORD_FORMAT.size:
+            raise ValueError("{} is not a capture file".format(filename))
+        self.version = version
+        self._data_offset = HEADER_FORMAT.size + meta_len
+        self.metadata = json.loads(bytes(self._mm[HEADER_FORMAT.size:self._data_offset]).decode("utf-8"))
+
+        self.index = self._read_footer()
+        if self.index is None:
+            logger.warning("Capture %s has no index, it was not closed properly", filename)
+            self.index = self._build_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.index["count"]
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def ids(self):
+        """Dictionary of arbitration id to (count, first timestamp, last timestamp)."""
+        return {int(msg_id): tuple(entry) for msg_id, entry in self.index["ids"].items()}
+
+    def records(self, arbitration_id=None, start=None, end=None):
+        """ Iterate over the records of one id and/or time window.
+
+        :param arbitration_id: Only return records of this id
+        :param start: Only return records with timestamp >= start
+        :param end: Only return records with timestamp < end
+        :return: Iterator of (timestamp, arbitration id, dlc, flags, data) tuples
+        """
+        for block_start, count in self._select_blocks(arbitration_id, start, end):
+            offset = self._data_offset + block_start * RECORD_FORMAT.size
+            view = memoryview(self._mm)[offset:offset + count * RECORD_FORMAT.size]
+            try:
+                for record in RECORD_FORMAT.iter_unpack(view):
+                    if arbitration_id is not None and record[1] != arbitration_id:
+                        continue
+                    if (start is not None and record[0] < start) or (end is not None and record[0] >= end):
+                        continue
+                    yield record
+            finally:
+                view.release()
+
+    def messages(self, arbitration_id=None, start=None, end=None):
+        """Same as records(), but returns CAN.Message objects."""
+        for timestamp, msg_id, dlc, flags, data in self.records(arbitration_id, start, end):
+            yield can.Message(timestamp=timestamp, arbitration_id=msg_id, dlc=dlc, data=data[:dlc],
+                              extended_id=bool(flags & FLAG_EXTENDED), is_remote_frame=bool(flags & FLAG_REMOTE),
+                              is_error_frame=bool(flags & FLAG_ERROR))
+
+    def array(self):
+        """Zero-copy NumPy structured array of all records (requires numpy)."""
+        import numpy as np
+        return np.frombuffer(self._mm, dtype=np.dtype(RECORD_DTYPE_SPEC), count=len(self),
+                             offset=self._data_offset)
+
+    def _select_blocks(self, arbitration_id, start, end):
+        for block_start, count, t_min, t_max, ids in self.index["blocks"]:
+            if arbitration_id is not None and arbitration_id not in ids:
+                continue
+            if (start is not None and t_max < start) or (end is not None and t_min >= end):
+                continue
+            yield block_start, count
+
+    def _read_footer(self):
+        size = len(self._mm)
+        if size < self._data_offset + TRAILER_FORMAT.size:
+            return None
+        offset, length, magic = TRAILER_FORMAT.unpack_from(self._mm, size - TRAILER_FORMAT.size)
+        if magic != TRAILER_MAGIC or offset + length + TRAILER_FORMAT.size != size:
+            return None
+        index = json.loads(bytes(self._mm[offset:offset + length]).decode("utf-8"))
+        for block in index["blocks"]:
+            block[4] = set(block[4])
+        return index
+
+    def _build_index(self):
+        """Index of a capture without footer, every block is searched."""
+        count = (len(self._mm) - self._data_offset) // RECORD_FORMAT.size
+        blocks = [[block_start, min(BLOCK_RECORDS, count - block_start), float("-inf"), float("inf"), _All()]
+                  for block_start in range(0, count, BLOCK_RECORDS)]
+        return {"count": count, "block_records": BLOCK_RECORDS, "blocks": blocks, "ids": {}}
+
+
+class _All:
+    """Stand-in for the id set of a block without index."""
+
+    def __contains__(self, item):
+        return True
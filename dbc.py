@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Import and export of message descriptions as DBC files.
+
+A DBC file is translated into message descriptions of the same form as in messages.py and compiled into
+messages.MessageCodec objects. Supported are INTEL byte order signals, signed and unsigned integers, IEEE floats
+(SIG_VALTYPE_), factor and offset, and the cycle time (GenMsgCycleTime) as "freq". Properties DBC can not express
+are written as attributes:
+    TruncatedFloat (signal):   Float sent with its upper bits only (1) or its lower bits only (2, messages type
+                               float_low, e.g. set_ri of SET_REF_SWITCH_CTRL_RI)
+    StructFormat (message):    msg_fmt of the byte containers
+    StructFields (message):    msg_fields, container names separated by commas
+
+A DBC file is parsed and compiled once. The message database is cached as pickle keyed by the SHA-256 of the file,
+together with the compiled code of the codecs; later starts only load the cache. The compiled code depends on the
+code generator of messages.py and on the Python version, the cache file name therefore also contains a digest of the
+generator source and the interpreter tag.
+
+Usage:
+    database = load_dbc("bte.dbc")
+    database.register()                 # Replace the built-in descriptions of messages.py
+    write_dbc("bte.dbc")                # Export the built-in descriptions
+"""
+
+import argparse
+import functools
+import hashlib
+import inspect
+import marshal
+import os
+import pickle
+import re
+import sys
+import logging
+
+import messages as msg
+
+
+logger = logging.getLogger("calibration.dbc")
+
+
+CACHE_VERSION = 1
+DEFAULT_NODE = "Vector__XXX"
+EXTENDED_FLAG = 0x80000000
+
+_MESSAGE = re.compile(r"^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)\s+(\w+)", re.M)
+_SIGNAL = re.compile(r"^\s*SG_\s+(\w+)\s*(M|m\d+)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*"
+                     r"\(([^,]+),([^)]+)\)\s*\[([^|]*)\|([^\]]*)\]\s*\"([^\"]*)\"\s*(.*)$")
+_VALUE_TYPE = re.compile(r"^SIG_VALTYPE_\s+(\d+)\s+(\w+)\s*:?\s*([0-3])\s*;", re.M)
+_MESSAGE_ATTRIBUTE = re.compile(r"^BA_\s+\"(\w+)\"\s+BO_\s+(\d+)\s+(.+?)\s*;", re.M)
+_SIGNAL_ATTRIBUTE = re.compile(r"^BA_\s+\"(\w+)\"\s+SG_\s+(\d+)\s+(\w+)\s+(.+?)\s*;", re.M)
+_NODES = re.compile(r"^BU_\s*:(.*)$", re.M)
+
+
+class DbcError(ValueError):
+    """DBC content that can not be translated into a message description."""
+
+
+class MessageDatabase:
+    """ Compiled message descriptions of a DBC file.
+
+    :param descriptions: Message descriptions in the form of messages.py
+    :param nodes: Node names of the DBC file
+    """
+
+    def __init__(self, descriptions, nodes=(), filename=None):
+        self.descriptions = list(descriptions)
+        self.nodes = list(nodes)
+        self.filename = filename
+        self.codecs = [msg.MessageCodec(description) for description in self.descriptions]
+        self.by_id = {codec.msg_id: codec for codec in self.codecs}
+        self.by_name = {codec.msg_name: codec for codec in self.codecs}
+
+    def __len__(self):
+        return len(self.codecs)
+
+    def __repr__(self):
+        return "MessageDatabase({!r}, {} messages)".format(self.filename, len(self.codecs))
+
+    def register(self):
+        """Add all messages to the registry of messages.py, descriptions with the same name or id are replaced."""
+        for codec in self.codecs:
+            msg.CODECS_BY_ID[codec.msg_id] = codec
+            msg.CODECS_BY_NAME[codec.msg_name] = codec
+
+
+"""
+
+    I M P O R T
+
+"""
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _unquote(text):
+    text = text.strip()
+    return text[1:-1] if text.startswith('"') and text.endswith('"') else _number(text)
+
+
+def parse_dbc(text):
+    """ Translate the content of a DBC file into message descriptions.
+
+    :return: Tuple of the list of message descriptions and the list of node names
+    :raises DbcError: For MOTOROLA byte order, multiplexed signals and layouts messages.py can not encode
+    """
+    nodes = []
+    match = _NODES.search(text)
+    if match:
+        nodes = match.group(1).split()
+
+    descriptions = {}
+    messages = list(_MESSAGE.finditer(text))
+    for index, match in enumerate(messages):
+        frame_id, name, dlc, sender = int(match.group(1)), match.group(2), int(match.group(3)), match.group(4)
+        description = {"msg_id": frame_id & ~EXTENDED_FLAG,
+                       "msg_name": name,
+                       "dlc": dlc}
+        if frame_id & EXTENDED_FLAG:
+            description["extended"] = True
+        if sender != DEFAULT_NODE:
+            description["sender"] = sender
+
+        # Signal lines follow their message line
+        end = messages[index + 1].start() if index + 1 < len(messages) else len(text)
+        for line in text[match.end():end].splitlines()[1:]:
+            if not line.lstrip().startswith("SG_"):
+                break
+            signal = _SIGNAL.match(line)
+            if signal is None:
+                raise DbcError("Signal of {} can not be parsed: {!r}".format(name, line.strip()))
+            (signal_name, multiplex, start_bit, length, byte_order, sign, factor, offset, minimum, maximum, unit,
+             receivers) = signal.groups()
+            if multiplex:
+                raise DbcError("Multiplexed signal {}.{} is not supported".format(name, signal_name))
+            if byte_order != "1":
+                raise DbcError("Signal {}.{} uses MOTOROLA byte order, only INTEL is supported".format(
+                    name, signal_name))
+            length = int(length)
+            info = {"byte_size": length // 8 if length % 8 == 0 else 0,
+                    "start_bit": int(start_bit),
+                    "length": length,
+                    "type": "signed" if sign == "-" else "unsigned",
+                    "unit": unit,
+                    "factor": _number(factor)}
+            if _number(offset) != 0:
+                info["offset"] = _number(offset)
+            if _number(minimum) != 0 or _number(maximum) != 0:
+                info["min"], info["max"] = _number(minimum), _number(maximum)
+            if receivers.strip() and receivers.strip() != DEFAULT_NODE:
+                info["receivers"] = receivers.replace(",", " ").split()
+            description[signal_name] = info
+        descriptions[frame_id] = description
+
+    for match in _VALUE_TYPE.finditer(text):
+        signal = _signal(descriptions, int(match.group(1)), match.group(2))
+        if match.group(3) in ("1", "2"):
+            signal["type"] = "float"
+    for match in _SIGNAL_ATTRIBUTE.finditer(text):
+        attribute, frame_id, signal_name, value = match.groups()
+        if attribute == "TruncatedFloat" and _unquote(value) in (1, 2):
+            _signal(descriptions, int(frame_id), signal_name)["type"] = "float" if _unquote(value) == 1 else "float_low"
+    for match in _MESSAGE_ATTRIBUTE.finditer(text):
+        attribute, frame_id, value = match.group(1), int(match.group(2)), _unquote(match.group(3))
+        description = descriptions.get(frame_id)
+        if description is None:
+            continue
+        if attribute == "GenMsgCycleTime" and value:
+            description["freq"] = 1000.0 / value if 1000 % value else 1000 // value
+        elif attribute == "StructFormat":
+            description["msg_fmt"] = value
+        elif attribute == "StructFields":
+            description["msg_fields"] = tuple(value.split(","))
+
+    for description in descriptions.values():
+        if "msg_fmt" not in description:
+            layouts = msg.signal_layouts(description)
+            description["msg_fmt"], fields = msg.container_format(layouts, description["dlc"])
+            if fields != tuple(layout.name for layout in layouts):
+                description["msg_fields"] = fields
+    return list(descriptions.values()), nodes
+
+
+def _signal(descriptions, frame_id, signal_name):
+    try:
+        return descriptions[frame_id][signal_name]
+    except KeyError:
+        raise DbcError("Attribute of unknown signal {} of message {}".format(signal_name, frame_id)) from None
+
+
+"""Functions of messages.py whose output ends up in the cached code objects."""
+_GENERATOR = (msg.signal_layouts, msg._slots, msg._containers, msg._scaled, msg._raw_value, msg._physical,
+              msg._raw_bits, msg._value, msg._aligned_code, msg.codec_source, msg.compile_codec, msg.MessageCodec)
+
+
+@functools.lru_cache(maxsize=None)
+def generator_digest():
+    """Digest of the source of the codec generator, cached databases of another generator are not used."""
+    digest = hashlib.sha256()
+    for item in _GENERATOR:
+        try:
+            digest.update(inspect.getsource(item).encode("utf-8"))
+        except (OSError, TypeError):
+            # Without source, e.g. in a frozen application, fall back to the bytecode of the functions
+            if hasattr(item, "__code__"):
+                digest.update(marshal.dumps(item.__code__))
+    return digest.hexdigest()[:16]
+
+
+def _cache_filename(digest, cache_dir):
+    return os.path.join(cache_dir, "{}.v{}.{}.{}.pickle".format(digest, CACHE_VERSION, generator_digest(),
+                                                                sys.implementation.cache_tag))
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "bte-calibration", "dbc")
+
+
+def load_dbc(filename, cache_dir=None, use_cache=True):
+    """ Load a DBC file as compiled MessageDatabase.
+
+    :param cache_dir: Directory of the compiled databases, see default_cache_dir()
+    :param use_cache: Load the database from the cache if it exists, with False the file is always parsed; the cache
+                      is written in both cases
+    :return: MessageDatabase
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    cache_dir = cache_dir or default_cache_dir()
+    cached = _cache_filename(digest, cache_dir)
+
+    if use_cache and os.path.exists(cached):
+        try:
+            with open(cached, "rb") as f:
+                database = pickle.load(f)
+            database.filename = filename
+            logger.debug("Message database of %s loaded from cache %s", filename, cached)
+            return database
+        except Exception:
+            logger.warning("Cache %s of %s is not usable, the DBC file is parsed again", cached, filename,
+                           exc_info=True)
+
+    descriptions, nodes = parse_dbc(content.decode("latin-1"))
+    database = MessageDatabase(descriptions, nodes, filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary = "{}.{}.tmp".format(cached, os.getpid())
+        with open(temporary, "wb") as f:
+            pickle.dump(database, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, cached)
+    except OSError:
+        logger.warning("Message database of %s could not be cached", filename, exc_info=True)
+    return database
+
+
+"""
+
+    E X P O R T
+
+"""
+
+
+def _format_number(value):
+    return repr(value) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def format_dbc(descriptions=msg.MESSAGE_DESCRIPTIONS, nodes=None):
+    """ Message descriptions as content of a DBC file.
+
+    :param descriptions: Message descriptions in the form of messages.py, by default the built-in ones
+    :param nodes: Node names, by default the senders and receivers of the descriptions
+    """
+    descriptions = list(descriptions)
+    nodes = list(nodes) if nodes is not None else sorted(
+        {description["sender"] for description in descriptions if "sender" in description}
+        | {node for description in descriptions for key, info in description.items()
+           if isinstance(info, dict) for node in info.get("receivers", ())})
+
+    lines = ['VERSION ""', "", "", "NS_ :", "    SIG_VALTYPE_", "    BA_DEF_", "    BA_", "", "BS_:", "",
+             "BU_: " + " ".join(nodes), ""]
+    value_types, message_attributes, signal_attributes = [], [], []
+    for description in descriptions:
+        frame_id = description["msg_id"] | (EXTENDED_FLAG if description.get("extended") else 0)
+        lines.append("")
+        lines.append("BO_ {} {}: {} {}".format(frame_id, description["msg_name"], description["dlc"],
+                                               description.get("sender", DEFAULT_NODE)))
+        for layout in msg.signal_layouts(description):
+            info = description[layout.name]
+            lines.append(' SG_ {} : {}|{}@1{} ({},{}) [{}|{}] "{}" {}'.format(
+                layout.name, layout.start_bit, layout.length, "-" if layout.type == "signed" else "+",
+                _format_number(layout.factor), _format_number(layout.offset),
+                _format_number(info.get("min", 0)), _format_number(info.get("max", 0)), info.get("unit", "").strip(),
+                ",".join(info.get("receivers", ())) or DEFAULT_NODE))
+            if layout.type == "float" and layout.length in (32, 64):
+                value_types.append("SIG_VALTYPE_ {} {} : {};".format(frame_id, layout.name,
+                                                                      1 if layout.length == 32 else 2))
+            elif layout.type in ("float", "float_low"):
+                signal_attributes.append('BA_ "TruncatedFloat" SG_ {} {} {};'.format(
+                    frame_id, layout.name, 1 if layout.type == "float" else 2))
+        if description.get("freq"):
+            message_attributes.append('BA_ "GenMsgCycleTime" BO_ {} {};'.format(
+                frame_id, int(round(1000.0 / description["freq"]))))
+        message_attributes.append('BA_ "StructFormat" BO_ {} "{}";'.format(frame_id, description["msg_fmt"]))
+        if "msg_fields" in description:
+            message_attributes.append('BA_ "StructFields" BO_ {} "{}";'.format(
+                frame_id, ",".join(description["msg_fields"])))
+
+    lines += ["", "",
+              'BA_DEF_ BO_ "GenMsgCycleTime" INT 0 65535;',
+              'BA_DEF_ BO_ "StructFormat" STRING ;',
+              'BA_DEF_ BO_ "StructFields" STRING ;',
+              'BA_DEF_ SG_ "TruncatedFloat" INT 0 2;',
+              'BA_DEF_DEF_ "GenMsgCycleTime" 0;',
+              'BA_DEF_DEF_ "StructFormat" "";',
+              'BA_DEF_DEF_ "StructFields" "";',
+              'BA_DEF_DEF_ "TruncatedFloat" 0;']
+    lines += message_attributes + signal_attributes + value_types
+    return "\n".join(lines) + "\n"
+
+
+def write_dbc(filename, descriptions=msg.MESSAGE_DESCRIPTIONS, nodes=None):
+    """Export message descriptions to a DBC file, see format_dbc()."""
+    with open(filename, "w", encoding="latin-1", newline="\n") as f:
+        f.write(format_dbc(descriptions, nodes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import and export DBC files of the BTE messages")
+    commands = parser.add_subparsers(dest="command")
+    export = commands.add_parser("export", help="Write the built-in message descriptions to a DBC file")
+    export.add_argument("filename")
+    show = commands.add_parser("show", help="Load a DBC file and list its messages")
+    show.add_argument("filename")
+    show.add_argument("--no-cache", action="store_true", default=False, help="Parse the file even if it is cached")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        write_dbc(args.filename)
+        print("{} messages written to {}".format(len(msg.MESSAGE_DESCRIPTIONS), args.filename))
+    elif args.command == "show":
+        database = load_dbc(args.filename, use_cache=not args.no_cache)
+        for codec in database.codecs:
+            print("0x{:03X} {:<28} dlc {} {}".format(codec.msg_id, codec.msg_name, codec.dlc, ", ".join(codec.signals)))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
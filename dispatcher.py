@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Receive path dispatching by arbitration id.
+
+The dispatcher knows which ids the session subscribed to. From these ids it computes CAN acceptance filters (id and
+mask) and pushes them to the bus, so the controller drops traffic of unrelated nodes before it reaches Python.
+Backends without hardware filters fall back to python-can's software filtering. Frames that pass the filter are
+handed to their handlers by a table lookup with the arbitration id.
+
+Usage:
+    dispatcher = Dispatcher()
+    dispatcher.subscribe(0x288, on_status)
+    dispatcher.apply_filters(bus, max_filters=4)
+    notifier = can.Notifier(bus, [dispatcher])
+"""
+
+import time
+import logging
+
+import can
+
+from metrics import METRICS
+
+
+logger = logging.getLogger("calibration.dispatcher")
+
+
+STANDARD_MASK = 0x7FF
+EXTENDED_MASK = 0x1FFFFFFF
+WALL_CLOCK_TOLERANCE = 60.0     # Timestamps further away from time.time() are device relative, e.g. Kvaser
+
+
+def _accepted_ids(mask, width):
+    """Number of ids accepted by a filter with this mask."""
+    return 1 << (width - bin(mask).count("1"))
+
+
+def compute_filters(ids, max_filters=None, extended=False):
+    """ Acceptance filters for a set of arbitration ids.
+
+    Every id gets its own exact filter. If the controller only supports max_filters filters, the two filters whose
+    combination accepts the fewest ids are merged until the limit is reached.
+
+    :param ids: Arbitration ids to accept
+    :param max_filters: Number of filters supported by the controller, None for unlimited
+    :param extended: Whether the ids are extended (29 bit) ids
+    :return: List of filter dictionaries as used by can.BusABC.set_filters()
+    """
+    full_mask = EXTENDED_MASK if extended else STANDARD_MASK
+    width = 29 if extended else 11
+    filters = [(msg_id & full_mask, full_mask) for msg_id in sorted(set(ids))]
+
+    while max_filters is not None and len(filters) > max(max_filters, 1):
+        best = None
+        for i in range(len(filters)):
+            for j in range(i + 1, len(filters)):
+                (id_a, mask_a), (id_b, mask_b) = filters[i], filters[j]
+                mask = mask_a & mask_b & ~(id_a ^ id_b) & full_mask
+                cost = _accepted_ids(mask, width)
+                if best is None or cost < best[0]:
+                    best = (cost, i, j, (id_a & mask, mask))
+        _, i, j, merged = best
+        filters[i] = merged
+        del filters[j]
+
+    return [{"can_id": can_id, "can_mask": mask, "extended": extended} for can_id, mask in filters]
+
+
+class Dispatcher(can.Listener):
+    """Calls the handlers subscribed to the arbitration id of a received frame."""
+
+    def __init__(self):
+        self._standard = [None] * (STANDARD_MASK + 1)
+        self._extended = {}
+        self.unhandled = 0          # Frames without handler, error frames and standard frames with ids above 0x7FF
+        self.handler_errors = 0     # Exceptions raised by handlers, logged and not passed to the notifier
+        self._wall_clock = None     # Whether the frame timestamps are wall-clock time, decided on the first frame
+
+    def subscribe(self, msg_id, handler, extended=False):
+        """Call handler(msg) for every received frame with this arbitration id."""
+        self._set_handlers(msg_id, self.handlers(msg_id, extended) + (handler,), extended)
+
+    def unsubscribe(self, msg_id, handler, extended=False):
+        handlers = tuple(h for h in self.handlers(msg_id, extended) if h != handler)
+        self._set_handlers(msg_id, handlers, extended)
+
+    def handlers(self, msg_id, extended=False):
+        handlers = self._extended.get(msg_id) if extended else self._standard[msg_id]
+        return handlers or ()
+
+    def _set_handlers(self, msg_id, handlers, extended):
+        if extended:
+            if handlers:
+                self._extended[msg_id] = handlers
+            else:
+                self._extended.pop(msg_id, None)
+        else:
+            self._standard[msg_id] = handlers or None
+
+    def subscribed_ids(self, extended=False):
+        if extended:
+            return sorted(self._extended)
+        return [msg_id for msg_id, handlers in enumerate(self._standard) if handlers]
+
+    def filters(self, max_filters=None, extra_ids=()):
+        """ Acceptance filters for all subscribed ids.
+
+        :param extra_ids: Standard ids without handler that have to pass as well, e.g. for other listeners
+        """
+        return (compute_filters(sorted(set(self.subscribed_ids()).union(extra_ids)), max_filters) +
+                (compute_filters(self.subscribed_ids(True), max_filters, extended=True) if self._extended else []))
+
+    def apply_filters(self, bus, max_filters=None, extra_ids=()):
+        """Push the acceptance filters of all subscribed ids to the bus."""
+        filters = self.filters(max_filters, extra_ids)
+        bus.set_filters(filters)
+        logger.debug("Acceptance filters set: %s", filters)
+        return filters
+
+    def on_message_received(self, message):
+        if METRICS.enabled:
+            self._on_message_instrumented(message)
+            return
+        if message.is_error_frame:
+            handlers = None
+        elif message.is_extended_id:
+            handlers = self._extended.get(message.arbitration_id)
+        elif message.arbitration_id > STANDARD_MASK:
+            handlers = None
+        else:
+            handlers = self._standard[message.arbitration_id]
+        if handlers is None:
+            self.unhandled += 1
+            return
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception:
+                self._handler_failed(handler, message)
+
+    def _handler_failed(self, handler, message):
+        # An exception in the thread of the can.Notifier would stop reception for every subscriber
+        self.handler_errors += 1
+        if METRICS.enabled:
+            METRICS.count("handler_errors", message.arbitration_id)
+        logger.error("Handler %r failed on %s", handler, message, exc_info=True)
+
+    def _on_message_instrumented(self, message):
+        """Same as on_message_received(), recording receive counters and receive and handler latencies."""
+        msg_id = message.arbitration_id
+        if message.is_error_frame:
+            METRICS.count("error_frames")
+        METRICS.count("rx_frames", msg_id)
+        if message.timestamp:
+            delay = time.time() - message.timestamp
+            if self._wall_clock is None:
+                self._wall_clock = abs(delay) < WALL_CLOCK_TOLERANCE
+                if not self._wall_clock:
+                    logger.info("Frame timestamps are not wall-clock time, receive latency is not recorded")
+            if self._wall_clock:
+                METRICS.observe("receive", msg_id, delay * 1e9)
+        if message.is_error_frame:
+            handlers = None
+        elif message.is_extended_id:
+            handlers = self._extended.get(msg_id)
+        else:
+            handlers = self._standard[msg_id] if msg_id <= STANDARD_MASK else None
+        if handlers is None:
+            self.unhandled += 1
+            METRICS.count("unhandled_frames", msg_id)
+            return
+        start = time.perf_counter_ns()
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception:
+                self._handler_failed(handler, message)
+        METRICS.observe("handler", msg_id, time.perf_counter_ns() - start)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Online calibration fit of measured values against reference setpoints.
+
+Every (reference, measured) pair updates running means and co-moments (Welford's algorithm for two variables) in
+O(1), no samples are stored. Gain, offset, residual statistics and the correction coefficients are therefore
+available at any time during a sweep, in particular the moment the sweep ends.
+
+Model: measured = gain * reference + offset
+Correction: reference = correction_gain * measured + correction_offset
+"""
+
+import math
+
+
+class StreamingLinearFit:
+    """Incremental least squares fit of a straight line."""
+
+    __slots__ = ("n", "mean_x", "mean_y", "c_xx", "c_xy", "c_yy")
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.c_xx = 0.0
+        self.c_xy = 0.0
+        self.c_yy = 0.0
+
+    def update(self, x, y):
+        """Add one pair of reference value x and measured value y."""
+        self.n += 1
+        dx = x - self.mean_x
+        dy = y - self.mean_y
+        self.mean_x += dx / self.n
+        self.mean_y += dy / self.n
+        self.c_xx += dx * (x - self.mean_x)
+        self.c_xy += dx * (y - self.mean_y)
+        self.c_yy += dy * (y - self.mean_y)
+
+    @property
+    def gain(self):
+        return self.c_xy / self.c_xx if self.c_xx > 0 else float("nan")
+
+    @property
+    def offset(self):
+        return self.mean_y - self.gain * self.mean_x
+
+    @property
+    def residual_variance(self):
+        """Unbiased variance of the residuals around the fitted line."""
+        if self.n < 3 or self.c_xx <= 0:
+            return float("nan")
+        return max(self.c_yy - self.c_xy * self.c_xy / self.c_xx, 0.0) / (self.n - 2)
+
+    @property
+    def residual_std(self):
+        return math.sqrt(self.residual_variance)
+
+    @property
+    def r_squared(self):
+        if self.c_xx <= 0 or self.c_yy <= 0:
+            return float("nan")
+        return self.c_xy * self.c_xy / (self.c_xx * self.c_yy)
+
+    def merge(self, other):
+        """Add all pairs of another fit, e.g. of a different capture of the same unit (Chan's parallel update)."""
+        if not other.n:
+            return
+        n = self.n + other.n
+        dx = other.mean_x - self.mean_x
+        dy = other.mean_y - self.mean_y
+        weight = self.n * other.n / n
+        self.mean_x += dx * other.n / n
+        self.mean_y += dy * other.n / n
+        self.c_xx += other.c_xx + dx * dx * weight
+        self.c_xy += other.c_xy + dx * dy * weight
+        self.c_yy += other.c_yy + dy * dy * weight
+        self.n = n
+
+    def state(self):
+        """Running sums as dictionary, e.g. to store them in a session journal."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_state(cls, state):
+        fit = cls()
+        for name in cls.__slots__:
+            setattr(fit, name, state[name])
+        return fit
+
+    def coefficients(self):
+        """Fit result and correction coefficients as dictionary."""
+        gain = self.gain
+        return {"samples": self.n,
+                "gain": gain,
+                "offset": self.offset,
+                "correction_gain": 1.0 / gain if gain else float("nan"),
+                "correction_offset": -self.offset / gain if gain else float("nan"),
+                "residual_std": self.residual_std,
+                "r_squared": self.r_squared}
+
+
+class CalibrationFit:
+    """ Fits of several measured signals of one unit, e.g. voltage and current.
+
+    Usage:
+        fit = CalibrationFit()
+        fit.update("voltage", setpoint, fields["meas_voltage"])
+        fit.coefficients()["voltage"]["correction_gain"]
+    """
+
+    def __init__(self, signals=("voltage", "current")):
+        self.fits = {signal: StreamingLinearFit() for signal in signals}
+
+    def update(self, signal, reference, measured):
+        fit = self.fits.get(signal)
+        if fit is None:
+            fit = self.fits[signal] = StreamingLinearFit()
+        fit.update(reference, measured)
+
+    def coefficients(self):
+        return {signal: fit.coefficients() for signal, fit in self.fits.items() if fit.n}
+
+    def merge(self, other):
+        for signal, fit in other.fits.items():
+            if signal not in self.fits:
+                self.fits[signal] = StreamingLinearFit()
+            self.fits[signal].merge(fit)
+
+    def state(self):
+        return {signal: fit.state() for signal, fit in self.fits.items()}
+
+    @classmethod
+    def from_state(cls, state):
+        calibration_fit = cls(signals=())
+        calibration_fit.fits = {signal: StreamingLinearFit.from_state(fit) for signal, fit in state.items()}
+        return calibration_fit
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Append-only session journal to resume an interrupted calibration.
+
+Every record is one JSON line with a sequence number, a timestamp and a type:
+    session:  Parameters of the sweep, a journal is only resumed with the same parameters
+    config:   Configuration frames applied to the device (arbitration id and data as hex)
+    point:    Completed calibration point together with the fit state after this point
+    done:     Result of the finished session
+
+Records are written through a buffered file and synced to disk in batches (every fsync_every records or after
+fsync_interval seconds), so the journal costs almost nothing per point and at most one batch is lost in a crash.
+A partially written last line is ignored on replay and cut off when the journal is resumed, so the next record
+starts on a line of its own.
+
+A journal that can not be resumed, e.g. of a finished session, is moved aside with archive() before a new session
+starts, so the records of every session are kept.
+
+Usage:
+    state = replay("BTE-0001.journal")
+    if state is not None and state.done:
+        archive("BTE-0001.journal")
+    journal = SessionJournal("BTE-0001.journal", resume=state is not None and not state.done)
+    journal.append("point", index=3, point={...}, fit=fit.state())
+    journal.close()
+"""
+
+import json
+import os
+import time
+import logging
+
+
+logger = logging.getLogger("calibration.journal")
+
+
+class SessionJournal:
+    """ Writer of an append-only JSON lines journal.
+
+    :param filename: Path of the journal file
+    :param resume: Append to an existing journal instead of starting a new one
+    :param fsync_every: Number of records written before the file is synced to disk
+    :param fsync_interval: Maximum time in seconds a written record stays unsynced, checked on every append
+    """
+
+    def __init__(self, filename, resume=False, fsync_every=8, fsync_interval=1.0):
+        self.filename = filename
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.sequence = 0
+        if resume and os.path.exists(filename):
+            records, end = _read_journal(filename)
+            if records:
+                self.sequence = records[-1]["seq"]
+            if end < os.path.getsize(filename):
+                # Appending after a torn line would join the next record with it
+                logger.warning("Incomplete last record of journal %s is cut off before resuming", filename)
+                with open(filename, "r+b") as f:
+                    f.truncate(end)
+        self._file = open(filename, "a" if resume else "w", encoding="utf-8")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, record_type, **fields):
+        """Append one record, fields must be JSON serializable."""
+        self.sequence += 1
+        record = dict(fields, seq=self.sequence, time=time.time(), type=record_type)
+        self._file.write(json.dumps(record) + "\n")
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Write all records to disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+
+class SessionState:
+    """State of a session rebuilt from its journal."""
+
+    def __init__(self):
+        self.session = None         # Fields of the session record
+        self.config_frames = []     # Configuration frames as journaled, see encode_frames()
+        self.points = []            # Fields of the point records in order
+        self.fit = None             # Fit state after the last completed point
+        self.result = None          # Result of the done record
+        self.records = 0
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    @property
+    def completed_points(self):
+        return len(self.points)
+
+    @property
+    def config(self):
+        """Configuration frames as CAN.Message objects."""
+        return decode_frames(self.config_frames)
+
+
+def encode_frames(frames):
+    """Configuration frames as JSON serializable list."""
+    return [{"id": frame.arbitration_id, "extended": frame.is_extended_id, "data": bytes(frame.data).hex()}
+            for frame in frames]
+
+
+def decode_frames(frames):
+    import can      # Reading a journal does not need the CAN backend, only the replayed frames do
+
+    return [can.Message(arbitration_id=frame["id"], data=bytes.fromhex(frame["data"]), extended_id=frame["extended"])
+            for frame in frames]
+
+
+def _read_journal(filename):
+    """ Records of a journal and the file offset after the last complete record.
+
+    A last line without line end or with invalid JSON is the torn record of a crash and ignored, an invalid record
+    before the last line is an error.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    records = []
+    offset = 0
+    while offset < len(data):
+        newline = data.find(b"\n", offset)
+        end = len(data) if newline < 0 else newline + 1
+        try:
+            record = json.loads(data[offset:end].decode("utf-8")) if newline >= 0 else None
+        except ValueError:
+            record = None
+        if record is None:
+            if end == len(data):
+                logger.warning("Journal %s ends with an incomplete record, it is ignored", filename)
+                break
+            raise ValueError("Journal {} has an invalid record at offset {}".format(filename, offset))
+        records.append(record)
+        offset = end
+    return records, offset
+
+
+def replay(filename):
+    """ Rebuild the session state from a journal.
+
+    :return: SessionState, None if the journal does not exist
+    """
+    if not os.path.exists(filename):
+        return None
+    state = SessionState()
+    for record in _read_journal(filename)[0]:
+        state.records += 1
+        record_type = record["type"]
+        if record_type == "session":
+            state.session = record
+        elif record_type == "config":
+            state.config_frames = record["frames"]
+        elif record_type == "point":
+            if record["index"] != len(state.points):
+                raise ValueError("Journal {} skips from point {} to {}".format(filename, len(state.points),
+                                                                                record["index"]))
+            state.points.append(record["point"])
+            state.fit = record.get("fit")
+        elif record_type == "done":
+            state.result = record.get("result")
+        else:
+            logger.warning("Unknown journal record type %r", record_type)
+    return state
+
+
+def archive(filename):
+    """ Move a journal aside, named after the time it was last written, so a new session does not overwrite it.
+
+    :return: New file name of the journal
+    """
+    base, ext = os.path.splitext(filename)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(filename)))
+    target = "{}.{}{}".format(base, stamp, ext)
+    count = 1
+    while os.path.exists(target):
+        count += 1
+        target = "{}.{}-{}{}".format(base, stamp, count, ext)
+    os.replace(filename, target)
+    logger.info("Journal %s moved to %s", filename, target)
+    return target
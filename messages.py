@@ -22,14 +22,20 @@ https://pymotw.com/2/struct/
 """
 
 import sys
+import re
 import struct
+import keyword
+import marshal
+import collections
 import binascii
 from can import Message, CanError
+import time
 import logging
 
+from metrics import METRICS
+
 
 logger = logging.getLogger("calibration.protocol.messages")
-logger.setLevel(logging.DEBUG)
 
 
 """
@@ -44,9 +50,11 @@ SET_SLOPE_U_I = {"msg_id": 0x144,
                  "dlc": 8,
                  "freq": 10,
                  "slope_voltage": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"V",
                                    "factor":1},
                  "slope_current": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
                                    "unit":"A",
                                    "factor":1}
                 }
@@ -58,23 +66,28 @@ SET_SLOPE_PWR_FILTER = {"msg_id": 0x154,
                  "dlc": 6,
                  "freq": 10,
                  "slope_power": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"W",
                                    "factor":1},
                  "filter": {"byte_size":2,
+                                   "start_bit":32, "length":16, "type":"signed",
                                    "unit":" ",
                                    "factor":1}
                 }
 
 
+# The operating limits of voltage and current carry the maximum first (see load_set_op_lim_u/_i)
 SET_OP_LIM_U = {"msg_id": 0x150,
                 "msg_name": "SET_OP_LIM_U",
                  "msg_fmt": "<ff",
                  "dlc": 8,
                  "freq": 100,
-                 "op_lim_u_mn": {"byte_size":4,
+                 "op_lim_u_mx": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"V",
                                    "factor":1},
-                 "op_lim_u_mx": {"byte_size":4,
+                 "op_lim_u_mn": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
                                    "unit":"V",
                                    "factor":1}
                 }
@@ -85,10 +98,12 @@ SET_OP_LIM_I = {"msg_id": 0x160,
                 "msg_name": "SET_OP_LIM_I",
                  "dlc": 8,
                  "freq": 100,
-                 "op_lim_i_mn": {"byte_size":4,
+                 "op_lim_i_mx": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"A",
                                    "factor":1},
-                 "op_lim_i_mx": {"byte_size":4,
+                 "op_lim_i_mn": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
                                    "unit":"A",
                                    "factor":1}
                 }
@@ -100,9 +115,11 @@ SET_OP_LIM_PWR = {"msg_id": 0x170,
                  "dlc": 8,
                  "freq": 100,
                  "op_lim_p_mn": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"W",
                                    "factor":1},
                  "op_lim_p_mx": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
                                    "unit":"W",
                                    "factor":1}
                 }
@@ -114,9 +131,11 @@ SET_PR_LIM_U = {"msg_id": 0x114,
                  "dlc": 8,
                  "freq": 10,
                  "op_lim_u_mn": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"V",
                                    "factor":1},
                  "op_lim_u_mx": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
                                    "unit":"V",
                                    "factor":1}
                 }
@@ -128,9 +147,11 @@ SET_PR_LIM_I = {"msg_id": 0x124,
                  "dlc": 8,
                  "freq": 10,
                  "op_lim_i_mn": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"A",
                                    "factor":1},
                  "op_lim_i_mx": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
                                    "unit":"A",
                                    "factor":1}
                 }
@@ -142,9 +163,11 @@ SET_PR_LIM_PWR = {"msg_id": 0x134,
                  "dlc": 8,
                  "freq": 10,
                  "op_lim_p_mn": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":"W",
                                    "factor":1},
                  "op_lim_p_mx": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
                                    "unit":"W",
                                    "factor":1}
                 }
@@ -156,6 +179,7 @@ CLEARANCE = {"msg_id": 0x720,
                  "dlc": 1,
                  "freq": 10,
                  "clearance": {"byte_size":1,
+                                   "start_bit":0, "length":8, "type":"signed",
                                    "unit":" ",
                                    "factor":1}
                 }
@@ -166,33 +190,117 @@ SET_RST_STOP = {"msg_id": 0x21F,
                 "msg_name": "SET_RST_STOP",
                  "dlc": 1,
                  "freq": 1,
-                 "clearance": {"byte_size":1,
+                 "rst_stop": {"byte_size":1,
+                                   "start_bit":0, "length":8, "type":"signed",
                                    "unit":" ",
                                    "factor":1}
                 }
 
 
 SET_REF_SWITCH_CTRL_RI = {"msg_id": 0xC1,
-                 "msg_fmt": "<fbbh",
+                 "msg_fmt": "<fB3s",
                   "msg_name": "SET_REF_SWITCH_CTRL_RI",
+                 "msg_fields": ("set_ref", "reg_ctrl", "set_ri"),   # Byte containers, switch to rst_e share reg_ctrl
                  "dlc": 8,
                  "freq": 1000,
                  "set_ref": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
                                    "unit":" ",
                                    "factor":1},
                  "set_switch": {"byte_size":0,
+                                   "start_bit":32, "length":3, "type":"unsigned",
                                    "unit":" ",
                                    "factor":1},
                  "set_ctrl": {"byte_size":0,
+                                   "start_bit":35, "length":3, "type":"unsigned",
                                    "unit":" ",
                                    "factor":1},
                  "rst_q": {"byte_size":0,
+                                   "start_bit":38, "length":1, "type":"unsigned",
                                    "unit":" ",
                                    "factor":1},
                  "rst_e": {"byte_size":0,
+                                   "start_bit":39, "length":1, "type":"unsigned",
+                                   "unit":" ",
+                                   "factor":1},
+                 "set_ri": {"byte_size":3,      # Low 3 bytes of the float as sent since the first version, unverified
+                                   "start_bit":40, "length":24, "type":"float_low",
+                                   "unit":" ",
+                                   "factor":1}
+                }
+
+
+"""
+
+    S T A T U S   M E S S A G E S   S E N T   B Y   T H E   B T E
+
+"""
+
+"""The status layouts are not yet checked against the manual and 0x298 is an assumed id for the measurement frame.
+The simulator implements the same assumption. Until STATUS_LAYOUTS_VERIFIED is set, setup and sweep only rely on them
+with simulated devices, on hardware the setup is confirmed by echo on the loopback channel (see tas.response_matcher).
+"""
+STATUS_LAYOUTS_VERIFIED = False
+
+STATUS_SYSTEM = {"msg_id": 0x288,
+                 "msg_fmt": "<BBBB",
+                 "msg_name": "STATUS_SYSTEM",
+                 "dlc": 4,
+                 "freq": 10,
+                 "op_state": {"byte_size":1,
+                                   "start_bit":0, "length":8, "type":"unsigned",
+                                   "unit":" ",
+                                   "factor":1},
+                 "ctrl_mode": {"byte_size":1,
+                                   "start_bit":8, "length":8, "type":"unsigned",
+                                   "unit":" ",
+                                   "factor":1},
+                 "clearance": {"byte_size":1,
+                                   "start_bit":16, "length":8, "type":"unsigned",
                                    "unit":" ",
                                    "factor":1},
-                 "set_ri": {"byte_size":3,
+                 "rst_stop": {"byte_size":1,
+                                   "start_bit":24, "length":8, "type":"unsigned",
+                                   "unit":" ",
+                                   "factor":1}
+                }
+
+
+STATUS_MEAS_U_I = {"msg_id": 0x298,
+                 "msg_fmt": "<ff",
+                 "msg_name": "STATUS_MEAS_U_I",
+                 "dlc": 8,
+                 "freq": 100,
+                 "meas_voltage": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"float",
+                                   "unit":"V",
+                                   "factor":1},
+                 "meas_current": {"byte_size":4,
+                                   "start_bit":32, "length":32, "type":"float",
+                                   "unit":"A",
+                                   "factor":1}
+                }
+
+
+STATUS_ERR_STANDBY = {"msg_id": 0x518,
+                 "msg_fmt": "<I",
+                 "msg_name": "STATUS_ERR_STANDBY",
+                 "dlc": 4,
+                 "freq": 10,
+                 "standby_errors": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"unsigned",
+                                   "unit":" ",
+                                   "factor":1}
+                }
+
+
+STATUS_ERR_CRITICAL = {"msg_id": 0x528,
+                 "msg_fmt": "<I",
+                 "msg_name": "STATUS_ERR_CRITICAL",
+                 "dlc": 4,
+                 "freq": 10,
+                 "critical_errors": {"byte_size":4,
+                                   "start_bit":0, "length":32, "type":"unsigned",
                                    "unit":" ",
                                    "factor":1}
                 }
@@ -207,39 +315,63 @@ SET_REF_SWITCH_CTRL_RI = {"msg_id": 0xC1,
 def load_message(msg_info, extended_flag=False, **kwargs):
     """ Universal function to load data based on message dictionary.
 
-    :param msg_info: Dictionary containing details about the CAN message.
+    :param msg_info: Dictionary, name or id of the CAN message.
     :param extended_flag: Whether the message has an extended CAN id or not
-    :param kwargs: List of data that are loaded to the CAN message. The order of data must relate tot he message format
+    :param kwargs: Signal values loaded to the CAN message, addressed by the signal names of the message description
     :return: CAN.Message object
     """
     message = None
+    timed = METRICS.enabled
+    if timed:
+        start = time.perf_counter_ns()
     try:
-        msg_id = msg_info["msg_id"]
-        msg_name = msg_info["msg_name"]
-        data_format = msg_info["msg_fmt"]
-
-        payload = struct.pack(data_format, *kwargs.values())
-        logger.debug("Payload: %s loaded to Message: %s", binascii.hexlify(payload), msg_name)
-
-        message = Message(arbitration_id=msg_id, data=payload, extended_id=extended_flag)
+        codec = get_codec(msg_info)
+        payload = codec.encode(**kwargs)
+        if timed:
+            METRICS.observe("encode", codec.msg_id, time.perf_counter_ns() - start)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Payload: %s loaded to Message: %s", binascii.hexlify(payload), codec.msg_name)
+
+        message = Message(arbitration_id=codec.msg_id, data=payload, extended_id=extended_flag)
     except struct.error:
         logger.error("Error occurred while packing data", exc_info=True)
         return None
     except KeyError:
         logger.error("Message information not complete, dictionary keyword missing", exc_info=True)
         return None
+    except TypeError:
+        logger.error("Signals do not match the message description", exc_info=True)
+        return None
     except CanError:
         logger.error("CAN message object could not be created", exc_info=True)
     return message
 
 
+def decode_message(msg):
+    """ Universal function to unload data from a received CAN message.
+
+    :param msg: CAN.Message object
+    :return: Tuple of message name and dictionary of signal values, None for unknown message ids
+    """
+    codec = CODECS_BY_ID.get(msg.arbitration_id)
+    if codec is None:
+        return None
+    if not METRICS.enabled:
+        return codec.msg_name, codec.decode(msg.data)
+    start = time.perf_counter_ns()
+    signals = codec.decode(msg.data)
+    METRICS.observe("decode", codec.msg_id, time.perf_counter_ns() - start)
+    return codec.msg_name, signals
+
+
 def load_clearance(clearance):
     """Create CAN message object with data loaded."""
     payload = None
     msgfmt = CLEARANCE["msg_fmt"]
     msgid = CLEARANCE["msg_id"]
     payload = struct.pack(msgfmt, clearance)
-    logger.debug("Data loaded to message")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Data loaded to message")
     return Message(arbitration_id=msgid,data=payload,extended_id=False)
 
 
@@ -249,7 +381,8 @@ def load_set_rst_stop(rst_stop):
     msgfmt = SET_RST_STOP["msg_fmt"]
     msgid = SET_RST_STOP["msg_id"]
     payload = struct.pack(msgfmt, rst_stop)
-    logger.debug("Data loaded to message")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Data loaded to message")
     return Message(arbitration_id=msgid,data=payload,extended_id=False)
 
 
@@ -260,7 +393,8 @@ def load_set_slope_u_i(slope_voltage,slope_current):
   msgid = SET_SLOPE_U_I["msg_id"]
   payload = struct.pack(msgfmt, slope_voltage, slope_current)
   #logger.debug("Message payload: ", binascii.hexlify(payload))
-  logger.debug("Data loaded to message")
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug("Data loaded to message")
   return Message(arbitration_id=msgid,data=payload,extended_id=False)
 
 
@@ -270,7 +404,8 @@ def load_set_slope_pwr_filter(slope_power, filter=0):
     msgfmt = SET_SLOPE_PWR_FILTER["msg_fmt"]
     msgid = SET_SLOPE_PWR_FILTER["msg_id"]
     payload = struct.pack(msgfmt, slope_power, filter)
-    logger.debug("Payload: %s loaded to Message: %s", binascii.hexlify(payload), load_set_slope_pwr_filter.__name__)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Payload: %s loaded to Message: %s", binascii.hexlify(payload), load_set_slope_pwr_filter.__name__)
     return Message(arbitration_id=msgid, data=payload, extended_id=False)
 
 
@@ -280,7 +415,8 @@ def load_set_op_lim_u(op_lim_u_mn, op_lim_u_mx):
     msgfmt = SET_OP_LIM_U["msg_fmt"]
     msgid = SET_OP_LIM_U["msg_id"]
     payload = struct.pack(msgfmt, op_lim_u_mx, op_lim_u_mn)
-    logger.debug("Message payload: ", binascii.hexlify(payload))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message payload: %s", binascii.hexlify(payload))
     return Message(arbitration_id=msgid, data=payload, extended_id=False)
 
 
@@ -290,7 +426,8 @@ def load_set_op_lim_i(op_lim_i_mn, op_lim_i_mx):
     msgfmt = SET_OP_LIM_I["msg_fmt"]
     msgid = SET_OP_LIM_I["msg_id"]
     payload = struct.pack(msgfmt, op_lim_i_mx, op_lim_i_mn)
-    logger.debug("Message payload: ", binascii.hexlify(payload))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message payload: %s", binascii.hexlify(payload))
     return Message(arbitration_id=msgid, data=payload, extended_id=False)
 
 
@@ -300,7 +437,8 @@ def load_set_op_lim_pwr(op_lim_pwr_mn, op_lim_pwr_mx):
     msgfmt = SET_OP_LIM_PWR["msg_fmt"]
     msgid = SET_OP_LIM_PWR["msg_id"]
     payload = struct.pack(msgfmt, op_lim_pwr_mn, op_lim_pwr_mx)
-    logger.debug("Message payload: ", binascii.hexlify(payload))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message payload: %s", binascii.hexlify(payload))
     return Message(arbitration_id=msgid, data=payload, extended_id=False)
 
 
@@ -310,7 +448,8 @@ def load_set_pr_lim_u(pr_lim_u_mn, pr_lim_u_mx):
     msgfmt = SET_PR_LIM_U["msg_fmt"]
     msgid = SET_PR_LIM_U["msg_id"]
     payload = struct.pack(msgfmt, pr_lim_u_mn, pr_lim_u_mx)
-    logger.debug("Message payload: %s", payload)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message payload: %s", binascii.hexlify(payload))
     return Message(arbitration_id=msgid, data=payload, extended_id=False)
 
 
@@ -320,7 +459,8 @@ def load_set_pr_lim_i(pr_lim_i_mn, pr_lim_i_mx):
     msgfmt = SET_PR_LIM_I["msg_fmt"]
     msgid = SET_PR_LIM_I["msg_id"]
     payload = struct.pack(msgfmt, pr_lim_i_mn, pr_lim_i_mx)
-    logger.debug("Message payload: ", binascii.hexlify(payload))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message payload: %s", binascii.hexlify(payload))
     return Message(arbitration_id=msgid, data=payload, extended_id=False)
 
 
@@ -330,7 +470,8 @@ def load_set_pr_lim_pwr(pr_lim_pwr_mn, pr_lim_pwr_mx):
     msgfmt = SET_PR_LIM_PWR["msg_fmt"]
     msgid = SET_PR_LIM_PWR["msg_id"]
     payload = struct.pack(msgfmt, pr_lim_pwr_mn, pr_lim_pwr_mx)
-    logger.debug("Message payload: ", binascii.hexlify(payload))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message payload: %s", binascii.hexlify(payload))
     return Message(arbitration_id=msgid, data=payload, extended_id=False)
 
 
@@ -342,24 +483,263 @@ def load_set_pr_lim_pwr(pr_lim_pwr_mn, pr_lim_pwr_mx):
 
 def unload_set_slope_u_i(msg):
   """Return CAN message data from message object."""
-  msgfmt = SET_SLOPE_U_I["msg_fmt"]
-  voltage, current = struct.unpack(msgfmt, msg.data)
+  voltage, current = CODECS_BY_ID[SET_SLOPE_U_I["msg_id"]].unpack(msg.data)
   return (voltage, current)
 
 
 """
 
-    A U X I L I A R Y   F U N C T I O N S
+    S I G N A L   L A Y O U T S
 
 """
 
+SIGNAL_TYPES = ("unsigned", "signed", "float", "float_low")
+
+"""Bit position of one signal, counted from the least significant bit of the first payload byte (INTEL order).
+Physical values are raw * factor + offset."""
+SignalLayout = collections.namedtuple("SignalLayout", "name start_bit length type factor offset")
+SignalLayout.__new__.__defaults__ = (1, 0)
+
+_STRUCT_LAYOUTS = {"B": ("unsigned", 8), "H": ("unsigned", 16), "I": ("unsigned", 32), "L": ("unsigned", 32),
+                   "Q": ("unsigned", 64), "b": ("signed", 8), "h": ("signed", 16), "i": ("signed", 32),
+                   "l": ("signed", 32), "q": ("signed", 64), "e": ("float", 16), "f": ("float", 32),
+                   "d": ("float", 64), "?": ("unsigned", 8)}
+
+_ALIGNED_CODES = {("unsigned", 8): "B", ("unsigned", 16): "H", ("unsigned", 32): "I", ("unsigned", 64): "Q",
+                  ("signed", 8): "b", ("signed", 16): "h", ("signed", 32): "i", ("signed", 64): "q",
+                  ("float", 16): "e", ("float", 32): "f", ("float", 64): "d"}
+
+_INTEGER_CODES = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+_FLOAT32 = struct.Struct("<f")
+_UINT32 = struct.Struct("<I")
+
+
+def _float_bits(value):
+    return _UINT32.unpack(_FLOAT32.pack(value))[0]
+
+
+def _bits_float(bits):
+    return _FLOAT32.unpack(_UINT32.pack(bits))[0]
 
-def set_bit(shift, value, bitmask):
-    return (value << shift) & bitmask
 
+def signal_layouts(msg_info):
+    """ Bit layout of the signals of a message description in payload order.
 
-def clear_bit(shift, value, bitmask):
-    return (value << shift) ^ bitmask
+    Signals are described by start_bit, length and type, optionally scaled by factor and offset. A float shorter than
+    32 bits holds the upper bits of an IEEE float, the lower mantissa bits are dropped. A float_low signal holds the
+    lower bits of an IEEE float, sign and exponent are dropped and its decoded value is only the float of these bits.
+    Descriptions without start_bit are laid out from msg_fmt.
+
+    :return: Tuple of SignalLayout
+    """
+    names = [key for key, value in msg_info.items() if isinstance(value, dict)]
+    if names and all("start_bit" in msg_info[name] for name in names):
+        layouts = [SignalLayout(name, msg_info[name]["start_bit"], msg_info[name]["length"], msg_info[name]["type"],
+                                msg_info[name].get("factor", 1), msg_info[name].get("offset", 0))
+                   for name in names]
+    else:
+        layouts = []
+        bit = 0
+        fields = iter(msg_info.get("msg_fields", names))
+        for count, char in re.findall(r"(\d*)([a-zA-Z?])", msg_info["msg_fmt"]):
+            count = int(count or 1)
+            if char == "x":
+                bit += 8 * count
+                continue
+            if char not in _STRUCT_LAYOUTS:
+                raise ValueError("{} needs a bit layout for format {!r}".format(msg_info["msg_name"], char))
+            signal_type, length = _STRUCT_LAYOUTS[char]
+            for _ in range(count):
+                name = next(fields)
+                info = msg_info.get(name, {})
+                layouts.append(SignalLayout(name, bit, length, signal_type, info.get("factor", 1),
+                                            info.get("offset", 0)))
+                bit += length
+
+    layouts.sort(key=lambda layout: layout.start_bit)
+    end = 0
+    for layout in layouts:
+        if layout.type not in SIGNAL_TYPES:
+            raise ValueError("Signal {} has unknown type {!r}".format(layout.name, layout.type))
+        if layout.type == "float" and layout.length not in (16, 32, 64) and not 0 < layout.length < 32:
+            raise ValueError("Float signal {} can not have {} bits".format(layout.name, layout.length))
+        if layout.type == "float_low" and not 0 < layout.length < 32:
+            raise ValueError("Float signal {} can not have {} bits".format(layout.name, layout.length))
+        if not layout.name.isidentifier() or keyword.iskeyword(layout.name) or layout.name.startswith("_"):
+            raise ValueError("Signal name {!r} is not usable".format(layout.name))
+        if layout.start_bit < end:
+            raise ValueError("Signal {} overlaps the signal before".format(layout.name))
+        end = layout.start_bit + layout.length
+    if end > 8 * msg_info["dlc"]:
+        raise ValueError("Signals of {} exceed the DLC of {}".format(msg_info["msg_name"], msg_info["dlc"]))
+    return tuple(layouts)
+
+
+def _slots(layouts):
+    """Group signals into the byte ranges they cover, signals sharing a byte share a range."""
+    slots = []
+    for layout in layouts:
+        first = layout.start_bit // 8
+        end = (layout.start_bit + layout.length + 7) // 8
+        if slots and first < slots[-1][1]:
+            slots[-1][1] = max(slots[-1][1], end)
+            slots[-1][2].append(layout)
+        else:
+            slots.append([first, end, [layout]])
+    return slots
+
+
+def _scaled(layout):
+    return layout.factor != 1 or layout.offset != 0
+
+
+def _raw_value(layout):
+    """Expression of the raw value of a signal parameter, before it is converted to bits."""
+    if not _scaled(layout):
+        return layout.name
+    raw = "({} - {!r})".format(layout.name, layout.offset) if layout.offset else layout.name
+    raw = "{} / {!r}".format(raw, layout.factor) if layout.factor != 1 else raw
+    return "({})".format(raw) if layout.type in ("float", "float_low") else "round({})".format(raw)
+
+
+def _physical(layout, raw):
+    """Expression of the physical value of a signal from the expression of its raw value."""
+    if layout.factor != 1:
+        raw = "{} * {!r}".format(raw, layout.factor)
+    return "{} + {!r}".format(raw, layout.offset) if layout.offset else raw
+
+
+def _raw_bits(layout):
+    """Expression of the raw bits of a signal parameter."""
+    if layout.type == "float" and layout.length == 32:
+        return "_float_bits({})".format(_raw_value(layout))
+    if layout.type == "float":
+        return "_float_bits({}) >> {}".format(_raw_value(layout), 32 - layout.length)
+    if layout.type == "float_low":
+        return "_float_bits({})".format(_raw_value(layout))
+    return _raw_value(layout)
+
+
+def _value(layout, raw):
+    """Expression of a signal value from the expression of its raw bits."""
+    if layout.type == "float" and layout.length == 32:
+        raw = "_bits_float({})".format(raw)
+    elif layout.type == "float":
+        raw = "_bits_float({} << {})".format(raw, 32 - layout.length)
+    elif layout.type == "float_low":
+        raw = "_bits_float({})".format(raw)
+    elif layout.type == "signed":
+        sign = 1 << (layout.length - 1)
+        raw = "(({} ^ {}) - {})".format(raw, sign, sign)
+    return _physical(layout, raw)
+
+
+def _aligned_code(layout, first, end):
+    """Struct code of a signal that fills its bytes alone, None if it has to be packed as bits."""
+    if layout.start_bit != 8 * first or layout.length != 8 * (end - first):
+        return None
+    return _ALIGNED_CODES.get((layout.type, layout.length))
+
+
+def _containers(layouts, dlc):
+    """ Byte containers of a signal layout in payload order.
+
+    Signals that fill their bytes alone with a struct size are their own container, signals sharing bytes and odd
+    sized signals are packed into the integer of their bytes.
+
+    :return: Tuple of the struct format and a list of (first byte, width, aligned, signals) per container
+    """
+    fmt, containers = ["<"], []
+    position = 0
+    for first, end, members in _slots(layouts):
+        if first > position:
+            fmt.append("{}x".format(first - position))
+        position = end
+        width = end - first
+        code = _aligned_code(members[0], first, end) if len(members) == 1 else None
+        fmt.append(code or _INTEGER_CODES.get(width) or "{}s".format(width))
+        containers.append((first, width, code is not None, members))
+    if dlc > position:
+        fmt.append("{}x".format(dlc - position))
+    return "".join(fmt), containers
+
+
+def container_format(layouts, dlc):
+    """ Struct format and field names of the byte containers of a signal layout, msg_fmt and msg_fields of a message
+    description. Containers of several signals are named after their first byte, e.g. "byte4".
+    """
+    fmt, containers = _containers(layouts, dlc)
+    return fmt, tuple(members[0].name if len(members) == 1 else "byte{}".format(first)
+                      for first, _, _, members in containers)
+
+
+def codec_source(msg_name, layouts, dlc):
+    """ Source code of the specialized encode and decode function of a message.
+
+    Byte aligned signals of a struct size become fields of one struct, bit fields and odd sized signals are combined
+    into the integer of the bytes they share. Encoding a frame is one pack call with the shifted and masked signals,
+    decoding one unpack call; there are no branches or loops per signal left.
+
+    :return: Source code defining encode_<msg_name>(**signals) -> bytes and decode_<msg_name>(data) -> dict
+    """
+    _, containers = _containers(layouts, dlc)
+    pack_args, unpack_names, setup, values = [], [], [], {}
+    for index, (first, width, aligned, members) in enumerate(containers):
+        slot = "s{}".format(index)
+        unpack_names.append(slot)
+        if aligned:
+            pack_args.append(_raw_value(members[0]))
+            values[members[0].name] = _physical(members[0], slot)
+            continue
+
+        parts = []
+        for layout in members:
+            mask = (1 << layout.length) - 1
+            shift = layout.start_bit - 8 * first
+            part = "({} & 0x{:X})".format(_raw_bits(layout), mask)
+            parts.append("{} << {}".format(part, shift) if shift else part)
+            raw = "{} >> {} & 0x{:X}".format(slot, shift, mask) if shift else "{} & 0x{:X}".format(slot, mask)
+            values[layout.name] = _value(layout, "({})".format(raw))
+        expression = " | ".join(parts)
+        if width in _INTEGER_CODES:
+            pack_args.append(expression)
+        else:
+            pack_args.append("({}).to_bytes({}, 'little')".format(expression, width))
+            setup.append("    {0} = int.from_bytes({0}, 'little')".format(slot))
+
+    name = _function_name(msg_name)
+    signals = [layout.name for layout in layouts]
+    return "\n".join(
+        ["def encode_{}({}):".format(name, ", ".join(signals)),
+         "    return _pack({})".format(", ".join(pack_args)),
+         "",
+         "def decode_{}(data):".format(name),
+         "    {} = _unpack(data)".format(", ".join(unpack_names) + "," * (len(unpack_names) == 1) or "_")]
+        + setup
+        + ["    return {{{}}}".format(", ".join("{!r}: {}".format(signal, values[signal]) for signal in signals)),
+           ""])
+
+
+def _function_name(msg_name):
+    return re.sub(r"\W", "_", msg_name)
+
+
+def compile_codec(msg_name, layouts, dlc, code=None):
+    """ Generate and compile the encode and decode function of a message from its signal layout, see codec_source().
+
+    :param code: Code object of an earlier compilation of the same layout, e.g. from a cache, skips the compilation
+    :return: Tuple of encode(**signals) -> bytes, decode(data) -> dict and the code object
+    """
+    fmt, _ = _containers(layouts, dlc)
+    if code is None:
+        code = compile(codec_source(msg_name, layouts, dlc), "<codec {}>".format(msg_name), "exec")
+    compiled = struct.Struct(fmt)
+    namespace = {"_pack": compiled.pack, "_unpack": compiled.unpack,
+                 "_float_bits": _float_bits, "_bits_float": _bits_float}
+    exec(code, namespace)
+    name = _function_name(msg_name)
+    return namespace["encode_" + name], namespace["decode_" + name], code
 
 
 """
@@ -367,3 +747,89 @@ def clear_bit(shift, value, bitmask):
     C L A S S E S
 
 """
+
+
+class MessageCodec:
+    """Compiled encoder/decoder for one message description.
+
+    encode() and decode() are generated from the bit layout of the signals (see compile_codec), so packing a frame
+    with bit fields is a single precompiled operation. pack() and unpack() work on the byte containers of msg_fmt
+    in the order of fields, e.g. the whole REG_CTRL byte of SET_REF_SWITCH_CTRL_RI.
+    """
+
+    __slots__ = ("msg_id", "msg_name", "dlc", "freq", "fields", "signals", "layouts", "description",
+                 "pack", "unpack", "encode", "decode", "code", "_struct")
+
+    def __init__(self, msg_info, code=None):
+        self.msg_id = msg_info["msg_id"]
+        self.msg_name = msg_info["msg_name"]
+        self.dlc = msg_info["dlc"]
+        self.freq = msg_info.get("freq")
+        self.description = msg_info
+        self._struct = struct.Struct(msg_info["msg_fmt"])
+        self.pack = self._struct.pack
+        self.unpack = self._struct.unpack
+        if "msg_fields" in msg_info:
+            self.fields = tuple(msg_info["msg_fields"])
+        else:
+            self.fields = tuple(key for key, value in msg_info.items() if isinstance(value, dict))
+
+        if len(self._struct.unpack(bytes(self._struct.size))) != len(self.fields):
+            raise ValueError("Format {} does not match signals of {}".format(msg_info["msg_fmt"], self.msg_name))
+
+        self.layouts = signal_layouts(msg_info)
+        self.signals = tuple(layout.name for layout in self.layouts)
+        self.encode, self.decode, self.code = compile_codec(self.msg_name, self.layouts, self.dlc, code)
+
+    def __repr__(self):
+        return "MessageCodec({}, id=0x{:X})".format(self.msg_name, self.msg_id)
+
+    def __reduce__(self):
+        # Generated functions can not be pickled, the codec is restored from its description and marshalled code
+        return _restore_codec, (self.description, marshal.dumps(self.code))
+
+    @property
+    def source(self):
+        """Source code of encode() and decode()."""
+        return codec_source(self.msg_name, self.layouts, self.dlc)
+
+
+def _restore_codec(msg_info, code):
+    return MessageCodec(msg_info, marshal.loads(code))
+
+
+"""
+
+    C O M P I L E D   M E S S A G E   R E G I S T R Y
+
+"""
+
+MESSAGE_DESCRIPTIONS = (SET_SLOPE_U_I, SET_SLOPE_PWR_FILTER,
+                        SET_OP_LIM_U, SET_OP_LIM_I, SET_OP_LIM_PWR,
+                        SET_PR_LIM_U, SET_PR_LIM_I, SET_PR_LIM_PWR,
+                        CLEARANCE, SET_RST_STOP, SET_REF_SWITCH_CTRL_RI,
+                        STATUS_SYSTEM, STATUS_MEAS_U_I, STATUS_ERR_STANDBY, STATUS_ERR_CRITICAL)
+
+CODECS_BY_ID = {}
+CODECS_BY_NAME = {}
+
+
+def register_message(msg_info):
+    """Compile a message description and add it to the registry."""
+    codec = MessageCodec(msg_info)
+    CODECS_BY_ID[codec.msg_id] = codec
+    CODECS_BY_NAME[codec.msg_name] = codec
+    return codec
+
+
+def get_codec(msg_info):
+    """Return the compiled codec for a message description, message name or message id."""
+    if isinstance(msg_info, dict):
+        return CODECS_BY_NAME[msg_info["msg_name"]]
+    if isinstance(msg_info, str):
+        return CODECS_BY_NAME[msg_info]
+    return CODECS_BY_ID[msg_info]
+
+
+for _msg_info in MESSAGE_DESCRIPTIONS:
+    register_message(_msg_info)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Instrumentation of the hot paths per arbitration id and pipeline stage.
+
+Counters and latency histograms are kept per (stage, arbitration id). The stages are encode, send, lateness,
+receive, decode and handler. send is the duration of bus.send(), lateness the delay of a cyclic frame of the software
+timer behind its deadline. receive is the delay between the frame timestamp and its dispatch, it is only recorded
+for backends stamping frames with wall-clock time, device relative timestamps are skipped. Latencies are recorded in
+nanoseconds into log-linear histograms in the style of HdrHistogram: every power of two is split into equally wide
+sub-buckets, so the relative error is bounded while the histogram only stores the buckets actually hit.
+
+Instrumentation is disabled by default. Every call site checks METRICS.enabled before it reads the clock, so a
+disabled run only pays one attribute lookup per frame.
+
+Usage:
+    from metrics import METRICS
+    METRICS.enable()
+    ...
+    METRICS.dump("metrics.json")
+    METRICS.serve(9100)         # Prometheus text format on http://localhost:9100/metrics
+"""
+
+import json
+import os
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger("calibration.metrics")
+
+
+STAGES = ("encode", "send", "lateness", "receive", "decode", "handler")
+
+
+class LogLinearHistogram:
+    """ Histogram of non-negative integer values with a bounded relative error.
+
+    Values below 2 ** sub_bucket_bits are counted exactly. Above, every power of two is divided into
+    2 ** (sub_bucket_bits - 1) buckets, the relative error is at most 2 ** (1 - sub_bucket_bits).
+
+    :param sub_bucket_bits: Resolution, 5 bits give an error below 7 %
+    """
+
+    __slots__ = ("sub_bucket_bits", "counts", "count", "total", "min", "max")
+
+    def __init__(self, sub_bucket_bits=5):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        bits = self.sub_bucket_bits
+        if value < 1 << bits:
+            return value
+        shift = value.bit_length() - bits
+        return (1 << bits) + ((shift - 1) << (bits - 1)) + (value >> shift) - (1 << (bits - 1))
+
+    def bucket_value(self, bucket):
+        """Lowest value of a bucket."""
+        bits = self.sub_bucket_bits
+        if bucket < 1 << bits:
+            return bucket
+        shift, sub_bucket = divmod(bucket - (1 << bits), 1 << (bits - 1))
+        return (sub_bucket + (1 << (bits - 1))) << (shift + 1)
+
+    def record(self, value):
+        value = max(int(value), 0)
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Lowest value of the bucket containing the percentile, None for an empty histogram."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(max(self.bucket_value(bucket), self.min), self.max)
+        return self.max
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def as_dict(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "min": self.min,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "p999": self.percentile(99.9),
+                "max": self.max,
+                "buckets": {self.bucket_value(bucket): count for bucket, count in sorted(self.counts.items())}}
+
+
+class Metrics:
+    """Counters, gauges and latency histograms keyed by name or stage and arbitration id."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+            self._started = time.time()
+
+    def count(self, name, msg_id=None, value=1):
+        """Increment a counter, e.g. count("rx_frames", 0x288)."""
+        key = (name, msg_id)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, msg_id=None):
+        """Set the current value of a gauge, e.g. a queue depth."""
+        self._gauges[(name, msg_id)] = value
+
+    def observe(self, stage, msg_id, nanoseconds):
+        """Record the latency of one frame in a pipeline stage."""
+        key = (stage, msg_id)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LogLinearHistogram()
+            histogram.record(nanoseconds)
+
+    def snapshot(self):
+        """JSON serializable copy of all metrics."""
+        with self._lock:
+            elapsed = time.time() - self._started
+            return {"timestamp": time.time(),
+                    "elapsed": elapsed,
+                    "counters": [{"name": name, "msg_id": msg_id, "value": value,
+                                  "rate": value / elapsed if elapsed > 0 else None}
+                                 for (name, msg_id), value in sorted(self._counters.items(), key=_sort_key)],
+                    "gauges": [{"name": name, "msg_id": msg_id, "value": value}
+                               for (name, msg_id), value in sorted(self._gauges.items(), key=_sort_key)],
+                    "latency_ns": [dict(histogram.as_dict(), stage=stage, msg_id=msg_id)
+                                   for (stage, msg_id), histogram in sorted(self._histograms.items(),
+                                                                            key=_sort_key)]}
+
+    def dump(self, filename):
+        """Write a snapshot as JSON, the file is replaced atomically."""
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(temporary, filename)
+
+    def prometheus_text(self):
+        """Snapshot in the Prometheus text exposition format, latencies as summaries in seconds."""
+        snapshot = self.snapshot()
+        lines = []
+        types = set()
+
+        def declare(name, kind):
+            if name not in types:
+                types.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        for counter in snapshot["counters"]:
+            name = "bte_{}_total".format(counter["name"])
+            declare(name, "counter")
+            lines.append("{}{} {}".format(name, _labels(counter["msg_id"]), counter["value"]))
+        for gauge in snapshot["gauges"]:
+            name = "bte_{}".format(gauge["name"])
+            declare(name, "gauge")
+            lines.append("{}{} {}".format(name, _labels(gauge["msg_id"]), gauge["value"]))
+        for histogram in snapshot["latency_ns"]:
+            declare("bte_latency_seconds", "summary")
+            labels = {"stage": histogram["stage"]}
+            for quantile, key in ((0.5, "p50"), (0.9, "p90"), (0.99, "p99"), (0.999, "p999")):
+                lines.append("bte_latency_seconds{} {:.9f}".format(
+                    _labels(histogram["msg_id"], quantile=quantile, **labels), histogram[key] / 1e9))
+            lines.append("bte_latency_seconds_count{} {}".format(_labels(histogram["msg_id"], **labels),
+                                                                 histogram["count"]))
+            lines.append("bte_latency_seconds_sum{} {:.9f}".format(_labels(histogram["msg_id"], **labels),
+                                                                   histogram["mean"] * histogram["count"] / 1e9))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        """Serve prometheus_text() on http://host:port/metrics from a daemon thread."""
+        metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True).start()
+        logger.info("Metrics served on http://%s:%d/metrics", host, self._server.server_address[1])
+        return self._server.server_address[1]
+
+    def stop_server(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _sort_key(item):
+    (name, msg_id), _ = item
+    return name, -1 if msg_id is None else msg_id
+
+
+def _labels(msg_id, **labels):
+    if msg_id is not None:
+        labels["msg_id"] = "0x{:X}".format(msg_id)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in labels.items()) + "}"
+
+
+"""Process wide instrumentation, disabled until METRICS.enable() is called"""
+METRICS = Metrics()
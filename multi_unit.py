@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Parallel calibration of several BTE units, one CAN channel per unit.
+
+Every unit runs its own calibration session (see runner.CalibrationRunner) on its own bus in a worker thread or
+worker process. A failing or hanging unit only ends its own session, the results of all units are collected and
+progress is reported after every finished unit.
+
+Usage:
+    units = [UnitSpec(channel=0, serial="BTE-0001"), UnitSpec(channel=1, serial="BTE-0002")]
+    results = calibrate_units(units, session)
+
+The sessions are independent of each other, so line throughput scales with the number of channels as long as the
+host has enough cores (use_processes=True) or the sessions mostly wait on the bus (threads).
+
+The buses are leased from a bus_pool.BusPool and stay open after a unit, so the next unit on the same channel starts
+without opening the interface again.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+import logging
+
+import tas_protocol as tas
+from bus_pool import BUS_POOL
+from runner import CalibrationRunner
+
+
+logger = logging.getLogger("calibration.multi_unit")
+
+
+class UnitSpec(collections.namedtuple("UnitSpec", "channel serial interface bitrate")):
+    """CAN channel and serial number of one unit on the line."""
+
+    __slots__ = ()
+
+    def __new__(cls, channel, serial, interface=tas.CAN_INTERFACE, bitrate=tas.CAN_BITRATE):
+        return super().__new__(cls, channel, serial, interface, bitrate)
+
+    @classmethod
+    def parse(cls, text, interface=tas.CAN_INTERFACE, bitrate=tas.CAN_BITRATE):
+        """Create a unit from a console argument "CHANNEL:SERIAL"."""
+        channel, _, serial = text.partition(":")
+        if not channel or not serial:
+            raise ValueError("Unit must be given as CHANNEL:SERIAL, got {!r}".format(text))
+        if channel.isdigit():
+            channel = int(channel)
+        return cls(channel, serial, interface, bitrate)
+
+
+UnitResult = collections.namedtuple("UnitResult", "serial channel ok error duration result")
+
+
+class LineProgress:
+    """Thread safe progress of all units on the line."""
+
+    def __init__(self, total, callback=None):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self._callback = callback
+        self._lock = threading.Lock()
+
+    def finished(self, result):
+        with self._lock:
+            self.done += 1
+            if not result.ok:
+                self.failed += 1
+            snapshot = self.snapshot()
+        logger.info("Unit %s on channel %s %s after %.2f s (%d/%d done, %d failed)",
+                    result.serial, result.channel, "passed" if result.ok else "FAILED", result.duration,
+                    snapshot["done"], snapshot["total"], snapshot["failed"])
+        if self._callback is not None:
+            self._callback(result, snapshot)
+
+    def snapshot(self):
+        return {"total": self.total, "done": self.done, "failed": self.failed}
+
+
+def run_unit(spec, session, step_timeout=1.0, unit_timeout=None, pool=None):
+    """ Run one calibration session on the bus of one unit.
+
+    Every error is caught and returned in the result, so one unit can not stop the others.
+
+    :param spec: UnitSpec of the unit
+    :param session: Coroutine function session(runner)
+    :param step_timeout: Default step timeout of the runner
+    :param unit_timeout: Maximum duration of the whole session in seconds
+    :param pool: BusPool the bus is leased from, default the pool of the process
+    :return: UnitResult
+    """
+    start = time.perf_counter()
+    pool = BUS_POOL if pool is None else pool
+
+    async def _session(runner):
+        runner.unit = spec
+        return await asyncio.wait_for(session(runner), unit_timeout)
+
+    try:
+        with pool.lease(spec.interface, spec.channel, spec.bitrate) as bus:
+            result = CalibrationRunner.run_session(bus, _session, step_timeout=step_timeout)
+    except Exception as e:
+        logger.error("Calibration of unit %s failed: %s", spec.serial, e, exc_info=True)
+        return UnitResult(spec.serial, spec.channel, False, repr(e), time.perf_counter() - start, None)
+    return UnitResult(spec.serial, spec.channel, True, None, time.perf_counter() - start, result)
+
+
+def calibrate_units(specs, session, workers=None, use_processes=False, step_timeout=1.0, unit_timeout=None,
+                    progress=None, pool=None):
+    """ Calibrate several units concurrently.
+
+    :param specs: List of UnitSpec
+    :param session: Coroutine function session(runner), must be a module level function if use_processes is set
+    :param workers: Number of workers, defaults to one per unit
+    :param use_processes: Run every session in a worker process instead of a thread
+    :param step_timeout: Default step timeout of the runners
+    :param unit_timeout: Maximum duration of one session in seconds
+    :param progress: Callback progress(result, snapshot) called after every finished unit
+    :param pool: BusPool of the threads, default the pool of the process. Worker processes use their own pool.
+    :return: List of UnitResult in the order of specs
+    """
+    if use_processes and pool is not None:
+        raise ValueError("A bus pool can not be shared with worker processes")
+    specs = list(specs)
+    if not specs:
+        return []
+    line = LineProgress(len(specs), progress)
+    executor_cls = concurrent.futures.ProcessPoolExecutor if use_processes else concurrent.futures.ThreadPoolExecutor
+    results = [None] * len(specs)
+
+    with executor_cls(max_workers=workers or len(specs)) as executor:
+        futures = {executor.submit(run_unit, spec, session, step_timeout, unit_timeout, pool): index
+                   for index, spec in enumerate(specs)}
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            spec = specs[index]
+            try:
+                result = future.result()
+            except Exception as e:
+                # Only reached if the worker itself died, e.g. a crashed process
+                result = UnitResult(spec.serial, spec.channel, False, repr(e), float("nan"), None)
+            results[index] = result
+            line.finished(result)
+    return results
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Batch reprocessing of archived captures with a process pool.
+
+Every capture file of a directory is handled by a worker process: the capture is decoded with the message
+descriptions of messages.py (see bulk_codec), the settled response of every setpoint hold is taken as calibration
+point with the settle criteria of the online sweep (see analysis.settled_points) and the settled points are fitted,
+so a capture of a sweep reproduces its online fit. Workers only return the fit state, the results of all captures of
+the same unit are merged afterwards, so reprocessing scales with the number of cores.
+
+The unit serial is taken from the "serial" entry of the capture metadata, or from the file name.
+
+Usage:
+    python reprocess.py captures/ --workers 8 --output coefficients.json
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+import logging
+
+from capture import CaptureReader
+from fit import CalibrationFit
+
+
+logger = logging.getLogger("calibration.reprocess")
+
+
+def process_capture(filename, settle=None):
+    """ Recompute the calibration of one capture, runs in a worker process.
+
+    :param settle: Keyword arguments of analysis.settled_points(), e.g. window and tolerance
+    :return: Dictionary with file, serial, frames, points, fit state and statistics, or the error
+    """
+    from bulk_codec import decode_capture
+    from analysis import settled_points
+
+    start = time.perf_counter()
+    try:
+        with CaptureReader(filename) as capture:
+            serial = capture.metadata.get("serial") or os.path.splitext(os.path.basename(filename))[0]
+            frames = len(capture)
+            points = settled_points(decode_capture(capture), **(settle or {}))
+    except Exception as e:
+        return {"file": filename, "error": repr(e)}
+
+    # Points that did not settle within their hold are left out, as in the online sweep
+    settled = points["settled"]
+    fit = CalibrationFit(signals=("voltage",))
+    for setpoint, mean in zip(points["setpoint"][settled].tolist(), points["mean"][settled].tolist()):
+        fit.update("voltage", setpoint, mean)
+    return {"file": filename,
+            "serial": serial,
+            "frames": frames,
+            "points": len(points["setpoint"]),
+            "unsettled": int(len(settled) - settled.sum()),
+            "point_std_max": float(points["std"][settled].max()) if settled.any() else None,
+            "fit": fit.state(),
+            "coefficients": fit.coefficients(),
+            "duration": time.perf_counter() - start}
+
+
+def print_progress(done, total, result, started):
+    """Default progress indicator, one updating line on stderr."""
+    elapsed = time.perf_counter() - started
+    remaining = elapsed / done * (total - done)
+    sys.stderr.write("\r[{}/{}] {:5.1f} % {:6.1f} s elapsed, {:6.1f} s remaining  {}".format(
+        done, total, 100.0 * done / total, elapsed, remaining, os.path.basename(result["file"])[-40:].ljust(40)))
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def reprocess(filenames, workers=None, settle=None, progress=print_progress):
+    """ Reprocess captures in a process pool and merge the fits per unit.
+
+    :param filenames: Capture files
+    :param workers: Number of worker processes, defaults to the number of cores
+    :param settle: Keyword arguments of analysis.settled_points(), defaults to the criteria of the online sweep
+    :param progress: Callback progress(done, total, file result, start time) after every capture, None for silence
+    :return: Dictionary with "files" (result per capture in input order) and "units" (merged coefficients per serial)
+    """
+    filenames = list(filenames)
+    files = [None] * len(filenames)
+    started = time.perf_counter()
+    if filenames:
+        workers = min(workers or os.cpu_count() or 1, len(filenames))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_capture, filename, settle): index
+                       for index, filename in enumerate(filenames)}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                index = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Only reached if the worker itself died
+                    result = {"file": filenames[index], "error": repr(e)}
+                files[index] = result
+                if progress is not None:
+                    progress(done, len(filenames), result, started)
+
+    merged = {}
+    for result in files:
+        if "error" in result:
+            logger.error("Reprocessing %s failed: %s", result["file"], result["error"])
+            continue
+        unit = merged.get(result["serial"])
+        if unit is None:
+            unit = merged[result["serial"]] = {"fit": CalibrationFit(signals=()), "files": 0, "frames": 0}
+        unit["fit"].merge(CalibrationFit.from_state(result.pop("fit")))
+        unit["files"] += 1
+        unit["frames"] += result["frames"]
+
+    units = {serial: {"files": unit["files"], "frames": unit["frames"], "coefficients": unit["fit"].coefficients()}
+             for serial, unit in sorted(merged.items())}
+    return {"files": files, "units": units, "duration": time.perf_counter() - started}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute calibration coefficients from archived captures")
+    parser.add_argument("directory", help="Directory of the capture files")
+    parser.add_argument("--pattern", default="*.btecap", help="File name pattern of the captures")
+    parser.add_argument("--recursive", action="store_true", default=False, help="Search subdirectories as well")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, default one per core")
+    parser.add_argument("--window", type=float, default=0.1, help="Settle window in seconds")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Maximum standard deviation within the window")
+    parser.add_argument("--slope-tolerance", type=float, default=5.0, help="Maximum drift within the window per second")
+    parser.add_argument("--setpoint-tolerance", type=float, default=None,
+                        help="Maximum distance of a settled point from its setpoint, default 40 %% of the step")
+    parser.add_argument("--max-dwell", type=float, default=0.5, help="Maximum dwell of a point in seconds")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--quiet", action="store_true", default=False, help="No progress indicator")
+    args = parser.parse_args(argv)
+
+    pattern = os.path.join(args.directory, "**", args.pattern) if args.recursive else \
+        os.path.join(args.directory, args.pattern)
+    filenames = sorted(glob.glob(pattern, recursive=args.recursive))
+    if not filenames:
+        print("No captures matching {}".format(pattern))
+        return 1
+
+    settle = {"window": args.window, "tolerance": args.tolerance, "slope_tolerance": args.slope_tolerance,
+              "setpoint_tolerance": args.setpoint_tolerance, "max_dwell": args.max_dwell}
+    result = reprocess(filenames, args.workers, settle, None if args.quiet else print_progress)
+    failed = sum(1 for entry in result["files"] if "error" in entry)
+    print("{} captures of {} units reprocessed in {:.1f} s, {} failed".format(
+        len(filenames), len(result["units"]), result["duration"], failed))
+    for serial, unit in result["units"].items():
+        voltage = unit["coefficients"].get("voltage", {})
+        print("{}: {} files, gain {:.6f}, offset {:.4f}".format(
+            serial, unit["files"], voltage.get("gain", float("nan")), voltage.get("offset", float("nan"))))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Local SQLite store of calibration results across the fleet.
+
+TABLES: runs:          One calibration run of a unit (serial, channel, time, status, settle report)
+        coefficients:  Fit result per run and signal (gain, offset, correction coefficients, residuals)
+        points:        Calibration points of a run (setpoint, settled mean, std, dwell)
+
+Writes are handed to a background writer thread through a queue and never block the caller. The writer commits
+everything queued so far in one transaction, per-point data is inserted with executemany. Queries use their own
+connection; the database runs in WAL mode, so reading does not wait for the writer.
+
+Usage:
+    with ResultStore("results.sqlite") as store:
+        store.submit(unit_result)
+        store.flush()
+        store.drift("BTE-0001")
+        store.outliers(field="gain")
+"""
+
+import json
+import math
+import queue
+import sqlite3
+import threading
+import time
+import logging
+
+
+logger = logging.getLogger("calibration.result_store")
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    serial TEXT NOT NULL,
+    channel TEXT,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    ok INTEGER NOT NULL,
+    error TEXT,
+    points INTEGER,
+    time_saved REAL,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS coefficients (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    signal TEXT NOT NULL,
+    samples INTEGER,
+    gain REAL,
+    offset REAL,
+    correction_gain REAL,
+    correction_offset REAL,
+    residual_std REAL,
+    r_squared REAL,
+    PRIMARY KEY (run_id, signal)
+);
+CREATE TABLE IF NOT EXISTS points (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    idx INTEGER NOT NULL,
+    setpoint REAL,
+    mean REAL,
+    std REAL,
+    dwell REAL,
+    settled INTEGER,
+    PRIMARY KEY (run_id, idx)
+);
+CREATE INDEX IF NOT EXISTS runs_serial_started ON runs (serial, started);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS runs_channel ON runs (channel);
+CREATE INDEX IF NOT EXISTS coefficients_signal ON coefficients (signal, run_id);
+"""
+
+COEFFICIENT_FIELDS = ("gain", "offset", "correction_gain", "correction_offset", "residual_std", "r_squared")
+
+_STOP = object()
+
+
+def _connect(filename):
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class ResultStore:
+    """ SQLite store of calibration runs with a background writer.
+
+    :param filename: Path of the database file
+    :param batch_size: Maximum number of runs committed in one transaction
+    """
+
+    def __init__(self, filename, batch_size=256):
+        self.filename = filename
+        self.batch_size = batch_size
+        # The context manager of a connection only commits, it does not close it
+        connection = _connect(filename)
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+        self._reader = _connect(filename)
+        self._reader.row_factory = sqlite3.Row
+        self._queue = queue.Queue()
+        self.failed = 0             # Runs that could not be written
+        self._thread = threading.Thread(target=self._write, name="ResultWriter", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    """ W R I T E   P A T H """
+
+    def submit(self, unit_result, metadata=None):
+        """ Queue a multi_unit.UnitResult for writing, returns immediately.
+
+        :param metadata: JSON serializable dictionary stored with the run, e.g. software version
+        """
+        finished = time.time()
+        duration = unit_result.duration if unit_result.duration == unit_result.duration else 0.0
+        self.submit_run(unit_result.serial, unit_result.channel, unit_result.result or {}, ok=unit_result.ok,
+                        error=unit_result.error, started=finished - duration, finished=finished,
+                        metadata=metadata)
+
+    def submit_run(self, serial, channel, result, ok=True, error=None, started=None, finished=None,
+                   metadata=None):
+        """ Queue one run for writing, returns immediately.
+
+        :param result: Dictionary as returned by sessions.calibrate_bte(): "fit" (coefficients per signal),
+                       optional "settle" report and "points" list
+        """
+        finished = time.time() if finished is None else finished
+        self._queue.put((serial, None if channel is None else str(channel), result, ok, error,
+                         finished if started is None else started, finished, metadata))
+
+    def flush(self):
+        """Wait until all queued runs are written."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._reader.close()
+
+    def _write(self):
+        connection = _connect(self.filename)
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = any(item is _STOP for item in batch)
+                runs = [item for item in batch if item is not _STOP]
+                try:
+                    with connection:
+                        for run in runs:
+                            self._insert(connection, *run)
+                except sqlite3.Error:
+                    self.failed += len(runs)
+                    logger.error("Writing %d calibration runs failed", len(runs), exc_info=True)
+                for _ in batch:
+                    self._queue.task_done()
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _insert(connection, serial, channel, result, ok, error, started, finished, metadata):
+        settle = result.get("settle") or {}
+        points = result.get("points") or []
+        cursor = connection.execute(
+            "INSERT INTO runs (serial, channel, started, finished, ok, error, points, time_saved, metadata) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (serial, channel, started, finished, int(bool(ok)), error, settle.get("points", len(points)),
+             settle.get("time_saved"), json.dumps(metadata) if metadata is not None else None))
+        run_id = cursor.lastrowid
+        connection.executemany(
+            "INSERT INTO coefficients (run_id, signal, samples, {}) VALUES (?, ?, ?, {})".format(
+                ", ".join(COEFFICIENT_FIELDS), ", ".join("?" * len(COEFFICIENT_FIELDS))),
+            [(run_id, signal, fit.get("samples")) + tuple(fit.get(field) for field in COEFFICIENT_FIELDS)
+             for signal, fit in (result.get("fit") or {}).items()])
+        connection.executemany(
+            "INSERT INTO points (run_id, idx, setpoint, mean, std, dwell, settled) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(run_id, index, point["setpoint"], point["mean"], point["std"], point["dwell"],
+              int(bool(point["settled"]))) for index, point in enumerate(points)])
+
+    """ Q U E R I E S """
+
+    def runs(self, serial=None, channel=None, since=None, until=None, ok=None):
+        """Runs filtered by serial, channel, time range and status, newest first."""
+        conditions, parameters = [], []
+        for column, operator, value in (("serial", "=", serial), ("channel", "=", channel),
+                                        ("started", ">=", since), ("started", "<", until)):
+            if value is not None:
+                conditions.append("{} {} ?".format(column, operator))
+                parameters.append(str(value) if column == "channel" else value)
+        if ok is not None:
+            conditions.append("ok = ?")
+            parameters.append(int(bool(ok)))
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return [dict(row) for row in self._reader.execute(
+            "SELECT * FROM runs{} ORDER BY started DESC".format(where), parameters)]
+
+    def points(self, run_id):
+        return [dict(row) for row in self._reader.execute(
+            "SELECT * FROM points WHERE run_id = ? ORDER BY idx", (run_id,))]
+
+    def drift(self, serial, signal="voltage"):
+        """Fit coefficients of all successful runs of one unit in time order."""
+        return [dict(row) for row in self._reader.execute(
+            "SELECT r.id AS run_id, r.started, r.channel, {} FROM runs r JOIN coefficients c ON c.run_id = r.id "
+            "WHERE r.serial = ? AND r.ok = 1 AND c.signal = ? ORDER BY r.started".format(
+                ", ".join("c." + field for field in COEFFICIENT_FIELDS)), (serial, signal))]
+
+    def drift_trends(self, signal="voltage", field="gain", since=None, min_runs=3):
+        """ Linear trend of a coefficient over time per unit, computed in one aggregate query.
+
+        :return: List of dictionaries with serial, runs, slope_per_day and the start times of the first and the
+                 latest run in the trend, sorted by the absolute slope
+        """
+        if field not in COEFFICIENT_FIELDS:
+            raise ValueError("Unknown coefficient {!r}".format(field))
+        # Times in days relative to the first run keep the sums small and the regression precise
+        reference = self._reader.execute("SELECT MIN(started) FROM runs").fetchone()[0] or 0.0
+        rows = self._reader.execute(
+            "SELECT serial, COUNT(*) AS n, SUM(x) AS sx, SUM(y) AS sy, SUM(x * x) AS sxx, SUM(x * y) AS sxy, "
+            "MIN(started) AS first, MAX(started) AS latest "
+            "FROM (SELECT r.serial, r.started, (r.started - ?) / 86400.0 AS x, c.{0} AS y "
+            "      FROM runs r JOIN coefficients c ON c.run_id = r.id "
+            "      WHERE r.ok = 1 AND c.signal = ? AND c.{0} IS NOT NULL AND r.started >= ?) "
+            "GROUP BY serial HAVING COUNT(*) >= ?".format(field), (reference, signal, since or 0.0, min_runs))
+        trends = []
+        for row in rows:
+            n = row["n"]
+            denominator = n * row["sxx"] - row["sx"] * row["sx"]
+            slope = (n * row["sxy"] - row["sx"] * row["sy"]) / denominator if denominator > 0 else 0.0
+            trends.append({"serial": row["serial"], "runs": n, "slope_per_day": slope,
+                           "first": row["first"], "latest": row["latest"]})
+        trends.sort(key=lambda trend: abs(trend["slope_per_day"]), reverse=True)
+        return trends
+
+    def outliers(self, signal="voltage", field="gain", threshold=3.0, since=None):
+        """ Units whose latest coefficient deviates from the rest of the fleet by more than threshold standard
+        deviations.
+
+        Each unit is compared with the mean and sample standard deviation of the other units (leave-one-out).
+        Including the unit itself bounds its z-score by (n - 1) / sqrt(n), below 3 for a fleet of up to 10 units.
+
+        :return: List of dictionaries with serial, run_id, value and z-score, largest deviation first
+        """
+        if field not in COEFFICIENT_FIELDS:
+            raise ValueError("Unknown coefficient {!r}".format(field))
+        latest = ("SELECT r.serial, r.id AS run_id, c.{0} AS value FROM runs r "
+                  "JOIN coefficients c ON c.run_id = r.id "
+                  "JOIN (SELECT serial, MAX(started) AS started FROM runs WHERE ok = 1 AND started >= ? "
+                  "      GROUP BY serial) l ON l.serial = r.serial AND l.started = r.started "
+                  "WHERE c.signal = ? AND c.{0} IS NOT NULL").format(field)
+        rows = self._reader.execute(latest, (since or 0.0, signal)).fetchall()
+        n = len(rows)
+        if n < 3:
+            return []
+        # Centred sums instead of AVG(value * value), coefficients close to 1 cancel in the raw second moment
+        mean = sum(row["value"] for row in rows) / n
+        m2 = sum((row["value"] - mean) ** 2 for row in rows)
+        result = []
+        for row in rows:
+            deviation = row["value"] - mean
+            others_mean = mean - deviation / (n - 1)
+            others_variance = max(m2 - deviation * deviation * n / (n - 1), 0.0) / (n - 2)
+            difference = row["value"] - others_mean
+            if others_variance > 0:
+                z = difference / others_variance ** 0.5
+            else:
+                z = math.copysign(math.inf, difference) if difference else 0.0
+            if abs(z) > threshold:
+                result.append({"serial": row["serial"], "run_id": row["run_id"], "value": row["value"], "z": z})
+        result.sort(key=lambda outlier: abs(outlier["z"]), reverse=True)
+        return result
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Bounded capture pipeline between the CAN driver and slow consumers.
+
+The ring buffer is a listener of the reader thread of the calibration runner (runner.add_reader_listener), a
+can.Notifier created without event loop. The thread copies every frame into a preallocated ring buffer of timestamps,
+ids, DLCs, flags (see capture.message_flags) and data bytes. Consumers take frames in batches. When the buffer is
+full, the configured policy either drops the oldest frames or blocks the reader thread, never the event loop; every
+lost frame is counted per arbitration id, so overflows are visible instead of silently happening in the driver queue.
+
+Usage:
+    ring = FrameRingBuffer(capacity=65536, policy=DROP_OLDEST)
+    runner.add_reader_listener(ring)
+    consumer = ConsumerThread(ring, writer.write_batch)
+"""
+
+import array
+import collections
+import threading
+import logging
+
+import can
+
+from capture import message_flags, FLAG_EXTENDED, FLAG_REMOTE, FLAG_ERROR
+from metrics import METRICS
+
+
+logger = logging.getLogger("calibration.ring_buffer")
+
+
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+_ZEROS = [bytes(size) for size in range(9)]
+
+
+"""Batch of frames taken from the ring buffer, data holds 8 bytes per frame, flags one capture flags byte per frame"""
+FrameBatch = collections.namedtuple("FrameBatch", "timestamps ids dlcs data flags")
+
+
+def batch_messages(batch):
+    """Iterate over a FrameBatch as CAN.Message objects."""
+    for index, (timestamp, msg_id, dlc, flags) in enumerate(zip(batch.timestamps, batch.ids, batch.dlcs,
+                                                                 batch.flags)):
+        yield can.Message(timestamp=timestamp, arbitration_id=msg_id, dlc=dlc,
+                          data=batch.data[index * 8:index * 8 + dlc], extended_id=bool(flags & FLAG_EXTENDED),
+                          is_remote_frame=bool(flags & FLAG_REMOTE), is_error_frame=bool(flags & FLAG_ERROR))
+
+
+class FrameRingBuffer(can.Listener):
+    """ Preallocated ring buffer of CAN frames.
+
+    :param capacity: Number of frames the buffer holds
+    :param policy: DROP_OLDEST overwrites the oldest frames, BLOCK lets the producer wait for free space
+    :param block_timeout: Maximum wait of a blocked producer, the new frame is dropped afterwards
+    """
+
+    def __init__(self, capacity=65536, policy=DROP_OLDEST, block_timeout=0.1):
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown overflow policy {!r}".format(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._timestamps = array.array("d", bytes(8 * capacity))
+        self._ids = array.array("L", [0]) * capacity
+        self._dlcs = bytearray(capacity)
+        self._flags = bytearray(capacity)
+        self._data = bytearray(8 * capacity)
+        self._head = 0              # Number of frames written
+        self._tail = 0              # Number of frames read or dropped
+        self._cond = threading.Condition()
+        self.dropped = collections.Counter()
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def on_message_received(self, msg):
+        self.put(msg.timestamp, msg.arbitration_id, msg.dlc, msg.data, message_flags(msg))
+
+    def put(self, timestamp, msg_id, dlc, data, flags=0):
+        """ Add one frame.
+
+        :param flags: Extended, remote, error and rx flags of the frame, see capture.message_flags()
+        :return: False if the frame was dropped because the buffer stayed full
+        """
+        with self._cond:
+            if self._head - self._tail == self.capacity:
+                if self.policy == BLOCK:
+                    if not self._cond.wait_for(lambda: self._head - self._tail < self.capacity, self.block_timeout):
+                        self.dropped[msg_id] += 1
+                        if METRICS.enabled:
+                            METRICS.count("dropped_frames", msg_id)
+                        return False
+                else:
+                    self.dropped[self._ids[self._tail % self.capacity]] += 1
+                    if METRICS.enabled:
+                        METRICS.count("dropped_frames", self._ids[self._tail % self.capacity])
+                    self._tail += 1
+
+            slot = self._head % self.capacity
+            self._timestamps[slot] = timestamp
+            self._ids[slot] = msg_id
+            self._dlcs[slot] = dlc
+            self._flags[slot] = flags
+            # Remote frames carry a DLC without data, the slice must keep its size
+            offset = slot * 8
+            size = min(len(data), dlc, 8)
+            self._data[offset:offset + size] = data[:size]
+            if size < 8:
+                self._data[offset + size:offset + 8] = _ZEROS[8 - size]
+            self._head += 1
+            self._cond.notify_all()
+        return True
+
+    def get_batch(self, max_frames=1024, timeout=None):
+        """ Take up to max_frames frames in the order they were received.
+
+        :param timeout: Seconds to wait for the first frame, None waits forever
+        :return: FrameBatch, empty if the timeout expired
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._head > self._tail, timeout):
+                return FrameBatch(array.array("d"), array.array("L"), b"", b"", b"")
+            if METRICS.enabled:
+                METRICS.gauge("ring_buffer_depth", self._head - self._tail)
+            count = min(self._head - self._tail, max_frames)
+            start = self._tail % self.capacity
+            first = min(count, self.capacity - start)
+            parts = [(start, start + first)]
+            if count > first:
+                parts.append((0, count - first))
+
+            timestamps, ids = array.array("d"), array.array("L")
+            dlcs, data, flags = bytearray(), bytearray(), bytearray()
+            for begin, end in parts:
+                timestamps.extend(self._timestamps[begin:end])
+                ids.extend(self._ids[begin:end])
+                dlcs += self._dlcs[begin:end]
+                flags += self._flags[begin:end]
+                data += self._data[begin * 8:end * 8]
+            self._tail += count
+            self._cond.notify_all()
+        return FrameBatch(timestamps, ids, bytes(dlcs), bytes(data), bytes(flags))
+
+    def overflow_counts(self):
+        """Dropped frames per arbitration id."""
+        with self._cond:
+            return dict(self.dropped)
+
+
+class ConsumerThread(threading.Thread):
+    """Thread handing batches of a ring buffer to a slow consumer, e.g. CaptureWriter.write_batch."""
+
+    def __init__(self, ring, handle_batch, max_frames=1024, timeout=0.1):
+        super().__init__(name="BatchConsumer", daemon=True)
+        self.ring = ring
+        self.handle_batch = handle_batch
+        self.max_frames = max_frames
+        self.timeout = timeout
+        self._running = threading.Event()
+        self._running.set()
+        self.start()
+
+    def run(self):
+        while self._running.is_set() or len(self.ring):
+            batch = self.ring.get_batch(self.max_frames, self.timeout)
+            if batch.ids:
+                try:
+                    self.handle_batch(batch)
+                except Exception:
+                    logger.error("Consumer failed on a batch of %d frames", len(batch.ids), exc_info=True)
+
+    def stop(self):
+        """Stop after the remaining frames are consumed, the producer must be stopped before."""
+        self._running.clear()
+        self.join()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+asyncio engine to run calibration steps.
+
+Received frames are pushed by a can.Notifier into an AsyncBufferedReader. A single monitor task distributes them to
+waiting steps and registered listeners, so transmit macros, cyclic setpoints and response monitoring run concurrently
+on one event loop instead of blocking each other. Listeners added with add_reader_listener(), e.g. a capture ring
+buffer, run on the thread of the Notifier instead and never wait for the event loop.
+
+Usage:
+    async def calibrate(runner):
+        await runner.step(runner.send_macro(tas.macroBTE_Initialization(...)), timeout=1.0, name="init")
+        runner.start_cyclic(msg.SET_REF_SWITCH_CTRL_RI, set_ref=0.0, set_switch=tas.SWITCH_STANDBY,
+                           set_ctrl=tas.CTRL_VOLTAGE, rst_q=0, rst_e=0, set_ri=0.0)
+        status = await runner.expect(0x288, timeout=0.5)
+
+    CalibrationRunner.run_session(bus, calibrate)
+"""
+
+import asyncio
+import collections
+import time
+import logging
+
+import can
+
+from scheduler import PeriodicScheduler
+from dispatcher import Dispatcher
+from status_cache import StatusCache
+from metrics import METRICS
+
+
+logger = logging.getLogger("calibration.runner")
+
+
+class StepTimeout(Exception):
+    """Raised when a calibration step does not finish within its timeout."""
+    pass
+
+
+"""Outcome of send_macro_batch(), failed holds the frames without confirmation after the last attempt"""
+MacroResult = collections.namedtuple("MacroResult", "sent confirmed unverified failed attempts")
+
+
+class _LoopForwarder(can.Listener):
+    """Hands the frames received by the thread of a can.Notifier to listeners running on an event loop."""
+
+    def __init__(self, loop, listeners):
+        self.loop = loop
+        self.listeners = listeners
+
+    def on_message_received(self, msg):
+        self.loop.call_soon_threadsafe(self._deliver, msg)
+
+    def _deliver(self, msg):
+        for listener in self.listeners:
+            listener.on_message_received(msg)
+
+
+def echo_matcher(frame):
+    """Predicate recognizing the echo of a sent frame on the monitored bus."""
+    msg_id, data = frame.arbitration_id, bytes(frame.data)
+    return lambda message: message.arbitration_id == msg_id and bytes(message.data) == data
+
+
+class CalibrationRunner:
+    """ Runs calibration steps as concurrent tasks on one event loop.
+
+    :param bus: CAN bus used for transmission
+    :param rx_bus: CAN bus monitored for responses, defaults to bus
+    :param loop: Event loop, defaults to the running loop
+    :param step_timeout: Default timeout of a single step in seconds
+    """
+
+    def __init__(self, bus, rx_bus=None, loop=None, step_timeout=1.0):
+        self.bus = bus
+        self.rx_bus = rx_bus if rx_bus is not None else bus
+        self.loop = loop or asyncio.get_event_loop()
+        self.step_timeout = step_timeout
+        self.unit = None            # UnitSpec of the calibrated unit, set by multi_unit.run_unit()
+        self.scheduler = PeriodicScheduler(bus)
+        self.dispatcher = Dispatcher()
+        self.reader = can.AsyncBufferedReader()
+        self.status_cache = StatusCache()       # Latest system and error status of the device
+        # The Notifier is created without loop, its thread runs the reader listeners and forwards to the event loop
+        self.notifier = can.Notifier(self.rx_bus, [_LoopForwarder(self.loop, [self.dispatcher, self.reader,
+                                                                              self.status_cache])], timeout=0.1)
+        self._waiters = []
+        self._listeners = []
+        self._monitor = self.loop.create_task(self._monitor_responses())
+
+    @classmethod
+    def run_session(cls, bus, session, rx_bus=None, step_timeout=1.0):
+        """ Run a session coroutine function session(runner) on a new event loop and shut down afterwards.
+
+        :return: Result of the session
+        """
+        async def _main():
+            runner = cls(bus, rx_bus=rx_bus, step_timeout=step_timeout)
+            try:
+                return await session(runner)
+            finally:
+                await runner.shutdown()
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(_main())
+        finally:
+            loop.close()
+
+    def add_listener(self, callback):
+        """Call callback(msg) for every received frame."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def add_reader_listener(self, listener):
+        """ Call listener.on_message_received(msg) for every received frame on the thread of the Notifier.
+
+        Backpressure of the listener, e.g. a full ring_buffer.FrameRingBuffer with the BLOCK policy, holds back the
+        reader thread and never the event loop.
+        """
+        self.notifier.add_listener(listener)
+
+    def subscribe(self, msg_id, handler):
+        """ Call handler(msg) for every frame with this arbitration id.
+
+        Handlers run on the event loop of the runner, so a handler must return quickly: a blocking
+        handler stalls expect(), step() and every other task of the session.
+        """
+        self.dispatcher.subscribe(msg_id, handler)
+
+    def apply_filters(self, max_filters=None, extra_ids=()):
+        """ Let only subscribed ids and the status messages of the status cache pass the acceptance filter of the
+        monitored bus.
+
+        Frames awaited with expect() must be subscribed or given in extra_ids, otherwise they are filtered out.
+        """
+        return self.dispatcher.apply_filters(self.rx_bus, max_filters,
+                                             set(extra_ids).union(self.status_cache.msg_ids))
+
+    async def send(self, message, timeout=None):
+        """Send one frame without blocking the event loop."""
+        if not METRICS.enabled:
+            await self.loop.run_in_executor(None, self.bus.send, message, timeout)
+            return
+        start = time.perf_counter_ns()
+        await self.loop.run_in_executor(None, self.bus.send, message, timeout)
+        METRICS.observe("send", message.arbitration_id, time.perf_counter_ns() - start)
+        METRICS.count("tx_frames", message.arbitration_id)
+
+    async def send_macro(self, frames, interval=0.0):
+        """ Send the frames of a protocol macro in order.
+
+        :param frames: Iterable of CAN.Message objects, e.g. tas.macroBTE_Initialization(...)
+        :param interval: Pause between two frames in seconds
+        :return: Number of frames sent
+        """
+        count = 0
+        for message in frames:
+            if message is None:
+                raise ValueError("Macro produced an invalid message")
+            await self.send(message)
+            count += 1
+            if interval:
+                await asyncio.sleep(interval)
+        return count
+
+    async def send_macro_batch(self, frames, interval=0.0, verify=None, timeout=None, retries=2, check=True):
+        """ Send all frames of a macro at once and verify them concurrently, only failed frames are retried.
+
+        The response waiters of all frames are registered before the first frame is sent, so a fast response is not
+        missed. After the whole sequence was sent, all confirmations are awaited together with one timeout: one
+        pipelined round trip instead of a send-and-wait step per frame.
+
+        :param frames: Iterable of CAN.Message objects, e.g. tas.macroBTE_Initialization(...)
+        :param interval: Pause between two frames in seconds
+        :param verify: Function verify(frame) returning a predicate predicate(msg) -> bool that recognizes the
+                       confirmation of the frame, or None if the frame can not be confirmed. Defaults to the echo of
+                       the frame if the monitored bus differs from the transmit bus, otherwise nothing is verified.
+        :param timeout: Time to wait for the confirmations of one attempt, defaults to the step timeout
+        :param retries: Number of repeated attempts for frames without confirmation
+        :param check: Raise StepTimeout if frames are still unconfirmed after the last attempt
+        :return: MacroResult
+        """
+        frames = list(frames)
+        if any(frame is None for frame in frames):
+            raise ValueError("Macro produced an invalid message")
+        if verify is None:
+            verify = echo_matcher if self.rx_bus is not self.bus else (lambda frame: None)
+        timeout = self.step_timeout if timeout is None else timeout
+
+        predicates = [verify(frame) for frame in frames]
+        unverified = [frame for frame, predicate in zip(frames, predicates) if predicate is None]
+        pending = [(frame, predicate) for frame, predicate in zip(frames, predicates) if predicate is not None]
+        confirmed, sent, attempts = [], 0, 0
+        to_send = frames
+        while True:
+            attempts += 1
+            waiters = [(predicate, self.loop.create_future()) for _, predicate in pending]
+            self._waiters.extend(waiters)
+            try:
+                for message in to_send:
+                    await self.send(message)
+                    sent += 1
+                    if interval:
+                        await asyncio.sleep(interval)
+                if waiters:
+                    await asyncio.wait([future for _, future in waiters], timeout=timeout)
+            finally:
+                for waiter in waiters:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+
+            failed = []
+            for (frame, predicate), (_, future) in zip(pending, waiters):
+                if future.done():
+                    confirmed.append(frame)
+                else:
+                    future.cancel()
+                    failed.append((frame, predicate))
+            if not failed or attempts > retries:
+                break
+            logger.warning("%d of %d frames not confirmed, retrying 0x%s", len(failed), len(frames),
+                           ", 0x".join("{:X}".format(frame.arbitration_id) for frame, _ in failed))
+            pending = failed
+            to_send = [frame for frame, _ in failed]
+
+        result = MacroResult(sent, confirmed, unverified, [frame for frame, _ in failed], attempts)
+        if failed and check:
+            raise StepTimeout("{} frames not confirmed after {} attempts: {}".format(
+                len(failed), attempts, ", ".join("0x{:X}".format(frame.arbitration_id) for frame in result.failed)))
+        return result
+
+    def start_cyclic(self, msg_info, freq=None, **signals):
+        """Start cyclic transmission of a setpoint message, see PeriodicScheduler.schedule()."""
+        return self.scheduler.schedule(msg_info, freq=freq, **signals)
+
+    def update_cyclic(self, msg_info, **signals):
+        """Change the payload of a cyclic setpoint without restarting its cycle."""
+        self.scheduler.update(msg_info, **signals)
+
+    def stop_cyclic(self, msg_id):
+        self.scheduler.cancel(msg_id)
+
+    async def expect(self, match, timeout=None):
+        """ Wait for a received frame.
+
+        :param match: Arbitration id or predicate predicate(msg) -> bool
+        :param timeout: Timeout in seconds, defaults to the step timeout
+        :return: First matching CAN.Message object
+        """
+        if not callable(match):
+            msg_id = match
+            match = lambda message: message.arbitration_id == msg_id
+        future = self.loop.create_future()
+        waiter = (match, future)
+        self._waiters.append(waiter)
+        try:
+            return await self.step(future, timeout)
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    async def step(self, awaitable, timeout=None, name=None):
+        """ Run one calibration step with a timeout.
+
+        :raises StepTimeout: If the step does not finish in time
+        """
+        timeout = self.step_timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            logger.error("Step %s timed out after %s s", name or awaitable, timeout)
+            raise StepTimeout("Step {} did not finish within {} s".format(name or "", timeout)) from None
+
+    async def gather(self, *steps):
+        """Run several steps concurrently, e.g. a transmit macro and the monitoring of its responses."""
+        return await asyncio.gather(*steps)
+
+    async def shutdown(self):
+        self.scheduler.stop_all()
+        self.notifier.stop()
+        self._monitor.cancel()
+        try:
+            await self._monitor
+        except asyncio.CancelledError:
+            pass
+
+    async def _monitor_responses(self):
+        async for message in self.reader:
+            for callback in self._listeners:
+                try:
+                    callback(message)
+                except Exception:
+                    logger.error("Listener failed on %s", message, exc_info=True)
+            if self._waiters:
+                for waiter in list(self._waiters):
+                    match, future = waiter
+                    if not future.done() and match(message):
+                        future.set_result(message)
+                        self._waiters.remove(waiter)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Periodic transmission of the cyclic messages declared in messages.py.
+
+Every message description declares a "freq". The scheduler keeps each scheduled message alive at this rate. Backends
+with their own cyclic transmission (in python-can 3 the SocketCAN broadcast manager and IXXAT) get the message handed
+over via send_periodic(), all other backends are served by a single software timer thread. Messages with a phase
+offset always use the software timer, a backend task starts at once and waiting for the phase would block the caller,
+e.g. the event loop of the runner.
+
+The software timer computes every deadline from the start time of the cycle (start + n * period) instead of sleeping
+a fixed period after each send, so send and sleep overshoot does not accumulate as drift.
+"""
+
+import heapq
+import math
+import threading
+import time
+import logging
+
+import can
+
+import messages as msg
+from metrics import METRICS
+
+
+logger = logging.getLogger("calibration.protocol.scheduler")
+
+
+def supports_hardware_periodic(bus):
+    """True if the bus backend implements its own cyclic transmission instead of python-can's thread fallback."""
+    return type(bus)._send_periodic_internal is not can.BusABC._send_periodic_internal
+
+
+def sleep_until(deadline, clock=time.perf_counter, spin=0.0002):
+    """Sleep until the clock reaches deadline. The last `spin` seconds are busy-waited to reduce oversleeping."""
+    remaining = deadline - clock()
+    if remaining > spin:
+        time.sleep(remaining - spin)
+    while clock() < deadline:
+        pass
+
+
+class PeriodStatistics:
+    """Achieved period and jitter of one cyclic message, updated with Welford's algorithm."""
+
+    __slots__ = ("nominal", "count", "mean", "_m2", "min", "max", "late", "_last")
+
+    def __init__(self, nominal):
+        self.nominal = nominal
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.late = 0            # Cycles skipped because the deadline had already passed by a full period
+        self._last = None
+
+    def update(self, timestamp):
+        if self._last is not None:
+            period = timestamp - self._last
+            self.count += 1
+            delta = period - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (period - self.mean)
+            if period < self.min:
+                self.min = period
+            if period > self.max:
+                self.max = period
+        self._last = timestamp
+
+    @property
+    def jitter(self):
+        """Standard deviation of the achieved period in seconds."""
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def as_dict(self):
+        return {"nominal": self.nominal,
+                "count": self.count,
+                "mean": self.mean,
+                "jitter": self.jitter,
+                "min": self.min if self.count else None,
+                "max": self.max if self.count else None,
+                "late": self.late}
+
+
+class _SoftwareTask:
+    """Book-keeping of one message on the software timer."""
+
+    __slots__ = ("message", "period", "deadline", "stats", "active")
+
+    def __init__(self, message, period, deadline):
+        self.message = message
+        self.period = period
+        self.deadline = deadline
+        self.stats = PeriodStatistics(period)
+        self.active = True
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+
+class PeriodicScheduler:
+    """ Keeps cyclic messages alive at the rate declared in their message description.
+
+    Usage:
+        scheduler = PeriodicScheduler(bus)
+        scheduler.schedule(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=1400)
+        scheduler.update(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=800)
+        scheduler.statistics()
+        scheduler.stop_all()
+    """
+
+    def __init__(self, bus, use_hardware=None, clock=time.perf_counter):
+        """
+        :param bus: CAN bus used for transmission
+        :param use_hardware: Force (True) or prevent (False) backend cyclic transmission, None detects it
+        :param clock: Monotonic clock used by the software timer
+        """
+        self.bus = bus
+        self.use_hardware = supports_hardware_periodic(bus) if use_hardware is None else use_hardware
+        self._clock = clock
+        self._hw_tasks = {}
+        self._sw_tasks = {}
+        self._extended_ids = set()
+        self._stats = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._plan = None
+        self._epoch = None
+
+    def apply_plan(self, plan):
+        """ Use the phase offsets of a bus_load.BusLoadPlan for all messages scheduled from now on.
+
+        The planned phases refer to a common epoch, so messages scheduled later still start at their planned slot.
+        """
+        self._plan = plan
+        self._epoch = self._clock()
+
+    def _planned_delay(self, msg_id, period):
+        """Delay until the next planned transmission of a message, None if it is not part of the plan."""
+        phase = self._plan.phase(msg_id) if self._plan is not None else None
+        if phase is None:
+            return None
+        return (self._epoch + phase - self._clock()) % period
+
+    def schedule(self, msg_info, freq=None, phase=None, extended_flag=False, **signals):
+        """ Start cyclic transmission of a message.
+
+        :param msg_info: Dictionary, name or id of the CAN message
+        :param freq: Transmission rate in Hz, defaults to the "freq" of the message description
+        :param phase: Delay of the first transmission in seconds, None uses the applied plan or starts immediately
+        :param extended_flag: Whether the message has an extended CAN id or not
+        :param signals: Signal values of the message
+        :return: Arbitration id of the scheduled message
+        """
+        codec = msg.get_codec(msg_info)
+        message = can.Message(arbitration_id=codec.msg_id, data=codec.encode(**signals), extended_id=extended_flag)
+        return self.schedule_message(message, freq, phase)
+
+    def schedule_message(self, message, freq=None, phase=None):
+        """ Start cyclic transmission of an already loaded message, e.g. the frames of a protocol macro.
+
+        :param message: CAN.Message object
+        :param freq: Transmission rate in Hz, defaults to the "freq" of the message description
+        :param phase: Delay of the first transmission in seconds, None uses the applied plan or starts immediately
+        :return: Arbitration id of the scheduled message
+        """
+        msg_id = message.arbitration_id
+        codec = msg.CODECS_BY_ID.get(msg_id)
+        freq = freq or (codec.freq if codec is not None else None)
+        if not freq:
+            raise ValueError("No transmission rate declared for 0x{:X}".format(msg_id))
+        period = 1.0 / freq
+        if phase is None:
+            phase = self._planned_delay(msg_id, period) or 0.0
+        self.cancel(msg_id)
+        if message.is_extended_id:
+            self._extended_ids.add(msg_id)
+
+        if self.use_hardware and not phase:
+            self._hw_tasks[msg_id] = self.bus.send_periodic(message, period)
+            self._stats[msg_id] = PeriodStatistics(period)
+            logger.debug("Hardware cyclic task started for 0x%X with %s Hz", msg_id, freq)
+        else:
+            with self._cond:
+                task = _SoftwareTask(message, period, self._clock() + phase)
+                self._sw_tasks[msg_id] = task
+                self._stats[msg_id] = task.stats
+                heapq.heappush(self._heap, task)
+                self._start_thread()
+                self._cond.notify()
+            logger.debug("Software cyclic task started for 0x%X with %s Hz", msg_id, freq)
+        return msg_id
+
+    def update(self, msg_info, **signals):
+        """Replace the payload of a scheduled message without restarting its cycle."""
+        codec = msg.get_codec(msg_info)
+        self.update_data(codec.msg_id, codec.encode(**signals))
+
+    def update_data(self, msg_id, payload):
+        """ Replace the raw payload of a scheduled message without restarting its cycle.
+
+        :raises ValueError: The message id is not scheduled
+        """
+        message = can.Message(arbitration_id=msg_id, data=payload, extended_id=msg_id in self._extended_ids)
+        if msg_id in self._hw_tasks:
+            self._hw_tasks[msg_id].modify_data(message)
+        elif msg_id in self._sw_tasks:
+            # Swapping the reference is atomic, the timer thread sends either the old or the new frame
+            self._sw_tasks[msg_id].message = message
+        else:
+            raise ValueError("0x{:X} is not scheduled, it can not be updated".format(msg_id))
+
+    def cancel(self, msg_id):
+        """Stop cyclic transmission of one message id."""
+        task = self._hw_tasks.pop(msg_id, None)
+        if task is not None:
+            task.stop()
+        task = self._sw_tasks.pop(msg_id, None)
+        if task is not None:
+            task.active = False
+        self._extended_ids.discard(msg_id)
+
+    def stop_all(self):
+        for msg_id in list(self._hw_tasks) + list(self._sw_tasks):
+            self.cancel(msg_id)
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def statistics(self):
+        """Achieved period and jitter per arbitration id.
+
+        Cycles of backend tasks are not visible to the scheduler, they only report their nominal period unless the
+        statistics are fed with received frames via observe().
+        """
+        return {msg_id: stats.as_dict() for msg_id, stats in self._stats.items()}
+
+    def observe(self, message):
+        """Feed a received (echoed) frame into the statistics, used to measure backend cyclic tasks on the bus."""
+        stats = self._stats.get(message.arbitration_id)
+        if stats is not None and message.arbitration_id in self._hw_tasks:
+            stats.update(message.timestamp)
+
+    def _start_thread(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="PeriodicScheduler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        clock = self._clock
+        while True:
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                task = self._heap[0]
+                now = clock()
+                if task.deadline - now > 0.002:
+                    # Wake up early for newly scheduled messages
+                    self._cond.wait(task.deadline - now - 0.002)
+                    continue
+                heapq.heappop(self._heap)
+
+            if not task.active:
+                continue
+            sleep_until(task.deadline, clock)
+            timed = METRICS.enabled
+            if timed:
+                start = clock()
+            try:
+                self.bus.send(task.message)
+            except can.CanError as e:
+                logger.error("Cyclic transmission of 0x%X failed: %s", task.message.arbitration_id, e)
+                if METRICS.enabled:
+                    METRICS.count("tx_errors", task.message.arbitration_id)
+            now = clock()
+            if timed:
+                # Lateness is the delay behind the deadline, send the duration of bus.send() as in the runner
+                METRICS.observe("lateness", task.message.arbitration_id, (start - task.deadline) * 1e9)
+                METRICS.observe("send", task.message.arbitration_id, (now - start) * 1e9)
+                METRICS.count("tx_frames", task.message.arbitration_id)
+            task.stats.update(now)
+
+            task.deadline += task.period
+            if now - task.deadline > task.period:
+                missed = int((now - task.deadline) / task.period)
+                task.stats.late += missed
+                task.deadline += missed * task.period
+            with self._cond:
+                heapq.heappush(self._heap, task)
+
+
+def stream_buffer(bus, msg_id, buffer, freq, extended_flag=False, stop_event=None, clock=time.perf_counter):
+    """ Send pre-encoded payloads of one message id at a fixed rate, e.g. a setpoint ramp.
+
+    A single CAN.Message object is reused, only its data bytes are overwritten for every frame. Deadlines are
+    computed from the start time, so the stream does not drift.
+
+    :param bus: CAN bus used for transmission
+    :param msg_id: Arbitration id of all frames
+    :param buffer: Bytes-like object with the concatenated payloads
+    :param freq: Transmission rate in Hz
+    :param extended_flag: Whether the message has an extended CAN id or not
+    :param stop_event: threading.Event to abort the stream
+    :return: PeriodStatistics of the stream
+    """
+    view = memoryview(buffer).cast("B")
+    codec = msg.CODECS_BY_ID.get(msg_id)
+    size = codec.dlc if codec is not None else 8
+    period = 1.0 / freq
+    stats = PeriodStatistics(period)
+    message = can.Message(arbitration_id=msg_id, data=bytes(size), extended_id=extended_flag)
+    data = message.data
+    send = bus.send
+
+    start = clock()
+    for index, offset in enumerate(range(0, len(view) - size + 1, size)):
+        if stop_event is not None and stop_event.is_set():
+            break
+        data[:] = view[offset:offset + size]
+        sleep_until(start + index * period, clock)
+        send(message)
+        stats.update(clock())
+    return stats
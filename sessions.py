@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Calibration sessions run on a CalibrationRunner, started by the calibrate command of calibration.py.
+
+SESSIONS: initialize_bte:  Send the initialization macro, keep it alive and monitor the responses
+          calibrate_bte:   800V sweep with settle detection, journaled and resumable
+
+This module loads the CAN backend, calibration.py only imports it when a session is run.
+"""
+
+import os
+import asyncio
+import logging
+
+import can
+
+import tas_protocol as tas
+import messages as msg
+from runner import CalibrationRunner, StepTimeout, echo_matcher
+from capture import CaptureWriter
+from ring_buffer import FrameRingBuffer, ConsumerThread
+from fit import CalibrationFit
+from bus_load import plan_schedule, ScheduleError
+from bus_pool import BusKey, bus_off
+from journal import SessionJournal, replay, archive, encode_frames
+
+
+logger = logging.getLogger("calibration")
+
+
+MONITOR_TIME = 5.0          # Seconds to monitor the device responses after initialization
+SWEEP = {"points": 17, "shape": "up", "u_min": 0.0, "u_max": 800.0}     # 800V calibration sweep
+APPROACH_SLOPE = 200.0      # V/s, slope_voltage applied by macroBTE_Initialization
+STATUS_MAX_AGE = 0.5        # Seconds, maximum age of the status the error reset is checked against
+
+
+async def setup_bte(runner, frames=None):
+    """ Send the initialization macro and keep the setup messages alive.
+
+    :param frames: Configuration frames to apply instead of the initialization macro, e.g. replayed from a journal
+    :return: List of the applied frames
+    """
+    logger_can = logging.getLogger('canlogger')
+    if frames is None:
+        frames = list(tas.macroBTE_Initialization(slope_u_i_pwr=(200,200,200),
+                                                  limit_mn_u_i_pwr=(0,600,200),
+                                                  limit_mx_u_i_pwr=(0,600,200)))
+    for frame in frames:
+        logger_can.info(frame)
+
+    # One pipelined round trip: send all frames, then await the status or echo confirmations together.
+    # The status layouts are only trusted on simulated devices until they are verified.
+    echo = echo_matcher if runner.rx_bus is not runner.bus else None
+    use_status = msg.STATUS_LAYOUTS_VERIFIED or tas.simulated(runner.bus)
+    if use_status:
+        frames = await _checked_reset(runner, frames)
+    result = await runner.send_macro_batch(frames, verify=lambda frame: tas.response_matcher(frame, echo, use_status))
+    logger.info("Initialization: %d frames sent, %d confirmed, %d attempts", result.sent, len(result.confirmed),
+                result.attempts)
+
+    # The error reset is sent once, repeating it would reset later errors without checking the status again
+    rst_id = msg.SET_RST_STOP["msg_id"]
+    cyclic = [frame for frame in frames if frame.arbitration_id != rst_id]
+
+    # Stagger the cyclic messages, the 0xC1 setpoint of the sweep is reserved in the plan
+    plan = plan_schedule([frame.arbitration_id for frame in cyclic] + [msg.SET_REF_SWITCH_CTRL_RI],
+                         tas.CAN_BITRATE, external=[msg.STATUS_SYSTEM, msg.STATUS_MEAS_U_I,
+                                                    msg.STATUS_ERR_STANDBY, msg.STATUS_ERR_CRITICAL])
+    logger.info("Bus load %.1f %%, peak burst %d frames (%d without phase offsets)", 100 * plan.utilization,
+                plan.peak_burst, plan.unstaggered_peak_burst)
+    runner.scheduler.apply_plan(plan)
+    for frame in cyclic:
+        runner.scheduler.schedule_message(frame)   # Keep setup messages alive at their declared rate
+    return frames
+
+
+async def _checked_reset(runner, frames):
+    """ Replace the SET_RST_STOP frame of a macro by tas.reset_stop() checked against the status cache.
+
+    The reset is left out if the error state of the device does not allow it or the status is not received in time.
+    """
+    rst_id = msg.SET_RST_STOP["msg_id"]
+    if not any(frame.arbitration_id == rst_id for frame in frames):
+        return frames
+    cache = runner.status_cache
+    deadline = runner.loop.time() + runner.step_timeout
+    while (not all(cache.is_fresh(msg_id, STATUS_MAX_AGE) for msg_id in cache.msg_ids)
+           and runner.loop.time() < deadline):
+        await asyncio.sleep(0.01)
+
+    checked = []
+    for frame in frames:
+        if frame.arbitration_id == rst_id:
+            frame = tas.reset_stop(frame.data[0], cache, STATUS_MAX_AGE, bus=runner.bus)
+            if frame is None:
+                logger.warning("Error reset left out of the initialization")
+                continue
+        checked.append(frame)
+    return checked
+
+
+async def initialize_bte(runner):
+    """Calibration session: send the initialization macro, keep it alive and monitor the responses."""
+    await setup_bte(runner)
+    await asyncio.sleep(MONITOR_TIME)
+    logger.info("Cyclic message statistics: %s", runner.scheduler.statistics())
+
+
+def _open_journal(runner, journal_dir):
+    """ Session journal of the unit and the replayed state of an unfinished session with the same sweep.
+
+    Any other journal of the unit is archived, see journal.archive().
+    """
+    serial = runner.unit.serial if runner.unit is not None else "bte"
+    os.makedirs(journal_dir, exist_ok=True)
+    filename = os.path.join(journal_dir, "{}.journal".format(serial))
+    state = replay(filename)
+    if state is not None and (state.done or state.session is None or state.session.get("sweep") != SWEEP):
+        # Finished or not resumable, the new session starts its own journal
+        archive(filename)
+        state = None
+    if state is not None:
+        logger.info("Resuming unit %s after %d completed points", serial, state.completed_points)
+    return SessionJournal(filename, resume=state is not None), state
+
+
+async def calibrate_bte(runner, journal_dir=None):
+    """ Calibration session: 800V voltage sweep with settle detection.
+
+    Every point ends as soon as the measured voltage settled. The settled means are fitted against the setpoints.
+    With a journal directory, the applied configuration, every completed point and the fit state are journaled.
+    An interrupted session of the same unit is resumed: the journaled configuration is applied again and the sweep
+    continues after the last completed point.
+
+    The sweep only runs on simulated devices until the register values and the status layouts are verified, see
+    tas.REGISTERS_VERIFIED and msg.STATUS_LAYOUTS_VERIFIED.
+
+    :param journal_dir: Directory of the session journals, one file per unit serial
+    :return: Dictionary with the fit coefficients and the settle report (time saved against the fixed dwell)
+    """
+    # Checked before the journal is opened, a refused run must not overwrite the journal of the unit
+    tas.require_simulated(runner.bus, "800V sweep", tas.REGISTERS_VERIFIED and msg.STATUS_LAYOUTS_VERIFIED)
+    journal, state = _open_journal(runner, journal_dir) if journal_dir else (None, None)
+    try:
+        return await _sweep(runner, journal, state)
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+async def _sweep(runner, journal, state):
+    frames = await setup_bte(runner, state.config if state is not None and state.config_frames else None)
+    if journal is not None and state is None:
+        journal.append("session", sweep=SWEEP)
+        journal.append("config", frames=encode_frames(frames))
+
+    if state is not None and state.fit is not None:
+        fit = CalibrationFit.from_state(state.fit)
+    else:
+        fit = CalibrationFit(signals=("voltage",))
+
+    def on_point(point):
+        # A point taken after max_dwell is recorded with its settled flag, but it is not fitted
+        if point.settled:
+            fit.update("voltage", point.setpoint, point.mean)
+        else:
+            logger.warning("Point %.1f V not settled after %.2f s (mean %.2f V, std %.3f V), left out of the fit",
+                           point.setpoint, point.dwell, point.mean, point.std)
+        if journal is not None:
+            journal.append("point", index=len(sequencer.points) - 1, point=point._asdict(), fit=fit.state())
+
+    sequencer = tas.macroBTE_Calibrate800V_Adaptive(on_point=on_point, **SWEEP)
+    approach = 0.0
+    if state is not None:
+        # The device starts again from 0 V, the next point gets the time to ramp up
+        if state.completed_points < len(sequencer.setpoints):
+            approach = abs(sequencer.setpoints[state.completed_points]) / APPROACH_SLOPE
+        sequencer.resume(state.points, approach_dwell=approach)
+    finished = asyncio.Event()
+    codec = msg.get_codec(msg.STATUS_MEAS_U_I)
+    ref_id = msg.SET_REF_SWITCH_CTRL_RI["msg_id"]
+
+    def on_measurement(message):
+        meas_voltage, _ = codec.unpack(bytes(message.data))
+        if sequencer.feed(message.timestamp, meas_voltage):
+            if sequencer.done:
+                runner.loop.call_soon_threadsafe(finished.set)
+            else:
+                runner.scheduler.update_data(ref_id, sequencer.payload)
+
+    if not sequencer.done:
+        # The setpoint is on the bus before measurements are fed, they would otherwise open the first point with
+        # responses to the previous state. A recorded hold starts with its setpoint frame as well.
+        setpoint = can.Message(arbitration_id=ref_id, data=sequencer.payload, extended_id=False)
+        await runner.send(setpoint)
+        runner.subscribe(codec.msg_id, on_measurement)
+        runner.scheduler.schedule_message(setpoint)
+        timeout = (len(sequencer.setpoints) - sequencer.index) * (sequencer.max_dwell + 0.5) + approach
+        await runner.step(finished.wait(), timeout=timeout, name="800V sweep")
+        runner.stop_cyclic(ref_id)
+
+    report = sequencer.report()
+    logger.info("800V sweep finished: %d points, %.2f s dwell, %.2f s saved", report["points"],
+                report["dwell_total"], report["time_saved"])
+    result = {"fit": fit.coefficients(), "settle": report, "points": [point._asdict() for point in sequencer.points]}
+    if journal is not None:
+        journal.append("done", result=result)
+    return result
+
+
+def open_device(loopback=True, pool=None):
+    """ Create the CAN device based on available configuration methodes.
+
+    Only the root directory can be used to load the interface configuration.
+    Otherwise an error is raised when creating the can.Bus() object.
+
+    :param loopback: Receive on a second interface channel, for sw-testing
+    :param pool: BusPool the buses are leased from, None opens new buses
+    :return: Tuple of the transmit and the receive bus, None if the device could not be created
+    """
+    try:
+        if os.path.exists("can.ini"):
+            logger.debug("Loading CAN device settings from file")
+            config = can.util.load_file_config()
+            if pool is None:
+                can_device = can.Bus()
+            else:
+                config = can.util.load_config(config=config)
+                key = BusKey(config["interface"], config["channel"], config.get("bitrate"))
+                can_device = pool.acquire(*key)
+        else:
+            logger.warning("CAN device configuration file not found")
+            if pool is None:
+                can.rc["interface"] = tas.CAN_INTERFACE
+                can.rc["channel"] = tas.CAN_CHANNEL
+                can.rc["bitrate"] = tas.CAN_BITRATE
+                can_device = can.interface.Bus()
+            else:
+                key = BusKey(tas.CAN_INTERFACE, tas.CAN_CHANNEL, tas.CAN_BITRATE)
+                can_device = pool.acquire(*key)
+    except can.CanError as e:
+        logger.error("Failure during creating CAN device %s", e)
+        return None
+    logger.info("CAN device created: %s", can_device)
+
+    rx_device = can_device
+    if loopback:
+        if pool is None:
+            rx_device = can.interface.Bus(bustype=tas.CAN_DEVICES["kvaser"],
+                                          channel=1,
+                                          bitrate=tas.CAN_BITRATES["500K"])
+        elif key != BusKey(tas.CAN_DEVICES["kvaser"], 1, tas.CAN_BITRATES["500K"]):
+            # A bus is leased once, the same channel would wait for itself
+            try:
+                rx_device = pool.acquire(tas.CAN_DEVICES["kvaser"], 1, tas.CAN_BITRATES["500K"])
+            except can.CanError as e:
+                logger.error("Failure during creating loopback device %s", e)
+                pool.release(can_device)
+                return None
+        logger.debug("Loopback-Interface: %s", rx_device)
+    return can_device, rx_device
+
+
+def release_device(can_device, rx_device, pool):
+    """ Give the buses of open_device() back to the pool, a bus in error state is reconnected on its next lease.
+
+    :param pool: BusPool the buses were leased from
+    """
+    for bus in {id(can_device): can_device, id(rx_device): rx_device}.values():
+        pool.release(bus, failed=bus_off(bus))
+
+
+def run_device_session(can_device, rx_device, capture="test.btecap", metadata=None, pool=None):
+    """ Initialize the device on the configured CAN interface, monitor it and capture the traffic.
+
+    The capture is closed and the buses are released however the session ends.
+    :param capture: File name of the capture of all received frames
+    :param metadata: JSON serializable metadata of the capture, e.g. software version
+    :param pool: BusPool the buses were leased from by open_device(), they are released to it at the end
+    :return: True if the session finished without error
+    """
+    logger.info("*** BTE Calibration Tool ***\n")
+    logger_can = logging.getLogger('canlogger')
+    logger_can.debug("CAN LOGGER created")
+
+    async def session(runner):
+        runner.add_reader_listener(ring)
+        # Frames are only logged with debug output enabled, otherwise the dispatcher has no handler to call
+        if logger_can.isEnabledFor(logging.DEBUG):
+            for msg_id in msg.CODECS_BY_ID:
+                runner.subscribe(msg_id, logger_can.debug)
+        # Drop traffic of other nodes before it reaches Python, the known messages pass for the capture
+        runner.apply_filters(extra_ids=msg.CODECS_BY_ID)
+        await initialize_bte(runner)
+
+    ok = False
+    capture_thread = None
+    l = None
+    try:
+        l = CaptureWriter(capture, metadata=metadata)
+        # The capture is written from a ring buffer, a slow disk can not stall the receive path
+        ring = FrameRingBuffer(capacity=65536)
+        capture_thread = ConsumerThread(ring, l.write_batch)
+
+        CalibrationRunner.run_session(can_device, session, rx_bus=rx_device)
+        logger.info("Program will quit here")
+        ok = True
+
+    except can.CanError as e:
+        logger.error("Error occurred while CAN interface was active. %s", e)
+
+    except StepTimeout as e:
+        logger.error("Calibration step failed. %s", e)
+
+    except ScheduleError as e:
+        logger.error("Cyclic messages do not fit on the bus. %s", e)
+
+    except KeyboardInterrupt:
+        logger.info("User quit program!")
+
+    finally:
+        # Any other error still stops the capture thread and gives the buses back
+        if capture_thread is not None:
+            capture_thread.stop()
+            if ring.overflow_counts():
+                logger.warning("Frames lost in capture buffer: %s", ring.overflow_counts())
+        if l is not None:
+            l.stop()
+        if pool is not None:
+            release_device(can_device, rx_device, pool)
+    print("Program exit")
+    return ok
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Settle detection to end calibration dwells early.
+
+SettleDetector keeps running sums over a sliding time window of the measured signal, so mean, variance and slope
+(least squares over the window) cost O(1) per sample. A point counts as settled when the window is filled, the
+standard deviation is within the tolerance and the slope is within the slope tolerance.
+
+AdaptiveDwellSequencer walks through the setpoints of a sweep and advances as soon as the measurement is settled, or
+after max_dwell at the latest. With a setpoint tolerance, a settled window only counts if its mean is close to the
+setpoint: a device with dead time still shows the flat plateau of the previous point after a step, which is settled
+as well. The sequencer records the settled mean of every point and the time saved compared to a fixed dwell of
+max_dwell per point.
+"""
+
+import collections
+import math
+
+
+class SettleDetector:
+    """ Rolling mean, variance and slope of a measured signal over a sliding time window.
+
+    :param window: Length of the sliding window in seconds
+    :param tolerance: Maximum standard deviation within the window
+    :param slope_tolerance: Maximum absolute slope in units per second
+    """
+
+    def __init__(self, window=0.1, tolerance=0.5, slope_tolerance=1.0):
+        self.window = window
+        self.tolerance = tolerance
+        self.slope_tolerance = slope_tolerance
+        self.reset()
+
+    def reset(self):
+        self._samples = collections.deque()
+        self._t0 = None
+        self._s_t = self._s_y = self._s_tt = self._s_ty = self._s_yy = 0.0
+
+    def update(self, t, y):
+        """ Add one sample.
+
+        :return: True if the signal is settled
+        """
+        if self._t0 is None:
+            self._t0 = t
+        t -= self._t0       # Small time values keep the running sums precise
+        self._samples.append((t, y))
+        self._s_t += t
+        self._s_y += y
+        self._s_tt += t * t
+        self._s_ty += t * y
+        self._s_yy += y * y
+        while self._samples and t - self._samples[0][0] > self.window:
+            old_t, old_y = self._samples.popleft()
+            self._s_t -= old_t
+            self._s_y -= old_y
+            self._s_tt -= old_t * old_t
+            self._s_ty -= old_t * old_y
+            self._s_yy -= old_y * old_y
+        return self.settled
+
+    @property
+    def filled(self):
+        """True if the samples span (almost) the whole window."""
+        return len(self._samples) > 2 and self._samples[-1][0] - self._samples[0][0] >= 0.9 * self.window
+
+    @property
+    def mean(self):
+        return self._s_y / len(self._samples) if self._samples else float("nan")
+
+    @property
+    def variance(self):
+        n = len(self._samples)
+        if n < 2:
+            return float("nan")
+        return max(self._s_yy - self._s_y * self._s_y / n, 0.0) / (n - 1)
+
+    @property
+    def slope(self):
+        n = len(self._samples)
+        denominator = n * self._s_tt - self._s_t * self._s_t
+        if n < 2 or denominator <= 0:
+            return float("nan")
+        return (n * self._s_ty - self._s_t * self._s_y) / denominator
+
+    @property
+    def settled(self):
+        return (self.filled and math.sqrt(self.variance) <= self.tolerance
+                and abs(self.slope) <= self.slope_tolerance)
+
+    def settled_at(self, setpoint, setpoint_tolerance=None):
+        """True if the signal is settled and, with a setpoint tolerance, its mean is that close to the setpoint."""
+        return self.settled and (setpoint_tolerance is None or abs(self.mean - setpoint) <= setpoint_tolerance)
+
+
+"""Result of one calibration point"""
+SettledPoint = collections.namedtuple("SettledPoint", "setpoint mean std dwell settled")
+
+
+class AdaptiveDwellSequencer:
+    """ Steps through the setpoints of a sweep, advancing as soon as the measurement settled.
+
+    :param setpoints: List of setpoints
+    :param detector: SettleDetector, reset at every new setpoint
+    :param max_dwell: Maximum time per point in seconds, the point is taken unsettled afterwards
+    :param min_dwell: Minimum time per point in seconds
+    :param setpoint_tolerance: Maximum distance of the settled mean from the setpoint, None accepts any settled mean
+    :param payloads: Optional pre-encoded frame payload per setpoint, see payload
+    :param on_point: Callback on_point(SettledPoint) after every finished point
+    """
+
+    def __init__(self, setpoints, detector, max_dwell=0.5, min_dwell=0.0, payloads=None, on_point=None,
+                 setpoint_tolerance=None):
+        self.setpoints = list(setpoints)
+        self.payloads = payloads
+        self.detector = detector
+        self.max_dwell = max_dwell
+        self.min_dwell = min_dwell
+        self.setpoint_tolerance = setpoint_tolerance
+        self.on_point = on_point
+        self.index = 0
+        self.points = []
+        self._point_start = None
+        self._approach_dwell = 0.0
+
+    @property
+    def done(self):
+        return self.index >= len(self.setpoints)
+
+    @property
+    def setpoint(self):
+        return self.setpoints[self.index] if not self.done else None
+
+    @property
+    def payload(self):
+        return self.payloads[self.index] if self.payloads is not None and not self.done else None
+
+    def resume(self, points, approach_dwell=0.0):
+        """ Continue after already completed points, e.g. replayed from a session journal.
+
+        :param points: List of SettledPoint or of dictionaries with the same fields
+        :param approach_dwell: Additional maximum dwell of the next point, the device may have to ramp to it first
+        """
+        self.points = [point if isinstance(point, SettledPoint) else SettledPoint(**point) for point in points]
+        self.index = len(self.points)
+        self.detector.reset()
+        self._point_start = None
+        self._approach_dwell = approach_dwell
+
+    def feed(self, t, measured):
+        """ Add a measurement taken at time t.
+
+        :return: True if the sequencer advanced to the next setpoint (or finished)
+        """
+        if self.done:
+            return False
+        if self._point_start is None:
+            self._point_start = t
+        self.detector.update(t, measured)
+        settled = self.detector.settled_at(self.setpoint, self.setpoint_tolerance)
+        dwell = t - self._point_start
+        if dwell < self.min_dwell or (not settled and dwell < self.max_dwell + self._approach_dwell):
+            return False
+
+        point = SettledPoint(self.setpoint, self.detector.mean, math.sqrt(self.detector.variance), dwell, settled)
+        self.points.append(point)
+        if self.on_point is not None:
+            self.on_point(point)
+        self.index += 1
+        self.detector.reset()
+        self._point_start = t
+        self._approach_dwell = 0.0
+        return True
+
+    def report(self):
+        """Dwell statistics of the finished points and the time saved against a fixed max_dwell."""
+        total = sum(point.dwell for point in self.points)
+        return {"points": len(self.points),
+                "unsettled": sum(1 for point in self.points if not point.settled),
+                "dwell_total": total,
+                "time_saved": len(self.points) * self.max_dwell - total}
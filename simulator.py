@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Simulated E-Storage BTE on a python-can virtual bus.
+
+The simulator understands the messages of messages.py: it applies slopes, operational and protection limits,
+clearance and set_rst_stop, follows the 0xC1 setpoints with a first-order response plus measurement noise and sends
+the status frames STATUS_SYSTEM (0x288), STATUS_MEAS_U_I, STATUS_ERR_STANDBY (0x518) and STATUS_ERR_CRITICAL (0x528)
+at their declared rates. Gain and offset errors of the simulated measurement give the calibration something to find.
+
+Usage:
+    with SimulatorFarm(4, channel_prefix="bte") as farm:      # channels bte0 .. bte3
+        ...
+
+rate_factor multiplies all status rates, e.g. rate_factor=5 loads the receive path with five times the real traffic.
+"""
+
+import math
+import random
+import struct
+import threading
+import time
+import logging
+
+import can
+
+import messages as msg
+import tas_protocol as tas
+from scheduler import sleep_until
+
+
+logger = logging.getLogger("calibration.simulator")
+
+
+"""Standby error bits sent in STATUS_ERR_STANDBY"""
+ERR_OVERVOLTAGE = 0x01
+ERR_OVERCURRENT = 0x02
+ERR_NO_CLEARANCE = 0x04
+
+
+class SimulatedBTE:
+    """ One simulated BTE attached to a virtual CAN channel.
+
+    :param channel: Virtual bus channel of the device
+    :param tau: Time constant of the first-order voltage response in seconds
+    :param noise: Standard deviation of the voltage measurement noise in V
+    :param gain_error: Relative gain error of the voltage measurement
+    :param offset_error: Offset error of the voltage measurement in V
+    :param load: Load resistance in Ohm, defines the current for a voltage
+    :param rate_factor: Multiplier of all status rates
+    :param seed: Seed of the noise generator
+    """
+
+    def __init__(self, channel, tau=0.05, noise=0.2, gain_error=0.002, offset_error=0.5, load=10.0,
+                 rate_factor=1.0, seed=None, interface="virtual"):
+        self.channel = channel
+        self.tau = tau
+        self.noise = noise
+        self.gain_error = gain_error
+        self.offset_error = offset_error
+        self.load = load
+        self.rate_factor = rate_factor
+        self._random = random.Random(seed)
+        self._interface = interface
+        self.bus = None
+
+        self.op_state = tas.SWITCH_OFF
+        self.ctrl_mode = 0
+        self.clearance = 0
+        self.rst_stop = 0
+        self.standby_errors = 0
+        self.critical_errors = 0
+        self.setpoint = 0.0
+        self.reference = 0.0            # Setpoint after the slope limitation
+        self.voltage = 0.0
+        self.slope_voltage = math.inf
+        self.op_lim_u = (-math.inf, math.inf)
+        self.op_lim_i = (-math.inf, math.inf)
+        self.pr_lim_u = (-math.inf, math.inf)
+        self.pr_lim_i = (-math.inf, math.inf)
+        self.frames_received = 0
+        self.frames_sent = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._handlers = {msg.SET_SLOPE_U_I["msg_id"]: self._on_slope_u_i,
+                          msg.SET_OP_LIM_U["msg_id"]: self._on_limit("op_lim_u", msg.SET_OP_LIM_U),
+                          msg.SET_OP_LIM_I["msg_id"]: self._on_limit("op_lim_i", msg.SET_OP_LIM_I),
+                          msg.SET_PR_LIM_U["msg_id"]: self._on_limit("pr_lim_u", msg.SET_PR_LIM_U),
+                          msg.SET_PR_LIM_I["msg_id"]: self._on_limit("pr_lim_i", msg.SET_PR_LIM_I),
+                          msg.CLEARANCE["msg_id"]: self._on_clearance,
+                          msg.SET_RST_STOP["msg_id"]: self._on_rst_stop,
+                          msg.SET_REF_SWITCH_CTRL_RI["msg_id"]: self._on_ref_switch_ctrl_ri}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.bus = can.interface.Bus(bustype=self._interface, channel=self.channel)
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._receive, name="BTE-rx-{}".format(self.channel), daemon=True),
+                         threading.Thread(target=self._transmit, name="BTE-tx-{}".format(self.channel), daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        logger.debug("Simulated BTE started on channel %s", self.channel)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.bus is not None:
+            self.bus.shutdown()
+            self.bus = None
+
+    def inject_error(self, standby=0, critical=0):
+        """Set error bits as if the device detected them."""
+        with self._lock:
+            self.standby_errors |= standby
+            self.critical_errors |= critical
+            self._apply_errors()
+
+    """ R E C E I V E   P A T H """
+
+    def _receive(self):
+        while not self._stop.is_set():
+            message = self.bus.recv(0.05)
+            if message is None:
+                continue
+            handler = self._handlers.get(message.arbitration_id)
+            if handler is None:
+                continue
+            self.frames_received += 1
+            codec = msg.CODECS_BY_ID[message.arbitration_id]
+            try:
+                values = codec.unpack(bytes(message.data))
+            except struct.error:
+                logger.warning("Simulated BTE %s received malformed frame %s", self.channel, message)
+                continue
+            with self._lock:
+                handler(*values)
+
+    def _on_slope_u_i(self, slope_voltage, slope_current):
+        self.slope_voltage = slope_voltage if slope_voltage > 0 else math.inf
+
+    def _on_limit(self, name, msg_info):
+        # Limits are taken by signal name as sent, a swapped field order shows up as an inverted limit
+        fields = msg.get_codec(msg_info).fields
+        mn_index = next(index for index, field in enumerate(fields) if field.endswith("_mn"))
+        mx_index = next(index for index, field in enumerate(fields) if field.endswith("_mx"))
+
+        def handler(*values):
+            if values[mn_index] > values[mx_index]:
+                logger.warning("Simulated BTE %s received inverted limit %s: %s > %s", self.channel, name,
+                               values[mn_index], values[mx_index])
+            setattr(self, name, (values[mn_index], values[mx_index]))
+        return handler
+
+    def _on_clearance(self, clearance):
+        self.clearance = clearance
+        if not clearance and self.op_state == tas.SWITCH_ON:
+            self.standby_errors |= ERR_NO_CLEARANCE
+            self._apply_errors()
+
+    def _on_rst_stop(self, rst_stop):
+        self.rst_stop = rst_stop
+        # Standby errors can only be reset in OFF or STANDBY, critical errors only in OFF
+        if rst_stop and self.op_state in (tas.SWITCH_OFF, tas.SWITCH_STANDBY):
+            self.standby_errors = 0
+        if rst_stop and self.op_state == tas.SWITCH_OFF:
+            self.critical_errors = 0
+
+    def _on_ref_switch_ctrl_ri(self, set_ref, reg_ctrl, set_ri):
+        switch = reg_ctrl & 0x07
+        self.ctrl_mode = (reg_ctrl >> 3) & 0x07
+        self.setpoint = set_ref
+        if switch == tas.SWITCH_ON and (self.standby_errors or self.critical_errors or not self.clearance):
+            switch = self.op_state if self.op_state != tas.SWITCH_ON else tas.SWITCH_STANDBY
+        self.op_state = switch
+
+    def _apply_errors(self):
+        if self.critical_errors:
+            self.op_state = tas.SWITCH_OFF
+        elif self.standby_errors and self.op_state == tas.SWITCH_ON:
+            self.op_state = tas.SWITCH_STANDBY
+
+    """ T R A N S M I T   P A T H """
+
+    def _step(self, dt):
+        """Advance the device model by dt seconds, return measured voltage and current."""
+        target = self.setpoint if self.op_state == tas.SWITCH_ON else 0.0
+        target = min(max(target, self.op_lim_u[0]), self.op_lim_u[1])
+        max_change = self.slope_voltage * dt
+        self.reference += min(max(target - self.reference, -max_change), max_change)
+        self.voltage += (self.reference - self.voltage) * (1.0 - math.exp(-dt / self.tau))
+
+        current = min(max(self.voltage / self.load, self.op_lim_i[0]), self.op_lim_i[1])
+        if not self.pr_lim_u[0] <= self.voltage <= self.pr_lim_u[1]:
+            self.standby_errors |= ERR_OVERVOLTAGE
+            self._apply_errors()
+        if not self.pr_lim_i[0] <= current <= self.pr_lim_i[1]:
+            self.standby_errors |= ERR_OVERCURRENT
+            self._apply_errors()
+
+        meas_voltage = (self.voltage * (1.0 + self.gain_error) + self.offset_error
+                        + self._random.gauss(0.0, self.noise))
+        meas_current = current + self._random.gauss(0.0, self.noise / self.load)
+        return meas_voltage, meas_current
+
+    def _transmit(self):
+        meas = msg.get_codec(msg.STATUS_MEAS_U_I)
+        status = msg.get_codec(msg.STATUS_SYSTEM)
+        standby = msg.get_codec(msg.STATUS_ERR_STANDBY)
+        critical = msg.get_codec(msg.STATUS_ERR_CRITICAL)
+        period = 1.0 / (meas.freq * self.rate_factor)
+        status_every = max(1, int(round(meas.freq / status.freq)))
+
+        tick = 0
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            sleep_until(start + tick * period)
+            with self._lock:
+                frames = [(meas.msg_id, meas.pack(*self._step(period)))]
+                if tick % status_every == 0:
+                    frames.append((status.msg_id, status.pack(self.op_state, self.ctrl_mode,
+                                                              self.clearance, self.rst_stop)))
+                    frames.append((standby.msg_id, standby.pack(self.standby_errors)))
+                    frames.append((critical.msg_id, critical.pack(self.critical_errors)))
+            for msg_id, payload in frames:
+                try:
+                    self.bus.send(can.Message(arbitration_id=msg_id, data=payload, extended_id=False))
+                    self.frames_sent += 1
+                except can.CanError as e:
+                    logger.error("Simulated BTE %s could not send: %s", self.channel, e)
+            tick += 1
+
+
+class SimulatorFarm:
+    """ Several simulated BTEs on the channels channel_prefix0 .. channel_prefixN-1.
+
+    :param channels: Number of devices or list of channel names
+    :param channel_prefix: Prefix of the virtual channel names if only the number of devices is given
+    :param kwargs: Arguments for every SimulatedBTE
+    """
+
+    def __init__(self, channels, channel_prefix="bte", **kwargs):
+        if isinstance(channels, int):
+            channels = ["{}{}".format(channel_prefix, index) for index in range(channels)]
+        self.devices = [SimulatedBTE(channel, seed=index, **kwargs) for index, channel in enumerate(channels)]
+
+    @property
+    def channels(self):
+        return [device.channel for device in self.devices]
+
+    def __enter__(self):
+        for device in self.devices:
+            device.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for device in self.devices:
+            device.stop()
+
+    def statistics(self):
+        return {device.channel: {"received": device.frames_received, "sent": device.frames_sent}
+                for device in self.devices}
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+Latest-value cache of the status messages sent by the BTE.
+
+The cache is a can.Listener, every CalibrationRunner attaches one to its Notifier (runner.status_cache). For every
+status message it keeps the decoded fields, the timestamp and a sequence number of the last received frame. An entry
+is an immutable tuple that is replaced as a whole, so readers never need a lock and always see a consistent entry.
+
+The status layouts are not yet verified against the manual (see messages.STATUS_LAYOUTS_VERIFIED), until then only
+decisions on simulated devices may rely on the cache.
+
+Usage:
+    cache = StatusCache()
+    notifier.add_listener(cache)
+    if cache.is_fresh(0x518, max_age=0.5):
+        errors = cache.get(0x518).fields["standby_errors"]
+"""
+
+import collections
+import struct
+import time
+import logging
+
+import can
+
+import messages as msg
+
+
+logger = logging.getLogger("calibration.status_cache")
+
+
+STATUS_IDS = (msg.STATUS_SYSTEM["msg_id"], msg.STATUS_ERR_STANDBY["msg_id"], msg.STATUS_ERR_CRITICAL["msg_id"])
+
+
+"""Cache entry: decoded fields, bus timestamp, local receive time (time.monotonic) and sequence number"""
+StatusEntry = collections.namedtuple("StatusEntry", "fields timestamp received sequence")
+
+
+class StaleStatus(Exception):
+    """Raised when a status is missing or older than the allowed age."""
+    pass
+
+
+class StatusCache(can.Listener):
+    """ Background-updated latest-value cache of status messages.
+
+    :param msg_ids: Arbitration ids of the cached status messages
+    :param clock: Clock of the receive time, must match the clock used for freshness checks
+    """
+
+    def __init__(self, msg_ids=STATUS_IDS, clock=time.monotonic):
+        self.msg_ids = tuple(msg_ids)
+        self._codecs = {msg_id: msg.CODECS_BY_ID[msg_id] for msg_id in msg_ids}
+        self._entries = dict.fromkeys(msg_ids)
+        self._clock = clock
+        self.malformed = collections.Counter()      # Frames with a payload not matching the layout, per id
+
+    def on_message_received(self, message):
+        codec = self._codecs.get(message.arbitration_id)
+        if codec is None:
+            return
+        try:
+            fields = codec.decode(bytes(message.data))
+        except struct.error:
+            # The previous entry is kept, it becomes stale if no valid frame follows
+            self.malformed[codec.msg_id] += 1
+            logger.warning("Malformed status frame %s", message)
+            return
+        previous = self._entries[codec.msg_id]
+        self._entries[codec.msg_id] = StatusEntry(fields, message.timestamp, self._clock(),
+                                                  previous.sequence + 1 if previous else 1)
+
+    def get(self, msg_id):
+        """Last entry of a status message, None if it was not received yet."""
+        return self._entries.get(msg_id)
+
+    def age(self, msg_id):
+        """Seconds since the last frame of a status message was received, infinite if never received."""
+        entry = self._entries.get(msg_id)
+        return self._clock() - entry.received if entry is not None else float("inf")
+
+    def is_fresh(self, msg_id, max_age):
+        return self.age(msg_id) <= max_age
+
+    def fields(self, msg_id, max_age=None):
+        """ Decoded fields of a status message.
+
+        :raises StaleStatus: If the status was not received within max_age seconds
+        """
+        entry = self._entries.get(msg_id)
+        if entry is None or (max_age is not None and self._clock() - entry.received > max_age):
+            raise StaleStatus("Status 0x{:X} not received within {} s".format(msg_id, max_age))
+        return entry.fields
+
+    def snapshot(self, max_age=None):
+        """ Merged fields of all cached status messages.
+
+        :raises StaleStatus: If one of the status messages is missing or too old
+        """
+        merged = {}
+        for msg_id in self._entries:
+            merged.update(self.fields(msg_id, max_age))
+        return merged
@@ -7,11 +7,16 @@
 
 """
 
+import collections
+from struct import pack
+
+from can import Message
+from can.interfaces.virtual import VirtualBus
+
 import messages as msg
 import logging
 
 logger = logging.getLogger("calibration.protocol")
-logger.setLevel(logging.DEBUG)
 
 
 """Available CAN bitrates for communication"""
@@ -35,6 +40,41 @@ CAN_CHANNEL = 0
 CAN_BITRATE = CAN_BITRATES["500K"]
 
 
+"""Register values of SET_REF_SWITCH_CTRL_RI.
+
+The values are not yet checked against the manual, the simulator implements the same assumption. Until
+REGISTERS_VERIFIED is set, frames built from them are only sent to simulated devices (see require_simulated), the 800V
+sweep switches a real device on and ramps it to high voltage.
+"""
+SWITCH_OFF = 0
+SWITCH_STANDBY = 1
+SWITCH_ON = 2
+CTRL_VOLTAGE = 1
+REGISTERS_VERIFIED = False
+
+
+class UnverifiedProtocol(Exception):
+    """Protocol values not verified against the manual would be sent to a hardware device."""
+    pass
+
+
+def simulated(bus):
+    """True if the bus is a virtual bus, the devices on it are simulated."""
+    return isinstance(bus, VirtualBus)
+
+
+def require_simulated(bus, name, verified):
+    """ Refuse to run a step with unverified protocol values on hardware.
+
+    :param name: Name of the step, used in the error message
+    :param verified: Whether the protocol values used by the step are verified against the manual
+    :raises UnverifiedProtocol: The values are not verified and the bus is not virtual
+    """
+    if not verified and not simulated(bus):
+        raise UnverifiedProtocol("{} uses protocol values not verified against the manual, it only runs on the "
+                                 "simulator (bus {})".format(name, getattr(bus, "channel_info", bus)))
+
+
 """
 
     P R E - D E F I N E D   M A C R O S   F O R   C A L I B R  A T I O N
@@ -66,12 +106,12 @@ def macroBTE_Initialization(slope_u_i_pwr: tuple, limit_mn_u_i_pwr: tuple, limit
 
     yield msg.load_message(msg.SET_SLOPE_U_I, slope_voltage=200, slope_current=200)
     yield msg.load_message(msg.SET_SLOPE_PWR_FILTER, slope_power=200, filter=0)
-    yield msg.load_message(msg.SET_OP_LIM_U, U_MX=1400, U_MIN=0)
-    yield msg.load_message(msg.SET_OP_LIM_I, I_MN=-900, I_MX=900)
-    yield msg.load_message(msg.SET_OP_LIM_PWR, PWR_MN=-500, PWR_MX=500)
-    yield msg.load_message(msg.SET_PR_LIM_I, I_MN=-900, I_MX=900)
-    yield msg.load_message(msg.SET_PR_LIM_PWR, PWR_MN=-500, PWR_MX=500)
-    yield msg.load_message(msg.SET_PR_LIM_U, U_MN=0, U_MX=1400)
+    yield msg.load_message(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=1400)
+    yield msg.load_message(msg.SET_OP_LIM_I, op_lim_i_mn=-900, op_lim_i_mx=900)
+    yield msg.load_message(msg.SET_OP_LIM_PWR, op_lim_p_mn=-500, op_lim_p_mx=500)
+    yield msg.load_message(msg.SET_PR_LIM_I, op_lim_i_mn=-900, op_lim_i_mx=900)
+    yield msg.load_message(msg.SET_PR_LIM_PWR, op_lim_p_mn=-500, op_lim_p_mx=500)
+    yield msg.load_message(msg.SET_PR_LIM_U, op_lim_u_mn=0, op_lim_u_mx=1400)
     yield msg.load_message(msg.CLEARANCE, clearance=1)
     yield msg.load_message(msg.SET_RST_STOP, rst_stop=1)
     """Missing messages for initialization: send_msg, debug_enable, debug_send=1, debug_send=0, 
@@ -79,18 +119,85 @@ def macroBTE_Initialization(slope_u_i_pwr: tuple, limit_mn_u_i_pwr: tuple, limit
     """
 
 
-def macroBTE_Calibrate800V():
-    """List of CAN messages to run a 800V calibration curve.
-    Message list:   1. set ctrl-mode to voltage
-                    2. set operational limits
-                    3. set slope values
-                    4. set protectional limits
-                    5. send clearance
-                    6. send set_rst_stop
-                    7. send switch-to-ON
+def ramp_setpoints(points=17, shape="up", u_min=0.0, u_max=800.0):
+    """ Equidistant setpoints between u_min and u_max.
 
+    :param shape: "up", "down" or "triangle" (up and down again)
+    :return: List of setpoints
     """
-    pass
+    if points < 2:
+        raise ValueError("A ramp needs at least two points")
+    setpoints = [u_min + (u_max - u_min) * index / (points - 1) for index in range(points)]
+    if shape == "down":
+        setpoints.reverse()
+    elif shape == "triangle":
+        setpoints += setpoints[-2::-1]
+    elif shape != "up":
+        raise ValueError("Unknown ramp shape {!r}".format(shape))
+    return setpoints
+
+
+"""Pre-encoded setpoint ramp, buffer holds frames_per_point payloads of msg_id for every setpoint"""
+SetpointRamp = collections.namedtuple("SetpointRamp", "msg_id freq setpoints frames_per_point buffer")
+
+
+def macroBTE_Calibrate800V(points=17, dwell=0.5, shape="up", u_min=0.0, u_max=800.0,
+                           set_switch=SWITCH_ON, set_ctrl=CTRL_VOLTAGE):
+    """ Setpoint ramp of a 800V calibration curve, pre-encoded as SET_REF_SWITCH_CTRL_RI (0xC1) payloads.
+
+    The configuration messages (ctrl-mode, limits, slopes, clearance, set_rst_stop) are sent before with
+    macroBTE_Initialization. The whole ramp is encoded at once into one contiguous buffer, which is streamed with
+    scheduler.stream_buffer(bus, ramp.msg_id, ramp.buffer, ramp.freq) without building a message per frame.
+    set_switch and set_ctrl default to the unverified register values, see REGISTERS_VERIFIED.
+
+    :param points: Number of calibration points between u_min and u_max
+    :param dwell: Time in seconds every point is held
+    :param shape: "up", "down" or "triangle" (up and down again)
+    :param u_min: First voltage setpoint
+    :param u_max: Last voltage setpoint
+    :param set_switch: Operating state sent with every setpoint
+    :param set_ctrl: Controller mode sent with every setpoint
+    :return: SetpointRamp
+    """
+    import numpy as np
+    from bulk_codec import encode_ref_switch_ctrl_ri
+
+    setpoints = np.array(ramp_setpoints(points, shape, u_min, u_max), dtype=np.float32)
+    freq = msg.SET_REF_SWITCH_CTRL_RI["freq"]
+    frames_per_point = max(1, int(round(dwell * freq)))
+    payloads = encode_ref_switch_ctrl_ri(setpoints, set_switch, set_ctrl)
+    buffer = np.repeat(payloads, frames_per_point, axis=0).tobytes()
+    logger.debug("800V ramp with %d points and %d frames encoded", len(setpoints), len(buffer) // 8)
+    return SetpointRamp(msg.SET_REF_SWITCH_CTRL_RI["msg_id"], freq, setpoints, frames_per_point, buffer)
+
+
+def macroBTE_Calibrate800V_Adaptive(points=17, shape="up", u_min=0.0, u_max=800.0, max_dwell=0.5, min_dwell=0.0,
+                                    window=0.1, tolerance=0.5, slope_tolerance=5.0, setpoint_tolerance=None,
+                                    set_switch=SWITCH_ON, set_ctrl=CTRL_VOLTAGE, on_point=None):
+    """ 800V calibration curve that advances to the next setpoint as soon as the measured voltage settled.
+
+    Instead of holding every point for a fixed dwell, the returned sequencer is fed with the measured voltage of
+    STATUS_MEAS_U_I. The SET_REF_SWITCH_CTRL_RI (0xC1) payload of every setpoint is encoded in advance, after every
+    advance the cyclic 0xC1 frame is updated with sequencer.payload. A point is taken after max_dwell at the latest.
+    set_switch and set_ctrl default to the unverified register values, see REGISTERS_VERIFIED.
+
+    :param window: Length of the settle window in seconds
+    :param tolerance: Maximum standard deviation of the measured voltage within the window in V
+    :param slope_tolerance: Maximum drift of the measured voltage within the window in V/s
+    :param setpoint_tolerance: Maximum distance of the settled voltage from the setpoint in V, defaults to 40 % of
+        the step between two setpoints, so the plateau of the previous point is never taken during the dead time
+    :param on_point: Callback on_point(settle.SettledPoint) after every finished point
+    :return: settle.AdaptiveDwellSequencer, see macroBTE_Calibrate800V for the other parameters
+    """
+    from settle import SettleDetector, AdaptiveDwellSequencer
+
+    setpoints = ramp_setpoints(points, shape, u_min, u_max)
+    payloads = [bytes(set_register_ref_switch_ctrl_ri(setpoint, set_switch, set_ctrl).data)
+                for setpoint in setpoints]
+    if setpoint_tolerance is None and points > 1:
+        setpoint_tolerance = 0.4 * abs(u_max - u_min) / (points - 1)
+    detector = SettleDetector(window, tolerance, slope_tolerance)
+    return AdaptiveDwellSequencer(setpoints, detector, max_dwell, min_dwell, payloads, on_point, setpoint_tolerance)
 
 
 """
@@ -102,53 +209,64 @@ def macroBTE_Calibrate800V():
 def set_register_ref_switch_ctrl_ri(set_ref,set_switch,set_ctrl,rst_q=False,rst_e=False,set_ri=0):
     """ Takes values to change the EStorage state and controller and set set values of controller.
 
+    The payload is packed by the encoder generated from the signal layout of SET_REF_SWITCH_CTRL_RI.
+
     :param set_ref: Set value of controller, based on the active controller mode
     :param set_switch: Change the EStorage state between Off, Standby and On
     :param set_ctrl: Change controller mode according to the manual
     :param rst_q: Reset the value of q
     :param rst_e: Reset the value of energy
-    :param set_ri: Set an inner resistance
+    :param set_ri: Set an inner resistance, the low 3 bytes of the float are sent (layout not yet verified)
     :return: returns a CAN message with id=0xC1
     """
-    from can import Message
-    from struct import pack
-
+    if not (0 <= set_switch <= 7 and 0 <= set_ctrl <= 7 and -2000 <= set_ri <= 2000):
+        logger.error("Wrong parameter value provided in function: set_switch=%s, set_ctrl=%s, set_ri=%s",
+                     set_switch, set_ctrl, set_ri)
+        return None
     try:
-        _reference_value = pack("<f", set_ref)
-        if 0 <= set_switch <= 7:
-            _operating_state = set_switch
-        else:
-            raise ValueError
-        if 0 <= set_ctrl <= 7:
-            _control_mode = set_ctrl
-        else:
-            raise ValueError
-        if -2000 <= set_ri <= 2000:
-            _resistance_ri = pack("<f", set_ri)[:3]
-        else:
-            raise ValueError
-
+        payload = msg.CODECS_BY_ID[0xC1].encode(set_ref=set_ref, set_switch=set_switch, set_ctrl=set_ctrl,
+                                                rst_q=rst_q, rst_e=rst_e, set_ri=set_ri)
     except msg.struct.error:
         logger.error("Error occurred while packing data", exc_info=True)
         return None
-    except ValueError:
-        logger.error("Wrong parameter value provided in function", exc_info=True)
+    return Message(arbitration_id=0xC1, data=payload, extended_id=False)
+
+
+# CANID: 0x288
+def request_system_status(status_cache, max_age=0.5):
+    """ Current system status from the latest-value cache of the status messages 0x288, 0x518 and 0x528.
+
+    :param status_cache: status_cache.StatusCache attached to the receive path
+    :param max_age: Maximum age of the status messages in seconds
+    :return: Dictionary of the status fields, None if the status is not available or too old
+    """
+    from status_cache import StaleStatus
+
+    try:
+        return status_cache.snapshot(max_age)
+    except StaleStatus:
+        logger.warning("System status not available within %s s", max_age)
         return None
 
-    reg_ctrl = _operating_state << 0
-    reg_ctrl += (_control_mode << 3)
-    reg_ctrl += (rst_q << 6)
-    reg_ctrl += (rst_e << 7)
-    logger.debug("Byte value of REG_CTRL: %s", bin(reg_ctrl))
 
-    payload = _reference_value + bytes([reg_ctrl]) + _resistance_ri
-    logger.debug("Payload for message := %s", payload)
-    return Message(arbitration_id=0xC1, data=payload, extended_id=False)
+def response_matcher(frame, fallback=None, use_status=True):
+    """ Predicate recognizing the device response that confirms a sent frame.
 
+    CLEARANCE and SET_RST_STOP are reflected in the system status STATUS_SYSTEM (0x288). All other frames are not
+    reported back by the device, fallback(frame) is used for them, e.g. runner.echo_matcher on a monitored loopback.
 
-# CANID: 0x288
-def request_system_status():
-    pass
+    :param frame: Sent CAN.Message object
+    :param fallback: Function returning a predicate for frames without device response, None skips them
+    :param use_status: Confirm by STATUS_SYSTEM, otherwise all frames use the fallback, see STATUS_LAYOUTS_VERIFIED
+    :return: Predicate predicate(msg) -> bool, None if the frame can not be confirmed
+    """
+    status = msg.get_codec(msg.STATUS_SYSTEM)
+    if use_status and frame.arbitration_id in (msg.CLEARANCE["msg_id"], msg.SET_RST_STOP["msg_id"]):
+        field = status.fields.index("clearance" if frame.arbitration_id == msg.CLEARANCE["msg_id"] else "rst_stop")
+        value = frame.data[0]
+        return lambda message: (message.arbitration_id == status.msg_id and len(message.data) >= status.dlc
+                                and status.unpack(bytes(message.data[:status.dlc]))[field] == value)
+    return fallback(frame) if fallback is not None else None
 
 
 # CANID: 0xFE manual page 35
@@ -156,23 +274,41 @@ def request_system_info():
     pass
 
 
-def reset_stop(value=False):
-    from can import Message
-    from struct import pack
+def reset_stop(value=False, status_cache=None, max_age=0.5, bus=None):
+    """ Message to reset the stop state and errors of the BTE.
+
+    If a status cache is provided, the system status is checked before because
+        Standby-Errors require OFF or SBY
+        Critical-Errors require OFF
+    Status information is available in messages 0x518 and 0x528. Their layouts are not verified yet, the check is
+    only done for devices on a virtual bus (see require_simulated).
+
+    :param value: Value of set_rst_stop
+    :param status_cache: Optional status_cache.StatusCache used to check the system status
+    :param max_age: Maximum age of the status messages in seconds
+    :param bus: Bus of the device, required to check the status
+    :return: CAN message with id=0x21F, None if the value is invalid or the reset is not possible in this state
+    :raises UnverifiedProtocol: The status is checked on hardware before the status layouts are verified
+    """
     _id = 0x21F
     try:
-        #TODO: Check current system status
-        """ Check system status because: 
-                    Standby-Errors require OFF or SBY 
-                    Critical-Errors require OFF
-           
-           Status information is available in messages 0x518 and 0x528
-        """
-        if 0 <= value <= 255:
-            return Message(arbitration_id=_id, data=pack("<B", value), extended_id=False)
-        else:
+        if not 0 <= value <= 255:
             raise ValueError
 
     except ValueError:
         logger.error("Wrong parameter value provided in function", exc_info=True)
         return None
+
+    if status_cache is not None:
+        require_simulated(bus, "Status check of reset_stop", msg.STATUS_LAYOUTS_VERIFIED)
+        status = request_system_status(status_cache, max_age)
+        if status is None:
+            return None
+        if status["critical_errors"] and status["op_state"] != SWITCH_OFF:
+            logger.error("Critical errors can only be reset in state OFF, current state: %s", status["op_state"])
+            return None
+        if status["standby_errors"] and status["op_state"] not in (SWITCH_OFF, SWITCH_STANDBY):
+            logger.error("Standby errors can only be reset in state OFF or SBY, current state: %s",
+                         status["op_state"])
+            return None
+    return Message(arbitration_id=_id, data=pack("<B", value), extended_id=False)
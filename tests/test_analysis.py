@@ -0,0 +1,46 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from analysis import step_responses, summarize
+
+
+DEAD_TIME = 0.05
+TAU = 0.1
+
+
+def first_order(steps, end, rate=1000.0):
+    """Decoded capture of setpoint steps (time, value) and a first order response with dead time."""
+    set_time = np.array([0.0] + [t for t, _ in steps])
+    set_value = np.array([0.0] + [value for _, value in steps])
+    time = np.arange(0.0, end, 1.0 / rate)
+    response = np.zeros_like(time)
+    old = 0.0
+    for t_step, new in steps:
+        elapsed = np.clip(time - t_step - DEAD_TIME, 0.0, None)
+        after = time >= t_step
+        response[after] = old + (new - old) * (1.0 - np.exp(-elapsed[after] / TAU))
+        old = new
+    return {"SET_REF_SWITCH_CTRL_RI": {"timestamp": set_time, "set_ref": set_value},
+            "STATUS_MEAS_U_I": {"timestamp": time, "meas_voltage": response}}
+
+
+def test_first_order_step_latency_and_rise_time():
+    steps = step_responses(first_order([(1.0, 100.0), (3.0, 20.0)], end=5.0))
+    np.testing.assert_allclose(steps["time"], [1.0, 3.0])
+    np.testing.assert_allclose(steps["old"], [0.0, 100.0])
+    np.testing.assert_allclose(steps["new"], [100.0, 20.0])
+    # 10 % is reached one tenth of the time constant after the dead time, 90 % ln(9) time constants later
+    np.testing.assert_allclose(steps["latency"], DEAD_TIME + TAU * math.log(1 / 0.9), atol=1e-3)
+    np.testing.assert_allclose(steps["rise_time"], TAU * math.log(9), atol=1e-3)
+    np.testing.assert_allclose(steps["overshoot"], 0.0, atol=1e-9)
+
+
+def test_step_without_response_is_missing():
+    signals = first_order([(1.0, 100.0)], end=1.04)      # Capture ends within the dead time
+    steps = step_responses(signals)
+    assert np.isnan(steps["latency"][0]) and np.isnan(steps["rise_time"][0]) and np.isnan(steps["overshoot"][0])
+    summary = summarize(steps)
+    assert summary["latency"] == {"count": 0, "missing": 1}
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("can")
+
+from benchmark import SCHEMA_VERSION, Case, compare, measure
+
+
+def run(schema=SCHEMA_VERSION, **cases):
+    return {"schema": schema, "results": {name: dict(zip(("frames_per_s", "p50_us", "p99_us"), values))
+                                          for name, values in cases.items()}}
+
+
+BASELINE = run(encode=(1000.0, 10.0, 20.0), decode=(5000.0, 2.0, 4.0))
+
+
+def test_compare_decides_on_throughput_and_median():
+    assert compare(BASELINE, run(encode=(950.0, 10.5, 28.0), decode=(5000.0, 2.0, 4.0))) == []
+    assert compare(BASELINE, run(encode=(850.0, 10.0, 20.0), decode=(5000.0, 2.5, 4.0))) == [
+        ("encode", "frames_per_s", 1000.0, 850.0), ("decode", "p50_us", 2.0, 2.5)]
+
+
+def test_compare_p99_uses_the_tail_threshold():
+    results = run(encode=(1000.0, 10.0, 35.0), decode=(5000.0, 2.0, 4.0))
+    assert compare(BASELINE, results) == [("encode", "p99_us", 20.0, 35.0)]
+    assert compare(BASELINE, results, tail_threshold=1.0) == []
+
+
+def test_compare_skips_percentiles_of_other_schema_and_new_cases():
+    results = run(schema=1, encode=(1000.0, 50.0, 100.0), fit=(10.0, 1.0, 1.0))
+    assert compare(BASELINE, results) == []
+
+
+def test_measure_reports_throughput_and_allocations():
+    result = measure(Case("allocate", lambda: [0] * 1000, frames=10), batches=5, calls=5, warmup=1)
+    assert result["frames_per_call"] == 10 and result["calls"] == 25
+    assert 0 < result["p50_us"] <= result["p99_us"]
+    assert result["alloc_bytes_per_call"] >= 8000
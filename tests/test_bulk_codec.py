@@ -0,0 +1,77 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import messages as msg
+from bulk_codec import decode_frames, encode_ref_switch_ctrl_ri
+
+
+SCALED = {"msg_id": 0x3A0, "msg_name": "TEST_SCALED", "dlc": 8,
+          "temperature": {"start_bit": 0, "length": 16, "type": "signed", "factor": 0.1, "offset": -40},
+          "voltage": {"start_bit": 16, "length": 12, "type": "unsigned", "factor": 0.5},
+          "mode": {"start_bit": 28, "length": 4, "type": "unsigned"},
+          "level": {"start_bit": 32, "length": 7, "type": "signed"},
+          "ratio": {"start_bit": 40, "length": 24, "type": "float"}}
+
+
+@pytest.fixture
+def scaled_codec():
+    codec = msg.register_message(dict(SCALED, msg_fmt="<Q", msg_fields=("word",)))
+    yield codec
+    del msg.CODECS_BY_ID[codec.msg_id], msg.CODECS_BY_NAME[codec.msg_name]
+
+
+def assert_matches_frame_decode(ids, payloads):
+    signals = decode_frames(ids, payloads)
+    for msg_id in set(ids.tolist()):
+        codec = msg.CODECS_BY_ID[msg_id]
+        columns = signals[codec.msg_name]
+        for row, index in enumerate(columns["index"]):
+            expected = codec.decode(payloads[index, :codec.dlc].tobytes())
+            for name, value in expected.items():
+                np.testing.assert_array_equal(columns[name][row], value, err_msg="{}.{}".format(codec.msg_name, name))
+
+
+def payload_rows(*payloads):
+    return np.array([list(payload.ljust(8, b"\x00")) for payload in payloads], dtype=np.uint8)
+
+
+def test_frames_are_grouped_by_id_in_input_order():
+    slope = msg.get_codec(msg.SET_SLOPE_U_I)
+    clearance = msg.get_codec(msg.CLEARANCE)
+    ids = np.array([0x144, 0x7FF, 0x144, 0x720], dtype=np.uint32)
+    payloads = payload_rows(slope.encode(slope_voltage=200.0, slope_current=2.0), bytes(8),
+                            slope.encode(slope_voltage=100.0, slope_current=1.0), clearance.encode(clearance=1))
+    signals = decode_frames(ids, payloads, timestamps=[0.0, 0.1, 0.2, 0.3])
+    assert set(signals) == {"SET_SLOPE_U_I", "CLEARANCE"}       # Unknown ids are skipped
+    np.testing.assert_array_equal(signals["SET_SLOPE_U_I"]["index"], [0, 2])
+    np.testing.assert_array_equal(signals["SET_SLOPE_U_I"]["timestamp"], [0.0, 0.2])
+    np.testing.assert_array_equal(signals["SET_SLOPE_U_I"]["slope_voltage"], [200.0, 100.0])
+    np.testing.assert_array_equal(signals["CLEARANCE"]["clearance"], [1])
+    with pytest.raises(ValueError):
+        decode_frames(ids, payloads[:, :4])
+
+
+def test_bulk_decode_matches_frame_decode_of_all_messages():
+    random = np.random.default_rng(1)
+    ids = random.choice(np.array(sorted(msg.CODECS_BY_ID), dtype=np.uint32), 2000)
+    assert_matches_frame_decode(ids, random.integers(0, 256, (len(ids), 8), dtype=np.uint8))
+
+
+def test_message_registered_later_is_decoded_with_scaling(scaled_codec):
+    random = np.random.default_rng(2)
+    ids = np.full(500, scaled_codec.msg_id, dtype=np.uint32)
+    payloads = random.integers(0, 256, (len(ids), 8), dtype=np.uint8)
+    assert_matches_frame_decode(ids, payloads)
+    payload = np.frombuffer(scaled_codec.encode(temperature=21.5, voltage=400.0, mode=3, level=-5, ratio=0.25),
+                            dtype=np.uint8).reshape(1, 8)
+    signals = decode_frames([scaled_codec.msg_id], payload)["TEST_SCALED"]
+    assert signals["temperature"][0] == pytest.approx(21.5)
+    assert (signals["voltage"][0], signals["mode"][0], signals["level"][0]) == (400.0, 3, -5)
+
+
+def test_encode_ref_switch_ctrl_ri_matches_codec():
+    codec = msg.get_codec(msg.SET_REF_SWITCH_CTRL_RI)
+    payloads = encode_ref_switch_ctrl_ri([100.0, 400.0], 1, 2, rst_q=1, set_ri=0.25)
+    assert payloads[1].tobytes() == codec.encode(set_ref=400.0, set_switch=1, set_ctrl=2, rst_q=1, rst_e=0,
+                                                 set_ri=0.25)
@@ -0,0 +1,74 @@
+import collections
+import math
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import bus_load
+import messages as msg
+from bus_load import ScheduleError, frame_bits, frame_time, plan_schedule
+from scheduler import PeriodicScheduler
+
+
+@pytest.mark.parametrize("dlc, extended, bits", [
+    (0, False, 55),
+    (1, False, 65),
+    (8, False, 135),
+    (0, True, 80),
+    (8, True, 160),
+])
+def test_worst_case_frame_bits(dlc, extended, bits):
+    assert frame_bits(dlc, extended) == bits
+
+
+def test_frame_time_at_500k():
+    assert frame_time(8, 500000) == pytest.approx(270e-6)
+
+
+def test_plan_staggers_harmonic_messages():
+    plan = plan_schedule([msg.SET_OP_LIM_U, msg.SET_OP_LIM_I, msg.SET_OP_LIM_PWR], 500000)
+    phases = [plan.phase(message["msg_id"]) for message in (msg.SET_OP_LIM_U, msg.SET_OP_LIM_I, msg.SET_OP_LIM_PWR)]
+    assert len(set(phases)) == 3
+    assert plan.peak_burst == 1 and plan.unstaggered_peak_burst == 3
+    assert plan.utilization == pytest.approx(3 * 100 * 135 / 500000)
+    assert plan.phase(0x7FF) is None
+
+
+def test_overloaded_schedule_is_rejected():
+    with pytest.raises(ScheduleError):
+        plan_schedule([(msg.SET_REF_SWITCH_CTRL_RI, 5000)], 500000)
+
+
+def test_planned_phase_does_not_block_with_backend_tasks():
+    bus = can.interface.Bus(bustype="virtual", channel="bus_load0")
+    scheduler = PeriodicScheduler(bus, use_hardware=True)
+    try:
+        start = time.perf_counter()
+        scheduler.schedule(msg.SET_RST_STOP, phase=0.8, rst_stop=1)
+        assert time.perf_counter() - start < 0.1
+        scheduler.schedule(msg.CLEARANCE, clearance=1)
+        assert set(scheduler._sw_tasks) == {msg.SET_RST_STOP["msg_id"]}
+        assert set(scheduler._hw_tasks) == {msg.CLEARANCE["msg_id"]}
+    finally:
+        scheduler.stop_all()
+        bus.shutdown()
+
+
+def test_frames_past_a_cut_hyperperiod_wrap_to_its_start(monkeypatch):
+    window = 15 * 135       # Whole slots of 8 byte frames at 1 Mbit/s
+    monkeypatch.setattr(bus_load, "MAX_HYPERPERIOD_US", window)
+    messages = [(msg.SET_OP_LIM_U, 1000), (msg.SET_OP_LIM_I, 1000), (msg.SET_OP_LIM_PWR, 1000), (msg.SET_PR_LIM_U, 300)]
+    plan = plan_schedule(messages, 1000000)
+    assert plan.hyperperiod == pytest.approx(window / 1e6)
+
+    # Frames of every message over the cut window, in slots of one frame time counted from its start
+    slot = int(math.ceil(frame_time(8, 1000000) * 1e6))
+    slots = collections.Counter()
+    for entry in plan.messages.values():
+        phase, period = int(round(entry.phase * 1e6)), int(round(1e6 / entry.freq))
+        for start in range(0, window, period):
+            slots[(phase + start) % window // slot] += 1
+    assert max(slots) < window // slot
+    assert plan.peak_burst == max(slots.values())
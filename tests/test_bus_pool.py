@@ -0,0 +1,73 @@
+import pytest
+
+can = pytest.importorskip("can")
+
+from bus_pool import BusBusy, BusPool, bus_off
+
+
+@pytest.fixture
+def pool():
+    def factory(key):
+        return can.interface.Bus(bustype="virtual", channel="{}-{}".format(key.interface, key.channel))
+
+    with BusPool(factory=factory) as pool:
+        yield pool
+
+
+def test_released_bus_is_reset_and_reused(pool):
+    with pool.lease("pool", 0) as bus:
+        bus.set_filters([{"can_id": 0x100, "can_mask": 0x7FF}])
+        sender = can.interface.Bus(bustype="virtual", channel="pool-0")
+        sender.send(can.Message(arbitration_id=0x100, data=[1], extended_id=False))
+        sender.shutdown()
+    with pool.lease("pool", 0) as again:
+        assert again is bus
+        assert pool.statistics["reused"] == 1 and pool.statistics["drained"] == 1
+
+
+def test_can_error_in_lease_reconnects(pool):
+    with pytest.raises(can.CanError):
+        with pool.lease("pool", 1) as bus:
+            raise can.CanError("bus error")
+    with pool.lease("pool", 1) as again:
+        assert again is not bus and pool.statistics["reconnected"] == 1
+
+
+def test_unreported_state_is_not_bus_off():
+    class Unreported:
+        @property
+        def state(self):
+            raise NotImplementedError()
+
+    class Unreadable:
+        @property
+        def state(self):
+            raise can.CanError("state not readable")
+
+    assert not bus_off(Unreported()) and bus_off(Unreadable())
+
+
+def test_release_is_idempotent(pool):
+    bus = pool.acquire("pool", 2)
+    pool.release(bus)
+    pool.release(bus)
+    other = can.interface.Bus(bustype="virtual", channel="unknown")
+    pool.release(other)
+    other.shutdown()
+    assert pool.acquire("pool", 2, timeout=0) is bus
+
+
+def test_discarded_bus_frees_its_channel(pool):
+    bus = pool.acquire("pool", 3)
+    with pytest.raises(BusBusy):
+        pool.acquire("pool", 3, timeout=0.01)
+    pool.discard(bus)
+    pool.release(bus)       # E.g. from the finally block of the session, does not raise
+    assert pool.acquire("pool", 3, timeout=0) is not bus
+
+
+def test_error_in_lease_is_not_hidden_by_release(pool):
+    with pytest.raises(RuntimeError, match="session failed"):
+        with pool.lease("pool", 4):
+            pool.close()
+            raise RuntimeError("session failed")
@@ -0,0 +1,104 @@
+import json
+import os
+import struct
+import subprocess
+import sys
+
+import pytest
+
+import calibration
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_version_import_leaves_backends_unloaded():
+    # Modules loaded at interpreter startup, e.g. by site customization, are not counted
+    code = ("import sys; before = set(sys.modules); import calibration; calibration.main(['version']); "
+            "print(' '.join(sorted(m for m in ('can', 'numpy', 'yaml', 'asyncio', 'sqlite3') "
+            "if m in sys.modules and m not in before)))")
+    process = subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR, stdout=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    version, lazy = process.stdout.split("\n")[:2]
+    assert version == "BTE Calibration Tool - v{}".format(calibration.SW_VERION)
+    assert lazy == ""
+
+
+def test_import_budget():
+    pytest.importorskip("can")
+    import benchmark
+    profile, violations = benchmark.check_import_budget()
+    assert violations == [], profile
+
+
+def test_version_command(capsys):
+    assert calibration.main(["version"]) == 0
+    assert calibration.main(["--version"]) == 0
+    assert capsys.readouterr().out == "BTE Calibration Tool - v{}\n".format(calibration.SW_VERION) * 2
+
+
+def test_calibrate_simulated_units(monkeypatch, capsys):
+    pytest.importorskip("can")
+    import sessions
+    monkeypatch.setattr(sessions, "MONITOR_TIME", 0.2)
+    assert calibration.main(["calibrate", "--simulate", "--unit", "cli0:S1", "--unit", "cli1:S2"]) == 0
+    assert capsys.readouterr().out.splitlines()[-2:] == ["S1: OK", "S2: OK"]
+
+
+def test_replay_of_a_capture(tmp_path, capsys):
+    can = pytest.importorskip("can")
+    pytest.importorskip("numpy")
+    import messages as msg
+    from capture import CaptureWriter
+
+    filename = str(tmp_path / "run.btecap")
+    capture = CaptureWriter(filename, metadata={"sw_version": 0.1})
+    for index in range(4):
+        data = struct.pack(msg.STATUS_MEAS_U_I["msg_fmt"], 10.0 * index, 1.0)
+        capture.on_message_received(can.Message(timestamp=index * 0.01, arbitration_id=0x298, data=data,
+                                                extended_id=False))
+    capture.on_message_received(can.Message(timestamp=0.05, arbitration_id=0x7FF, data=b"\x00", extended_id=False))
+    capture.stop()
+
+    assert calibration.main(["replay", "--json", "--frames", filename]) == 0
+    entry, = json.loads(capsys.readouterr().out)
+    assert entry["records"] == 5 and list(entry["messages"]) == ["STATUS_MEAS_U_I"]
+    assert [frame["timestamp"] for frame in entry["frames"]] == [0.0, 0.01, 0.02, 0.03]
+    assert [frame["signals"]["meas_voltage"] for frame in entry["frames"]] == [0.0, 10.0, 20.0, 30.0]
+    assert entry["messages"]["STATUS_MEAS_U_I"]["signals"]["meas_current"]["mean"] == 1.0
+
+    assert calibration.main(["replay", str(tmp_path / "missing.journal")]) == 1
+
+
+def test_store_is_closed_when_calibration_fails(tmp_path, monkeypatch):
+    pytest.importorskip("can")
+    import multi_unit
+    from result_store import ResultStore
+
+    def failing(units, session, progress=None):
+        progress(multi_unit.UnitResult("S1", "cli0", True, None, 1.0, {"fit": {}}), None)
+        raise RuntimeError("unit thread failed")
+
+    monkeypatch.setattr(multi_unit, "calibrate_units", failing)
+    database = str(tmp_path / "results.db")
+    with pytest.raises(RuntimeError):
+        calibration.main(["calibrate", "--interface", "virtual", "--unit", "cli0:S1", "--store", database])
+    with ResultStore(database) as store:
+        assert [run["serial"] for run in store.runs()] == ["S1"]
+
+
+def test_replay_skips_files_that_are_no_journal(tmp_path, capsys):
+    pytest.importorskip("can")
+    from journal import SessionJournal
+
+    csv = tmp_path / "test.csv"
+    csv.write_text("timestamp,arbitration_id,extended,remote,error,dlc,data\n0.0,0x298,0,0,0,8,AAAAAAAAAAA=\n")
+    corrupt = tmp_path / "corrupt.journal"
+    corrupt.write_text('{"type": "session"}\nnot json\n{"type": "done"}\n')
+    journal = SessionJournal(str(tmp_path / "S1.journal"))
+    journal.append("session", sweep={"points": 2})
+    journal.close()
+
+    assert calibration.main(["replay", "--json", str(csv), str(corrupt), str(tmp_path / "S1.journal")]) == 1
+    entry, = json.loads(capsys.readouterr().out)
+    assert entry["journal"] == str(tmp_path / "S1.journal") and entry["records"] == 1
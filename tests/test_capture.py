@@ -0,0 +1,94 @@
+import pytest
+
+can = pytest.importorskip("can")
+
+import capture as capture_module
+from capture import CaptureReader, CaptureWriter, FLAG_ERROR, FLAG_EXTENDED, FLAG_REMOTE, FLAG_RX
+from ring_buffer import FrameRingBuffer, batch_messages
+
+
+FRAMES = [
+    can.Message(timestamp=1.0, arbitration_id=0x298, data=[1, 2, 3, 4, 5, 6, 7, 8], extended_id=False),
+    can.Message(timestamp=2.0, arbitration_id=0x123, data=[9], extended_id=True),        # Extended id below 0x7FF
+    can.Message(timestamp=3.0, arbitration_id=0x7A0, dlc=4, is_remote_frame=True, extended_id=False),
+    can.Message(timestamp=4.0, arbitration_id=0x0, is_error_frame=True, extended_id=False),
+]
+
+
+def test_ring_buffer_keeps_frame_flags():
+    ring = FrameRingBuffer(capacity=8)
+    for frame in FRAMES:
+        ring.on_message_received(frame)
+    batch = ring.get_batch()
+    assert list(batch.flags) == [FLAG_RX, FLAG_RX | FLAG_EXTENDED, FLAG_RX | FLAG_REMOTE, FLAG_RX | FLAG_ERROR]
+    for original, message in zip(FRAMES, batch_messages(batch)):
+        assert message.is_extended_id == original.is_extended_id
+        assert message.is_remote_frame == original.is_remote_frame
+        assert message.is_error_frame == original.is_error_frame
+        assert bytes(message.data) == bytes(original.data)
+
+
+def test_capture_through_ring_buffer_equals_direct_capture(tmp_path):
+    ring = FrameRingBuffer(capacity=2)      # Wraps around within the batch
+    direct = CaptureWriter(str(tmp_path / "direct.btecap"))
+    batched = CaptureWriter(str(tmp_path / "batched.btecap"))
+    for frame in FRAMES:
+        direct.on_message_received(frame)
+        ring.on_message_received(frame)
+        if len(ring) == 2:
+            batched.write_batch(ring.get_batch())
+    batched.write_batch(ring.get_batch(timeout=0))
+    assert ring.overflow_counts() == {}
+    direct.stop()
+    batched.stop()
+
+    with CaptureReader(str(tmp_path / "direct.btecap")) as a, CaptureReader(str(tmp_path / "batched.btecap")) as b:
+        assert list(a.records()) == list(b.records())
+        assert len(a) == len(FRAMES)
+
+
+def write_capture(filename, frames, **kwargs):
+    writer = CaptureWriter(filename, metadata={"serial": "BTE-0001"}, **kwargs)
+    for frame in frames:
+        writer.on_message_received(frame)
+    writer.stop()
+
+
+def test_capture_round_trip(tmp_path):
+    filename = str(tmp_path / "run.btecap")
+    write_capture(filename, FRAMES)
+    with CaptureReader(filename) as capture:
+        assert capture.metadata == {"serial": "BTE-0001"} and len(capture) == len(FRAMES)
+        for original, message in zip(FRAMES, capture.messages()):
+            assert (message.timestamp, message.arbitration_id) == (original.timestamp, original.arbitration_id)
+            assert message.dlc == original.dlc and bytes(message.data) == bytes(original.data)
+            assert (message.is_extended_id, message.is_remote_frame, message.is_error_frame) == (
+                original.is_extended_id, original.is_remote_frame, original.is_error_frame)
+        assert capture.ids()[0x298] == (1, 1.0, 1.0)
+
+
+def test_reader_selects_blocks_by_id_and_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(capture_module, "BLOCK_RECORDS", 4)
+    frames = [can.Message(timestamp=0.1 * index, arbitration_id=0x100 + index % 3, data=[index % 256],
+                          extended_id=False) for index in range(40)]
+    filename = str(tmp_path / "blocks.btecap")
+    write_capture(filename, frames, flush_records=7)
+    with CaptureReader(filename) as capture:
+        assert len(capture.index["blocks"]) == 10
+        selected = list(capture.records(arbitration_id=0x101, start=1.0, end=2.0))
+        assert [record[0] for record in selected] == pytest.approx([1.0, 1.3, 1.6, 1.9])
+        assert all(record[1] == 0x101 for record in selected)
+
+
+def test_capture_without_footer_is_readable(tmp_path):
+    filename = str(tmp_path / "crashed.btecap")
+    writer = CaptureWriter(filename, flush_records=1)
+    for frame in FRAMES[:2]:
+        writer.on_message_received(frame)
+    writer.flush()      # No footer, as after a crash
+    try:
+        with CaptureReader(filename) as capture:
+            assert len(capture) == 2
+            assert [record[1] for record in capture.records(arbitration_id=0x123)] == [0x123]
+    finally:
+        writer.stop()
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("can")
+
+import dbc
+import messages as msg
+
+
+def signature(codec):
+    return (codec.msg_id, codec.msg_name, codec.dlc, codec.freq, codec.description["msg_fmt"], codec.fields,
+            codec.layouts)
+
+
+def test_export_import_round_trip():
+    descriptions, nodes = dbc.parse_dbc(dbc.format_dbc())
+    database = dbc.MessageDatabase(descriptions, nodes)
+    assert len(database) == len(msg.MESSAGE_DESCRIPTIONS)
+    for original in msg.MESSAGE_DESCRIPTIONS:
+        codec, imported = msg.get_codec(original), database.by_id[original["msg_id"]]
+        assert signature(imported) == signature(codec)
+        payload = bytes(range(1, codec.dlc + 1))
+        assert imported.decode(payload) == codec.decode(payload)
+
+
+def test_round_trip_of_scaled_bit_fields():
+    description = {"msg_id": 0x1ABCDEF, "msg_name": "TEST_SCALED", "dlc": 8, "extended": True, "freq": 20,
+                   "temperature": {"start_bit": 0, "length": 16, "type": "signed", "factor": 0.1, "offset": -40},
+                   "mode": {"start_bit": 16, "length": 4, "type": "unsigned", "factor": 1},
+                   "ratio": {"start_bit": 40, "length": 24, "type": "float", "factor": 1}}
+    layouts = msg.signal_layouts(description)
+    description["msg_fmt"], description["msg_fields"] = msg.container_format(layouts, description["dlc"])
+    (imported,), _ = dbc.parse_dbc(dbc.format_dbc([description]))
+    assert imported["extended"] and imported["freq"] == 20
+    assert msg.signal_layouts(imported) == layouts
+    codec = msg.MessageCodec(imported)
+    assert codec.decode(codec.encode(temperature=21.5, mode=3, ratio=0.25)) == pytest.approx(
+        {"temperature": 21.5, "mode": 3, "ratio": 0.25})
+
+
+def test_cached_database_depends_on_generator(tmp_path, monkeypatch):
+    filename = str(tmp_path / "bte.dbc")
+    dbc.write_dbc(filename)
+    cache_dir = str(tmp_path / "cache")
+    parsed = dbc.load_dbc(filename, cache_dir)
+    cached = dbc.load_dbc(filename, cache_dir)
+    assert [signature(codec) for codec in cached.codecs] == [signature(codec) for codec in parsed.codecs]
+    assert cached.by_name["SET_OP_LIM_U"].encode(op_lim_u_mx=1400, op_lim_u_mn=0) == msg.get_codec(
+        msg.SET_OP_LIM_U).encode(op_lim_u_mx=1400, op_lim_u_mn=0)
+
+    monkeypatch.setattr(dbc, "generator_digest", lambda: "0" * 16)
+    dbc.load_dbc(filename, cache_dir)
+    assert len(list((tmp_path / "cache").glob("*.pickle"))) == 2
@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+from dispatcher import Dispatcher, compute_filters
+from metrics import METRICS
+
+
+def test_frames_are_handed_to_the_handlers_of_their_id():
+    received = []
+    dispatcher = Dispatcher()
+    dispatcher.subscribe(0x288, received.append)
+    dispatcher.subscribe(0x18FF0001, received.append, extended=True)
+    assert dispatcher.subscribed_ids() == [0x288] and dispatcher.subscribed_ids(True) == [0x18FF0001]
+
+    frames = [can.Message(arbitration_id=0x288, extended_id=False),
+              can.Message(arbitration_id=0x298, extended_id=False),
+              can.Message(arbitration_id=0x18FF0001, extended_id=True)]
+    for frame in frames:
+        dispatcher.on_message_received(frame)
+    assert received == [frames[0], frames[2]] and dispatcher.unhandled == 1
+
+    dispatcher.unsubscribe(0x288, received.append)
+    dispatcher.on_message_received(frames[0])
+    assert dispatcher.subscribed_ids() == [] and dispatcher.unhandled == 2
+
+
+def test_error_frames_and_oversized_standard_ids_are_unhandled():
+    received = []
+    dispatcher = Dispatcher()
+    dispatcher.subscribe(0x004, received.append)
+    frames = [can.Message(arbitration_id=0x20000004, is_error_frame=True, extended_id=False),
+              can.Message(arbitration_id=0x004, is_error_frame=True, extended_id=False),
+              can.Message(arbitration_id=0x800, extended_id=False)]
+    for frame in frames:
+        dispatcher.on_message_received(frame)
+    METRICS.enable()
+    try:
+        for frame in frames:
+            dispatcher.on_message_received(frame)
+    finally:
+        METRICS.disable()
+        METRICS.reset()
+    assert received == [] and dispatcher.unhandled == 6 and dispatcher.handler_errors == 0
+
+
+def test_failing_handler_does_not_stop_reception():
+    received = []
+
+    def broken(message):
+        raise RuntimeError("handler bug")
+
+    dispatcher = Dispatcher()
+    dispatcher.subscribe(0x288, broken)
+    dispatcher.subscribe(0x288, received.append)
+    bus = can.interface.Bus(bustype="virtual", channel="dispatcher0")
+    sender = can.interface.Bus(bustype="virtual", channel="dispatcher0")
+    notifier = can.Notifier(bus, [dispatcher], timeout=0.01)
+    try:
+        for index in range(3):
+            sender.send(can.Message(arbitration_id=0x288, data=[index], extended_id=False))
+        deadline = time.monotonic() + 2.0
+        while len(received) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        notifier.stop()
+        bus.shutdown()
+        sender.shutdown()
+    assert [message.data[0] for message in received] == [0, 1, 2]
+    assert dispatcher.handler_errors == 3
+
+
+def test_failing_handler_is_counted_with_metrics():
+    dispatcher = Dispatcher()
+    dispatcher.subscribe(0x298, lambda message: 1 / 0)
+    METRICS.enable()
+    try:
+        dispatcher.on_message_received(can.Message(arbitration_id=0x298, extended_id=False))
+    finally:
+        METRICS.disable()
+        METRICS.reset()
+    assert dispatcher.handler_errors == 1
+
+
+def test_filters_are_merged_down_to_the_controller_limit():
+    assert compute_filters([0x288, 0x298]) == [{"can_id": 0x288, "can_mask": 0x7FF, "extended": False},
+                                              {"can_id": 0x298, "can_mask": 0x7FF, "extended": False}]
+    merged, = compute_filters([0x288, 0x298], max_filters=1)
+    assert merged["can_mask"] == 0x7EF and merged["can_id"] == 0x288
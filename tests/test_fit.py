@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from fit import CalibrationFit, StreamingLinearFit
+
+
+def least_squares(pairs):
+    n = len(pairs)
+    mean_x = sum(x for x, _ in pairs) / n
+    mean_y = sum(y for _, y in pairs) / n
+    s_xx = sum((x - mean_x) ** 2 for x, _ in pairs)
+    s_xy = sum((x - mean_x) * (y - mean_y) for x, y in pairs)
+    gain = s_xy / s_xx
+    residuals = [y - gain * x - (mean_y - gain * mean_x) for x, y in pairs]
+    return gain, mean_y - gain * mean_x, (sum(r * r for r in residuals) / (n - 2)) ** 0.5
+
+
+def sweep(count, seed):
+    generator = random.Random(seed)
+    # Large setpoints around a small spread test the numerical stability of the running sums
+    return [(x, 1.0017 * x + 0.35 + generator.gauss(0, 0.05))
+            for x in (800.0 + 0.5 * generator.random() for _ in range(count))]
+
+
+def fitted(pairs):
+    fit = StreamingLinearFit()
+    for x, y in pairs:
+        fit.update(x, y)
+    return fit
+
+
+def test_streaming_fit_matches_least_squares():
+    pairs = sweep(200, 1)
+    fit = fitted(pairs)
+    gain, offset, residual_std = least_squares(pairs)
+    assert fit.gain == pytest.approx(gain, rel=1e-9)
+    assert fit.offset == pytest.approx(offset, rel=1e-6)
+    assert fit.residual_std == pytest.approx(residual_std, rel=1e-6)
+
+
+@pytest.mark.parametrize("split", [0, 1, 37, 199, 200])
+def test_merge_equals_sequential_update(split):
+    pairs = sweep(200, 2)
+    merged = fitted(pairs[:split])
+    merged.merge(fitted(pairs[split:]))
+    sequential = fitted(pairs)
+    assert merged.n == sequential.n
+    for name in ("mean_x", "mean_y", "c_xx", "c_xy", "c_yy"):
+        assert getattr(merged, name) == pytest.approx(getattr(sequential, name), rel=1e-9, abs=1e-12)
+
+
+def test_calibration_fit_merge_and_state_round_trip():
+    first, second = CalibrationFit(), CalibrationFit(signals=("voltage",))
+    for index, (x, y) in enumerate(sweep(50, 3)):
+        (first if index % 2 else second).update("voltage", x, y)
+    second.update("temperature", 20.0, 20.5)
+    second.update("temperature", 30.0, 30.5)
+    first.merge(second)
+    restored = CalibrationFit.from_state(first.state())
+    assert restored.state() == first.state()
+    assert restored.coefficients()["voltage"]["samples"] == 50
+    assert restored.coefficients()["temperature"]["offset"] == pytest.approx(0.5)
+    assert "current" not in restored.coefficients()
@@ -0,0 +1,77 @@
+import pytest
+
+from journal import SessionJournal, replay, archive
+
+
+def point(index):
+    return {"setpoint": 50.0 * index, "mean": 50.0 * index + 0.5, "std": 0.1, "dwell": 0.4, "settled": True}
+
+
+def write_session(filename, points):
+    with SessionJournal(filename) as journal:
+        journal.append("session", sweep={"points": 17})
+        journal.append("config", frames=[])
+        for index in range(points):
+            journal.append("point", index=index, point=point(index), fit={"n": index + 1})
+
+
+def test_replay_rebuilds_state(tmp_path):
+    filename = str(tmp_path / "unit.journal")
+    write_session(filename, 3)
+    state = replay(filename)
+    assert state.records == 5 and state.completed_points == 3 and not state.done
+    assert state.fit == {"n": 3} and state.session["sweep"] == {"points": 17}
+    assert replay(str(tmp_path / "missing.journal")) is None
+
+
+def test_torn_tail_is_cut_off_on_resume(tmp_path):
+    filename = str(tmp_path / "unit.journal")
+    write_session(filename, 1)
+    with open(filename, "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "point": {"setpoint": 5')      # Crash in the middle of a record
+    assert replay(filename).completed_points == 1
+
+    with SessionJournal(filename, resume=True) as journal:
+        assert journal.sequence == 3
+        journal.append("point", index=1, point=point(1), fit={"n": 2})
+    assert replay(filename).completed_points == 2
+
+    with SessionJournal(filename, resume=True) as journal:
+        journal.append("point", index=2, point=point(2), fit={"n": 3})
+        journal.append("done", result={"fit": {}})
+    state = replay(filename)
+    assert state.completed_points == 3 and state.done
+
+
+def test_record_without_line_end_counts_as_torn(tmp_path):
+    filename = str(tmp_path / "unit.journal")
+    write_session(filename, 1)
+    with open(filename, "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "point": {}, "seq": 4, "type": "point"}')
+    assert replay(filename).completed_points == 1
+    with SessionJournal(filename, resume=True) as journal:
+        assert journal.sequence == 3
+
+
+def test_invalid_record_before_the_end_is_an_error(tmp_path):
+    filename = str(tmp_path / "unit.journal")
+    write_session(filename, 1)
+    with open(filename, "r+", encoding="utf-8") as f:
+        lines = f.readlines()
+        lines[1] = "garbage\n"
+        f.seek(0)
+        f.writelines(lines)
+    with pytest.raises(ValueError):
+        replay(filename)
+
+
+def test_archive_keeps_earlier_journals(tmp_path):
+    filename = str(tmp_path / "unit.journal")
+    archived = []
+    for points in (1, 2):
+        write_session(filename, points)
+        archived.append(archive(filename))
+    assert not (tmp_path / "unit.journal").exists()
+    # Both journals were written within the same second, the second one gets a counter
+    assert len(set(archived)) == 2 and all(name.endswith(".journal") for name in archived)
+    assert [replay(name).completed_points for name in archived] == [1, 2]
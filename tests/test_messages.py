@@ -0,0 +1,98 @@
+import logging
+import struct
+
+import pytest
+
+pytest.importorskip("can")
+
+import messages as msg
+import tas_protocol as tas
+
+
+def test_codecs_are_indexed_by_id_and_name():
+    for msg_info in (msg.CLEARANCE, msg.SET_RST_STOP, msg.SET_OP_LIM_U, msg.SET_SLOPE_U_I):
+        codec = msg.get_codec(msg_info)
+        assert msg.CODECS_BY_ID[msg_info["msg_id"]] is codec
+        assert msg.CODECS_BY_NAME[msg_info["msg_name"]] is codec
+
+
+def test_signals_are_packed_by_name():
+    message = msg.load_message(msg.SET_SLOPE_U_I, slope_current=2.0, slope_voltage=200.0)
+    assert struct.unpack("<ff", bytes(message.data)) == (200.0, 2.0)
+    assert msg.decode_message(message) == ("SET_SLOPE_U_I", {"slope_voltage": 200.0, "slope_current": 2.0})
+    assert msg.decode_message(msg.Message(arbitration_id=0x7FF, data=bytes(8), extended_id=False)) is None
+
+
+@pytest.mark.parametrize("msg_info, helper, prefix", [
+    (msg.SET_OP_LIM_U, msg.load_set_op_lim_u, "op_lim_u"),
+    (msg.SET_OP_LIM_I, msg.load_set_op_lim_i, "op_lim_i"),
+])
+def test_operating_limits_carry_maximum_first(msg_info, helper, prefix):
+    message = msg.load_message(msg_info, **{prefix + "_mn": -900, prefix + "_mx": 1400})
+    assert struct.unpack("<ff", bytes(message.data)) == (1400, -900)
+    assert bytes(helper(-900, 1400).data) == bytes(message.data)
+    assert msg.decode_message(message)[1] == {prefix + "_mx": 1400, prefix + "_mn": -900}
+
+
+def test_initialization_limits_on_the_wire():
+    frames = {message.arbitration_id: bytes(message.data) for message in tas.macroBTE_Initialization((), (), ())}
+    assert struct.unpack("<ff", frames[0x150]) == (1400, 0)
+    assert struct.unpack("<ff", frames[0x160]) == (900, -900)
+
+
+def example_signals(codec):
+    """Distinct in-range values for every signal of a codec."""
+    values = {}
+    for index, layout in enumerate(codec.layouts):
+        if layout.type == "float":
+            values[layout.name] = 1.5 + index          # Exact in a truncated float of 24 bits
+        elif layout.type == "float_low":
+            values[layout.name] = struct.unpack("<f", struct.pack("<I", index + 1))[0]   # Sign and exponent zero
+        elif layout.type == "signed":
+            values[layout.name] = -((index % (1 << (layout.length - 2))) + 1)
+        else:
+            values[layout.name] = (index + 1) % (1 << layout.length)
+    return values
+
+
+@pytest.mark.parametrize("codec", list(msg.CODECS_BY_ID.values()), ids=lambda codec: codec.msg_name)
+def test_generated_codec_round_trip(codec):
+    signals = example_signals(codec)
+    payload = codec.encode(**signals)
+    assert len(payload) == codec.dlc
+    assert codec.decode(payload) == signals
+    # The generated encoder agrees with the byte containers of msg_fmt
+    assert codec.encode(**codec.decode(payload)) == payload
+    assert len(codec.unpack(payload)) == len(codec.fields)
+
+
+def test_bit_fields_of_ref_switch_ctrl_ri():
+    payload = msg.get_codec(msg.SET_REF_SWITCH_CTRL_RI).encode(set_ref=400.0, set_switch=5, set_ctrl=2, rst_q=1,
+                                                               rst_e=0, set_ri=0.25)
+    set_ref, reg_ctrl, set_ri = struct.unpack("<fB3s", payload)
+    assert set_ref == 400.0
+    assert reg_ctrl == 5 | 2 << 3 | 1 << 6
+    assert set_ri == struct.pack("<f", 0.25)[:3]
+
+
+def test_scaled_signals_round_trip():
+    codec = msg.MessageCodec({"msg_id": 0x3A0, "msg_name": "TEST_SCALED", "dlc": 4, "msg_fmt": "<I",
+                              "msg_fields": ("word",),
+                              "temperature": {"start_bit": 0, "length": 12, "type": "signed", "factor": 0.5,
+                                              "offset": -40},
+                              "mode": {"start_bit": 12, "length": 20, "type": "unsigned", "factor": 2}})
+    payload = codec.encode(temperature=21.5, mode=400)
+    assert struct.unpack("<I", payload)[0] == 123 | 200 << 12       # (21.5 + 40) / 0.5 and 400 / 2
+    assert codec.decode(payload) == {"temperature": 21.5, "mode": 400}
+
+
+def test_payloads_are_only_formatted_for_debug_output(monkeypatch, caplog):
+    def hexlify(payload):
+        raise AssertionError("payload formatted without debug output")
+
+    monkeypatch.setattr(msg.binascii, "hexlify", hexlify)
+    caplog.set_level(logging.INFO, logger=msg.logger.name)
+    assert msg.load_set_pr_lim_u(0.0, 800.0) is not None
+    assert msg.load_set_slope_u_i(200.0, 10.0) is not None
+    assert msg.load_message(msg.SET_OP_LIM_U, op_lim_u_mn=0.0, op_lim_u_mx=800.0) is not None
+    assert not caplog.records
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import messages as msg
+from dispatcher import Dispatcher
+from metrics import METRICS, LogLinearHistogram
+from scheduler import PeriodicScheduler
+
+
+@pytest.fixture
+def metrics():
+    METRICS.enable()
+    yield METRICS
+    METRICS.disable()
+    METRICS.reset()
+
+
+def stages(snapshot, msg_id):
+    return {entry["stage"]: entry for entry in snapshot["latency_ns"] if entry["msg_id"] == msg_id}
+
+
+def test_histogram_percentiles_within_relative_error():
+    histogram = LogLinearHistogram()
+    for value in range(1, 100001):
+        histogram.record(value)
+    assert histogram.percentile(50) == pytest.approx(50000, rel=0.07)
+    assert histogram.percentile(99) == pytest.approx(99000, rel=0.07)
+    assert histogram.max == 100000 and histogram.count == 100000
+
+
+def test_dispatcher_counts_frames_and_times_handlers(metrics):
+    dispatcher = Dispatcher()
+    dispatcher.subscribe(0x288, lambda message: None)
+    for _ in range(3):
+        dispatcher.on_message_received(can.Message(arbitration_id=0x288, extended_id=False))
+    dispatcher.on_message_received(can.Message(arbitration_id=0x298, extended_id=False))
+    snapshot = metrics.snapshot()
+    counters = {(counter["name"], counter["msg_id"]): counter["value"] for counter in snapshot["counters"]}
+    assert counters == {("rx_frames", 0x288): 3, ("rx_frames", 0x298): 1, ("unhandled_frames", 0x298): 1}
+    assert stages(snapshot, 0x288)["handler"]["count"] == 3
+    assert 'bte_rx_frames_total{msg_id="0x288"} 3' in metrics.prometheus_text()
+
+
+def test_software_timer_records_lateness_separately_from_send(metrics):
+    bus = can.interface.Bus(bustype="virtual", channel="metrics0")
+    scheduler = PeriodicScheduler(bus, use_hardware=False)
+    try:
+        scheduler.schedule(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=1400)
+        time.sleep(0.1)
+    finally:
+        scheduler.stop_all()
+        bus.shutdown()
+    recorded = stages(metrics.snapshot(), msg.SET_OP_LIM_U["msg_id"])
+    assert {"send", "lateness"} <= set(recorded)
+    assert recorded["send"]["count"] == recorded["lateness"]["count"] > 0
+
+
+def test_receive_latency_only_for_wall_clock_timestamps(metrics):
+    wall_clock, device = Dispatcher(), Dispatcher()
+    wall_clock.on_message_received(can.Message(timestamp=time.time() - 0.001, arbitration_id=0x288,
+                                               extended_id=False))
+    device.on_message_received(can.Message(timestamp=12.5, arbitration_id=0x298, extended_id=False))
+    snapshot = metrics.snapshot()
+    assert "receive" in stages(snapshot, 0x288)
+    assert "receive" not in stages(snapshot, 0x298)
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import messages as msg
+from bus_pool import BusPool
+from multi_unit import UnitSpec, calibrate_units
+from simulator import SimulatorFarm
+
+
+def virtual_pool():
+    return BusPool(factory=lambda key: can.interface.Bus(bustype="virtual", channel=key.channel))
+
+
+async def measure(runner):
+    """Session: wait for three measurements of the unit, one unit fails and one stalls."""
+    if runner.unit.serial == "FAIL":
+        raise RuntimeError("Unit reports a defect")
+    if runner.unit.serial == "STALL":
+        await asyncio.sleep(60)
+    for _ in range(3):
+        await runner.expect(msg.STATUS_MEAS_U_I["msg_id"], timeout=1.0)
+    return {"serial": runner.unit.serial}
+
+
+async def wait(runner):
+    """Session of the worker processes, sleeps like a session waiting on the bus."""
+    if runner.unit.serial == "FAIL":
+        raise RuntimeError("Unit reports a defect")
+    await asyncio.sleep(0.3)
+    return {"pid": os.getpid()}
+
+
+def test_failing_and_stalled_units_do_not_stop_the_others():
+    serials = ["BTE-0001", "FAIL", "STALL", "BTE-0004"]
+    units = [UnitSpec("mu{}".format(index), serial, interface="virtual") for index, serial in enumerate(serials)]
+    progress = []
+    with virtual_pool() as pool, SimulatorFarm(len(units), channel_prefix="mu"):
+        results = calibrate_units(units, measure, unit_timeout=2.0, pool=pool,
+                                  progress=lambda result, snapshot: progress.append((result.serial, snapshot)))
+
+    assert [result.serial for result in results] == serials
+    assert [result.ok for result in results] == [True, False, False, True]
+    assert "RuntimeError" in results[1].error and "TimeoutError" in results[2].error
+    assert results[3].result == {"serial": "BTE-0004"}
+    assert sorted(serial for serial, _ in progress) == sorted(serials)
+    assert [snapshot["done"] for _, snapshot in progress] == [1, 2, 3, 4]
+    assert progress[-1][1] == {"total": 4, "done": 4, "failed": 2}
+
+
+def test_units_run_concurrently_in_threads():
+    units = [UnitSpec("par{}".format(index), "BTE-{}".format(index), interface="virtual") for index in range(8)]
+    start = time.perf_counter()
+    with virtual_pool() as pool:
+        results = calibrate_units(units, wait, pool=pool)
+    assert all(result.ok for result in results)
+    # Eight sessions of 0.3 s each take about as long as one
+    assert time.perf_counter() - start < 8 * 0.3 / 2
+
+
+def test_worker_processes_isolate_a_failing_unit():
+    units = [UnitSpec("proc{}".format(index), serial, interface="virtual")
+             for index, serial in enumerate(["BTE-0001", "FAIL", "BTE-0003"])]
+    results = calibrate_units(units, wait, use_processes=True)
+    assert [result.ok for result in results] == [True, False, True]
+    assert {result.result["pid"] for result in results if result.ok}.isdisjoint({os.getpid()})
+    with virtual_pool() as pool, pytest.raises(ValueError):
+        calibrate_units(units, wait, use_processes=True, pool=pool)
@@ -0,0 +1,73 @@
+import struct
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import tas_protocol as tas
+from scheduler import stream_buffer
+
+
+def test_ramp_is_encoded_as_one_buffer():
+    pytest.importorskip("numpy")
+    ramp = tas.macroBTE_Calibrate800V(points=5, dwell=0.01, shape="triangle")
+    assert list(ramp.setpoints) == [0.0, 200.0, 400.0, 600.0, 800.0, 600.0, 400.0, 200.0, 0.0]
+    assert ramp.msg_id == 0xC1 and len(ramp.buffer) == 9 * ramp.frames_per_point * 8
+    payloads = [ramp.buffer[offset:offset + 8] for offset in range(0, len(ramp.buffer), 8)]
+    setpoints = [struct.unpack_from("<f", payload)[0] for payload in payloads[::ramp.frames_per_point]]
+    assert setpoints == list(ramp.setpoints)
+    assert {payload[4] for payload in payloads} == {tas.SWITCH_ON | tas.CTRL_VOLTAGE << 3}
+    with pytest.raises(ValueError):
+        tas.macroBTE_Calibrate800V(shape="zigzag")
+
+
+def test_ref_switch_ctrl_ri_keeps_the_set_ri_bytes_of_the_first_version():
+    frame = tas.set_register_ref_switch_ctrl_ri(400.0, tas.SWITCH_ON, tas.CTRL_VOLTAGE, set_ri=-1.75)
+    assert bytes(frame.data) == (struct.pack("<f", 400.0) + bytes([tas.SWITCH_ON | tas.CTRL_VOLTAGE << 3])
+                                 + struct.pack("<f", -1.75)[:3])
+
+
+def test_stream_buffer_sends_every_payload_in_order():
+    pytest.importorskip("numpy")
+    tx, rx = (can.interface.Bus(bustype="virtual", channel="protocol-stream") for _ in range(2))
+    try:
+        ramp = tas.macroBTE_Calibrate800V(points=3, dwell=0.02)
+        stats = stream_buffer(tx, ramp.msg_id, ramp.buffer, ramp.freq)
+        frames = []
+        message = rx.recv(0.1)
+        while message is not None:
+            frames.append(message)
+            message = rx.recv(0)
+    finally:
+        tx.shutdown()
+        rx.shutdown()
+    assert b"".join(bytes(frame.data) for frame in frames) == ramp.buffer
+    assert {frame.arbitration_id for frame in frames} == {0xC1}
+    assert stats.count == len(frames) - 1 and stats.mean == pytest.approx(1 / ramp.freq, rel=0.2)
+
+
+class HardwareBus:
+    channel_info = "kvaser channel 0"
+
+
+def test_unverified_values_only_run_on_the_simulator():
+    bus = can.interface.Bus(bustype="virtual", channel="protocol0")
+    try:
+        tas.require_simulated(bus, "800V sweep", verified=False)
+    finally:
+        bus.shutdown()
+    tas.require_simulated(HardwareBus(), "800V sweep", verified=True)
+    with pytest.raises(tas.UnverifiedProtocol):
+        tas.require_simulated(HardwareBus(), "800V sweep", verified=False)
+
+
+def test_clearance_is_confirmed_by_echo_without_status():
+    clearance = can.Message(arbitration_id=0x720, data=[1], extended_id=False)
+    echo = lambda frame: (lambda message: message.arbitration_id == frame.arbitration_id)
+    status = can.Message(arbitration_id=0x288, data=[0, 0, 1, 0], extended_id=False)
+
+    by_status = tas.response_matcher(clearance, echo)
+    assert by_status(status) and not by_status(clearance)
+    by_echo = tas.response_matcher(clearance, echo, use_status=False)
+    assert by_echo(clearance) and not by_echo(status)
+    assert tas.response_matcher(clearance, None, use_status=False) is None
@@ -0,0 +1,87 @@
+import struct
+
+import pytest
+
+pytest.importorskip("numpy")
+can = pytest.importorskip("can")
+
+import sessions
+from bus_pool import BusPool
+from capture import CaptureWriter
+from multi_unit import UnitSpec, run_unit
+from reprocess import process_capture, reprocess
+from simulator import SimulatorFarm
+
+
+def test_reprocessed_capture_reproduces_online_fit(tmp_path):
+    channel = "reprocess0"
+    filename = str(tmp_path / "S1.btecap")
+    # A second node on the bus records setpoints and responses with the timestamps the runner saw
+    monitor = can.interface.Bus(bustype="virtual", channel=channel)
+    writer = CaptureWriter(filename, metadata={"serial": "S1"})
+    notifier = can.Notifier(monitor, [writer], timeout=0.05)
+    with BusPool() as pool:
+        try:
+            with SimulatorFarm([channel]):
+                unit = run_unit(UnitSpec(channel, "S1", interface="virtual"), sessions.calibrate_bte, pool=pool)
+        finally:
+            notifier.stop()
+            writer.stop()
+            monitor.shutdown()
+    assert unit.ok, unit.error
+    online = unit.result["fit"]["voltage"]
+
+    offline = process_capture(filename)
+    assert "error" not in offline, offline.get("error")
+    voltage = offline["coefficients"]["voltage"]
+    settled = sum(1 for point in unit.result["points"] if point["settled"])
+    assert offline["points"] == len(unit.result["points"])
+    assert voltage["samples"] == online["samples"] == settled
+    assert voltage["gain"] == pytest.approx(online["gain"], rel=1e-6)
+    assert voltage["offset"] == pytest.approx(online["offset"], abs=1e-3)
+    assert offline["point_std_max"] <= 0.5
+
+
+def write_sweep(filename, serial, setpoints, gain, offset):
+    """Capture of a sweep, the setpoint and the measured voltage are sent every 10 ms."""
+    capture = CaptureWriter(filename, metadata={"serial": serial})
+    t = 0.0
+    for setpoint in setpoints:
+        for _ in range(50):
+            capture.write(t, 0xC1, 8, 0, struct.pack("<fB3s", setpoint, 1, b""))
+            capture.write(t + 0.005, 0x298, 8, 0, struct.pack("<ff", gain * setpoint + offset, 0.0))
+            t += 0.01
+    capture.stop()
+    return filename
+
+
+def test_captures_of_a_unit_are_merged(tmp_path):
+    filenames = [write_sweep(str(tmp_path / "a.btecap"), "S1", [0.0, 100.0, 200.0, 300.0], 1.002, 0.3),
+                 write_sweep(str(tmp_path / "b.btecap"), "S1", [400.0, 500.0, 600.0, 700.0], 1.002, 0.3),
+                 write_sweep(str(tmp_path / "c.btecap"), "S2", [0.0, 350.0, 700.0], 0.998, -0.2),
+                 str(tmp_path / "broken.btecap")]
+    with open(filenames[-1], "wb") as f:
+        f.write(b"not a capture")
+
+    result = reprocess(filenames, workers=2, progress=None)
+    assert ["error" in entry for entry in result["files"]] == [False, False, False, True]
+    assert sorted(result["units"]) == ["S1", "S2"]
+    s1 = result["units"]["S1"]
+    assert s1["files"] == 2 and s1["frames"] == 800
+    assert s1["coefficients"]["voltage"]["samples"] == 8
+    assert s1["coefficients"]["voltage"]["gain"] == pytest.approx(1.002, rel=1e-5)
+    assert s1["coefficients"]["voltage"]["offset"] == pytest.approx(0.3, abs=1e-3)
+    assert result["units"]["S2"]["coefficients"]["voltage"]["gain"] == pytest.approx(0.998, rel=1e-5)
+
+
+def test_point_is_taken_unsettled_after_max_dwell(tmp_path):
+    filename = str(tmp_path / "drift.btecap")
+    capture = CaptureWriter(filename)
+    for index in range(100):
+        # The response drifts by 20 V/s for 0.6 s, longer than the sweep waits for a point
+        t = index * 0.01
+        capture.write(t, 0xC1, 8, 0, struct.pack("<fB3s", 100.0, 1, b""))
+        capture.write(t + 0.005, 0x298, 8, 0, struct.pack("<ff", 100.0 + 20.0 * max(0.0, 0.6 - t), 0.0))
+    capture.stop()
+    assert process_capture(filename)["unsettled"] == 1
+    assert process_capture(filename, settle={"max_dwell": None})["unsettled"] == 0
@@ -0,0 +1,39 @@
+import pytest
+
+from result_store import ResultStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    with ResultStore(str(tmp_path / "results.sqlite")) as store:
+        yield store
+
+
+def submit_fleet(store, gains):
+    for index, gain in enumerate(gains):
+        store.submit_run("BTE-{:04d}".format(index), 0, {"fit": {"voltage": {"gain": gain, "offset": 0.0}}},
+                         started=1000.0 + index, finished=1001.0 + index)
+    store.flush()
+
+
+def test_outlier_found_in_small_fleet(store):
+    # With the unit itself in the statistics |z| can not exceed (n - 1) / sqrt(n) = 2.5 for 8 units
+    submit_fleet(store, [1.0010, 1.0012, 1.0009, 1.0011, 1.0010, 1.0013, 1.0011, 1.0150])
+    outliers = store.outliers(field="gain")
+    assert [outlier["serial"] for outlier in outliers] == ["BTE-0007"]
+    assert outliers[0]["z"] > 3
+
+
+def test_latest_run_per_unit_is_compared(store):
+    submit_fleet(store, [1.0010, 1.0012, 1.0009, 1.0011, 1.0150])
+    store.submit_run("BTE-0004", 0, {"fit": {"voltage": {"gain": 1.0011, "offset": 0.0}}},
+                     started=2000.0, finished=2001.0)
+    store.flush()
+    assert store.outliers(field="gain") == []
+
+
+def test_fleet_of_two_has_no_outliers(store):
+    submit_fleet(store, [1.0, 1.5])
+    assert store.outliers(field="gain") == []
+    with pytest.raises(ValueError):
+        store.outliers(field="unknown")
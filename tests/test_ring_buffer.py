@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+pytest.importorskip("can")
+
+from ring_buffer import BLOCK, DROP_OLDEST, ConsumerThread, FrameRingBuffer
+
+
+def fill(ring, count, msg_id=0x298):
+    return [ring.put(float(index), msg_id + index % 2, 1, bytes([index % 256])) for index in range(count)]
+
+
+def test_batches_keep_the_receive_order_across_the_wrap():
+    ring = FrameRingBuffer(capacity=4)
+    fill(ring, 3)
+    assert list(ring.get_batch(max_frames=2).timestamps) == [0.0, 1.0]
+    fill(ring, 3)       # Wraps around the end of the buffer
+    batch = ring.get_batch(timeout=0)
+    assert list(batch.timestamps) == [2.0, 0.0, 1.0, 2.0]
+    assert batch.data[::8] == bytes([2, 0, 1, 2]) and len(ring) == 0
+    assert len(ring.get_batch(timeout=0).timestamps) == 0
+
+
+def test_drop_oldest_counts_lost_frames_per_id():
+    ring = FrameRingBuffer(capacity=4, policy=DROP_OLDEST)
+    assert all(fill(ring, 7))
+    assert list(ring.get_batch(timeout=0).timestamps) == [3.0, 4.0, 5.0, 6.0]
+    assert ring.overflow_counts() == {0x298: 2, 0x299: 1}
+
+
+def test_block_drops_the_new_frame_after_the_timeout():
+    ring = FrameRingBuffer(capacity=2, policy=BLOCK, block_timeout=0.01)
+    assert fill(ring, 3) == [True, True, False]
+    assert list(ring.get_batch(timeout=0).timestamps) == [0.0, 1.0]
+    assert ring.overflow_counts() == {0x298: 1}
+    with pytest.raises(ValueError):
+        FrameRingBuffer(policy="drop_newest")
+
+
+def test_consumer_thread_drains_the_buffer_on_stop():
+    ring = FrameRingBuffer(capacity=1024)
+    received = []
+    consumer = ConsumerThread(ring, lambda batch: received.extend(batch.timestamps), max_frames=16, timeout=0.01)
+    producer = threading.Thread(target=fill, args=(ring, 500))
+    producer.start()
+    producer.join()
+    consumer.stop()
+    assert received == [float(index) for index in range(500)]
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import tas_protocol as tas
+from runner import CalibrationRunner, StepTimeout, echo_matcher
+from simulator import SimulatedBTE
+
+
+@pytest.fixture
+def buses(request):
+    channel = "runner-{}".format(request.node.name)
+    tx, rx, device = (can.interface.Bus(bustype="virtual", channel=channel) for _ in range(3))
+    yield tx, rx, device
+    for bus in (tx, rx, device):
+        bus.shutdown()
+
+
+def frame(msg_id, data=b"\x01"):
+    return can.Message(arbitration_id=msg_id, data=data, extended_id=False)
+
+
+def test_expect_times_out(buses):
+    tx, rx, _ = buses
+
+    async def session(runner):
+        start = time.perf_counter()
+        with pytest.raises(StepTimeout):
+            await runner.expect(0x288, timeout=0.1)
+        return time.perf_counter() - start
+
+    assert 0.1 <= CalibrationRunner.run_session(tx, session, rx_bus=rx) < 0.5
+
+
+def test_expect_returns_first_matching_frame(buses):
+    tx, rx, device = buses
+
+    async def session(runner):
+        waiting = runner.loop.create_task(runner.expect(lambda message: message.data[0] == 2, timeout=1.0))
+        await asyncio.sleep(0.05)
+        for value in (1, 2, 3):
+            device.send(frame(0x288, bytes([value])))
+        return await waiting
+
+    assert bytes(CalibrationRunner.run_session(tx, session, rx_bus=rx).data) == b"\x02"
+
+
+def test_step_wraps_wait_for(buses):
+    tx, rx, _ = buses
+
+    async def session(runner):
+        assert await runner.step(asyncio.sleep(0.01, result="done"), timeout=0.5) == "done"
+        with pytest.raises(StepTimeout, match="slow"):
+            await runner.step(asyncio.sleep(1.0), timeout=0.05, name="slow")
+        return runner._waiters
+
+    assert CalibrationRunner.run_session(tx, session, rx_bus=rx) == []
+
+
+def test_sent_frame_is_confirmed_on_monitored_bus(buses):
+    tx, rx, _ = buses
+    sent = frame(0x720)
+
+    async def session(runner):
+        confirmation = runner.loop.create_task(runner.expect(echo_matcher(sent)))
+        await runner.send(sent)
+        return await confirmation
+
+    received = CalibrationRunner.run_session(tx, session, rx_bus=rx)
+    assert (received.arbitration_id, bytes(received.data)) == (0x720, b"\x01")
+
+
+def test_handlers_run_on_the_event_loop(buses):
+    tx, rx, device = buses
+    threads = []
+
+    async def session(runner):
+        runner.subscribe(0x288, lambda message: threads.append(threading.current_thread()))
+        device.send(frame(0x288))
+        await runner.expect(0x288)
+        return threading.current_thread()
+
+    assert threads == [CalibrationRunner.run_session(tx, session, rx_bus=rx)]
+
+
+def test_reader_listeners_run_on_the_reader_thread(buses):
+    tx, rx, device = buses
+    threads = []
+
+    class Recorder(can.Listener):
+        def on_message_received(self, message):
+            threads.append(threading.current_thread())
+
+    async def session(runner):
+        runner.add_reader_listener(Recorder())
+        device.send(frame(0x288))
+        await runner.expect(0x288)
+        await asyncio.sleep(0.05)
+        return threading.current_thread()
+
+    loop_thread = CalibrationRunner.run_session(tx, session, rx_bus=rx)
+    assert len(threads) == 1 and threads[0] is not loop_thread
+
+
+class IgnoringBTE(SimulatedBTE):
+    """Simulated device that ignores the first CLEARANCE frames it receives."""
+
+    def __init__(self, channel, ignore):
+        super().__init__(channel)
+        self.ignore = ignore
+
+    def _on_clearance(self, clearance):
+        if self.ignore:
+            self.ignore -= 1
+            return
+        super()._on_clearance(clearance)
+
+
+def send_initialization(channel, ignore, retries=2, check=True):
+    frames = list(tas.macroBTE_Initialization((), (), ()))
+    bus = can.interface.Bus(bustype="virtual", channel=channel)
+
+    async def session(runner):
+        return await runner.send_macro_batch(frames, verify=tas.response_matcher, timeout=0.3, retries=retries,
+                                             check=check)
+
+    try:
+        with IgnoringBTE(channel, ignore):
+            return frames, CalibrationRunner.run_session(bus, session)
+    finally:
+        bus.shutdown()
+
+
+def test_batch_retries_only_the_unconfirmed_frame():
+    frames, result = send_initialization("batch-retry", ignore=1)
+    clearance, rst_stop = frames[-2:]
+    assert result.attempts == 2 and result.failed == []
+    assert result.sent == len(frames) + 1
+    assert result.confirmed == [rst_stop, clearance]     # The reset was confirmed in the first attempt
+    assert result.unverified == frames[:-2]
+
+
+def test_batch_reports_frames_failed_after_all_attempts():
+    frames, result = send_initialization("batch-fail", ignore=10, retries=2, check=False)
+    assert result.failed == [frames[-2]] and result.confirmed == [frames[-1]]
+    assert result.attempts == 3 and result.sent == len(frames) + 2
+    with pytest.raises(StepTimeout, match="0x720"):
+        send_initialization("batch-check", ignore=10, retries=0)
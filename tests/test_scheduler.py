@@ -0,0 +1,83 @@
+import statistics
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import messages as msg
+from scheduler import PeriodStatistics, PeriodicScheduler
+
+
+@pytest.fixture
+def buses(request):
+    channel = "scheduler-{}".format(request.node.name)
+    tx, rx = (can.interface.Bus(bustype="virtual", channel=channel) for _ in range(2))
+    scheduler = PeriodicScheduler(tx, use_hardware=False)
+    yield scheduler, rx
+    scheduler.stop_all()
+    tx.shutdown()
+    rx.shutdown()
+
+
+def receive(bus, duration):
+    frames = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        message = bus.recv(0.01)
+        if message is not None:
+            frames.append(message)
+    return frames
+
+
+def test_period_statistics():
+    stats = PeriodStatistics(0.01)
+    assert stats.as_dict()["min"] is None and stats.jitter == 0.0
+    timestamps = [0.0, 0.010, 0.021, 0.030, 0.041, 0.050]
+    for timestamp in timestamps:
+        stats.update(timestamp)
+    periods = [b - a for a, b in zip(timestamps, timestamps[1:])]
+    assert stats.count == 5
+    assert stats.mean == pytest.approx(statistics.mean(periods))
+    assert stats.jitter == pytest.approx(statistics.stdev(periods))
+    assert (stats.min, stats.max) == (pytest.approx(min(periods)), pytest.approx(max(periods)))
+
+
+def test_software_timer_does_not_drift(buses):
+    scheduler, rx = buses
+    period = 0.01
+    scheduler.schedule(msg.SET_REF_SWITCH_CTRL_RI, freq=1 / period, set_ref=0.0, set_switch=0, set_ctrl=0, rst_q=0,
+                       rst_e=0, set_ri=0.0)
+    frames = receive(rx, 1.0)
+    scheduler.stop_all()
+    first, last = frames[0].timestamp, frames[-1].timestamp
+    cycles = round((last - first) / period)
+    # Deadlines are computed from the start, the error of the last frame does not grow with the number of cycles
+    assert abs(last - (first + cycles * period)) < 0.3 * period
+    assert cycles == len(frames) - 1 + scheduler.statistics()[0xC1]["late"]
+    stats = scheduler.statistics()[0xC1]
+    assert stats["mean"] == pytest.approx(period, rel=0.05)
+    assert stats["jitter"] < period / 2
+
+
+def test_update_keeps_the_cycle(buses):
+    scheduler, rx = buses
+    period = 0.02
+    scheduler.schedule(msg.SET_OP_LIM_U, freq=1 / period, op_lim_u_mn=0, op_lim_u_mx=1400)
+    before = receive(rx, 0.2)
+    scheduler.update(msg.SET_OP_LIM_U, op_lim_u_mn=0, op_lim_u_mx=800)
+    after = receive(rx, 0.2)
+    codec = msg.get_codec(msg.SET_OP_LIM_U)
+    assert {codec.decode(bytes(frame.data))["op_lim_u_mx"] for frame in before} == {1400}
+    assert codec.decode(bytes(after[-1].data))["op_lim_u_mx"] == 800
+    # The new payload is sent on the grid of the first transmission
+    first = before[0].timestamp
+    for frame in after:
+        cycles = (frame.timestamp - first) / period
+        assert abs(cycles - round(cycles)) < 0.3
+
+
+def test_update_of_unscheduled_message(buses):
+    scheduler, _ = buses
+    with pytest.raises(ValueError, match="0x150"):
+        scheduler.update_data(0x150, bytes(8))
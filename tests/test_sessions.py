@@ -0,0 +1,89 @@
+import asyncio
+import os
+import types
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import messages as msg
+import sessions
+from bus_pool import BusPool
+from capture import CaptureReader
+from journal import replay
+from simulator import SimulatedBTE
+
+
+@pytest.fixture
+def pool():
+    opened = []
+
+    def factory(key):
+        bus = can.interface.Bus(bustype="virtual", channel="{}-{}".format(key.interface, key.channel))
+        opened.append(bus)
+        return bus
+
+    with BusPool(factory=factory) as pool:
+        pool.opened = opened
+        yield pool
+
+
+def test_error_reset_is_sent_once_not_kept_alive():
+    scheduled, sent = [], []
+
+    async def send_macro_batch(frames, verify):
+        sent.extend(frames)
+        return types.SimpleNamespace(sent=len(frames), confirmed=list(frames), attempts=1)
+
+    # A bus that is not virtual, the status cache check is not used with unverified status layouts
+    bus = object()
+    scheduler = types.SimpleNamespace(apply_plan=lambda plan: None, schedule_message=scheduled.append)
+    runner = types.SimpleNamespace(bus=bus, rx_bus=bus, scheduler=scheduler, send_macro_batch=send_macro_batch)
+    frames = asyncio.run(sessions.setup_bte(runner))
+
+    rst_id = msg.SET_RST_STOP["msg_id"]
+    assert [frame.arbitration_id for frame in sent].count(rst_id) == 1
+    assert rst_id not in [frame.arbitration_id for frame in scheduled]
+    assert len(scheduled) == len(frames) - 1
+
+
+def test_device_is_leased_from_pool_and_released(pool, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # No can.ini, the default interface configuration is used
+    devices = sessions.open_device(True, pool=pool)
+    assert devices is not None and devices[0] is not devices[1]
+    sessions.release_device(*devices, pool=pool)
+
+    # Both buses are free again and reused by the next session
+    assert sessions.open_device(True, pool=pool) == devices
+    assert len(pool.opened) == 2 and pool.statistics["reused"] == 2
+    sessions.release_device(*devices, pool=pool)
+
+
+def test_device_session_captures_without_printing_frames(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(sessions, "MONITOR_TIME", 0.3)
+    capture = str(tmp_path / "session.btecap")
+    bus = can.interface.Bus(bustype="virtual", channel="device-session")
+    try:
+        with SimulatedBTE("device-session"):
+            assert sessions.run_device_session(bus, bus, capture=capture)
+    finally:
+        bus.shutdown()
+    assert capsys.readouterr().out == "Program exit\n"
+    with CaptureReader(capture) as reader:
+        ids = reader.ids()
+    assert msg.STATUS_MEAS_U_I["msg_id"] in ids and msg.STATUS_SYSTEM["msg_id"] in ids
+
+
+def test_finished_journal_is_archived_not_truncated(tmp_path):
+    runner = types.SimpleNamespace(unit=types.SimpleNamespace(serial="S1"))
+    journal_dir = str(tmp_path)
+    journal, state = sessions._open_journal(runner, journal_dir)
+    journal.append("session", sweep=sessions.SWEEP)
+    journal.append("done", result={"fit": {}})
+    journal.close()
+
+    journal, state = sessions._open_journal(runner, journal_dir)
+    journal.close()
+    assert state is None
+    archived = [name for name in os.listdir(journal_dir) if name != "S1.journal"]
+    assert len(archived) == 1 and replay(os.path.join(journal_dir, archived[0])).done
@@ -0,0 +1,56 @@
+import pytest
+
+from settle import SettleDetector, AdaptiveDwellSequencer
+
+
+def run_sequencer(sequencer, setpoints, dead_time):
+    """Feed the plant, which steps as soon as the sequencer advances."""
+    rate, t, started, previous = 1000.0, 0.0, 0.0, setpoints[0]
+    while not sequencer.done and t < 10.0:
+        setpoint = sequencer.setpoint
+        value = previous if t - started < dead_time else setpoint
+        if sequencer.feed(t, value):
+            previous, started = setpoint, t
+        t += 1 / rate
+    return sequencer.points
+
+
+def test_detector_settles_on_flat_signal_only():
+    detector = SettleDetector(window=0.1, tolerance=0.5, slope_tolerance=1.0)
+    assert not any(detector.update(k / 1000.0, 10.0 * k / 1000.0) for k in range(200))   # 10 V/s ramp
+    detector.reset()
+    settled = [detector.update(k / 1000.0, 5.0) for k in range(200)]
+    assert not settled[50] and settled[-1]
+    assert detector.mean == pytest.approx(5.0)
+
+
+def test_sequencer_advances_as_soon_as_settled():
+    setpoints = [0.0, 50.0, 100.0]
+    sequencer = AdaptiveDwellSequencer(setpoints, SettleDetector(0.1, 0.5, 5.0), max_dwell=1.0)
+    points = run_sequencer(sequencer, setpoints, dead_time=0.0)
+    assert [point.mean for point in points] == pytest.approx(setpoints)
+    assert all(point.settled and point.dwell < 0.5 for point in points)
+    assert sequencer.report()["time_saved"] > 1.5
+
+
+def test_dead_time_plateau_is_not_taken_without_tolerance_check():
+    setpoints = [0.0, 50.0, 100.0]
+    naive = AdaptiveDwellSequencer(setpoints, SettleDetector(0.1, 0.5, 5.0), max_dwell=1.0)
+    points = run_sequencer(naive, setpoints, dead_time=0.3)
+    assert points[1].mean == pytest.approx(0.0)     # The previous plateau, the failure mode
+
+    checked = AdaptiveDwellSequencer(setpoints, SettleDetector(0.1, 0.5, 5.0), max_dwell=1.0, setpoint_tolerance=20.0)
+    points = run_sequencer(checked, setpoints, dead_time=0.3)
+    assert [point.mean for point in points] == pytest.approx(setpoints)
+    assert all(point.settled for point in points)
+    assert all(point.dwell >= 0.3 for point in points[1:])
+
+
+def test_point_is_taken_unsettled_after_max_dwell():
+    sequencer = AdaptiveDwellSequencer([100.0], SettleDetector(0.1, 0.5, 5.0), max_dwell=0.2, setpoint_tolerance=5.0)
+    t = 0.0
+    while not sequencer.feed(t, 0.0):
+        t += 0.001
+    point, = sequencer.points
+    assert not point.settled and point.dwell == pytest.approx(0.2, abs=0.002)
+    assert sequencer.report()["unsettled"] == 1
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+can = pytest.importorskip("can")
+
+import messages as msg
+import tas_protocol as tas
+from simulator import ERR_NO_CLEARANCE, ERR_OVERVOLTAGE, SimulatedBTE
+
+
+def receive(device, message):
+    """Handle a frame like the receive thread of the device, without a bus."""
+    values = msg.CODECS_BY_ID[message.arbitration_id].unpack(bytes(message.data))
+    device._handlers[message.arbitration_id](*values)
+
+
+def switched_on(setpoint, **kwargs):
+    device = SimulatedBTE("unused", noise=0.0, gain_error=0.0, offset_error=0.0, **kwargs)
+    receive(device, msg.load_clearance(1))
+    device._on_ref_switch_ctrl_ri(setpoint, tas.SWITCH_ON, 0.0)
+    assert device.op_state == tas.SWITCH_ON
+    return device
+
+
+def settle(device, seconds=1.0, dt=0.01):
+    for _ in range(int(seconds / dt)):
+        voltage, current = device._step(dt)
+    return voltage, current
+
+
+def test_operational_limits_clamp_voltage_and_current():
+    device = switched_on(500.0)
+    receive(device, msg.load_set_op_lim_u(0.0, 100.0))
+    receive(device, msg.load_set_op_lim_i(-5.0, 5.0))
+    voltage, current = settle(device)
+    assert device.op_lim_u == (0.0, 100.0) and device.op_lim_i == (-5.0, 5.0)
+    assert voltage == pytest.approx(100.0, abs=1e-3)
+    assert current == pytest.approx(5.0)
+
+
+def test_inverted_limit_is_reported(caplog):
+    device = switched_on(0.0)
+    receive(device, msg.load_set_pr_lim_u(0.0, 850.0))
+    assert device.pr_lim_u == (0.0, 850.0) and not caplog.records
+
+    receive(device, msg.load_set_op_lim_u(800.0, 0.0))
+    assert device.op_lim_u == (800.0, 0.0)
+    assert any("inverted limit op_lim_u" in record.getMessage() for record in caplog.records)
+
+
+def test_protection_limit_stops_the_device():
+    device = switched_on(500.0)
+    receive(device, msg.load_set_pr_lim_u(0.0, 400.0))
+    settle(device)
+    assert device.standby_errors & ERR_OVERVOLTAGE and device.op_state == tas.SWITCH_STANDBY
+
+
+def test_injected_errors_stop_the_device():
+    device = switched_on(100.0)
+    device.inject_error(standby=ERR_NO_CLEARANCE)
+    assert device.op_state == tas.SWITCH_STANDBY
+    # Switching on again is refused while the error is set
+    device._on_ref_switch_ctrl_ri(100.0, tas.SWITCH_ON, 0.0)
+    assert device.op_state == tas.SWITCH_STANDBY
+    device.inject_error(critical=0x01)
+    assert device.op_state == tas.SWITCH_OFF and device.critical_errors == 0x01
+
+
+@pytest.mark.parametrize("state, standby, critical", [
+    (tas.SWITCH_OFF, 0, 0),
+    (tas.SWITCH_STANDBY, 0, 0x01),
+    (tas.SWITCH_ON, ERR_OVERVOLTAGE, 0x01),
+])
+def test_error_reset_depends_on_the_state(state, standby, critical):
+    device = SimulatedBTE("unused")
+    device.op_state = state
+    device.standby_errors, device.critical_errors = ERR_OVERVOLTAGE, 0x01
+    receive(device, msg.load_set_rst_stop(1))
+    assert (device.standby_errors, device.critical_errors) == (standby, critical)
+    assert device.rst_stop == 1
+
+
+def count_measurements(channel, rate_factor, seconds=0.5):
+    bus = can.interface.Bus(bustype="virtual", channel=channel)
+    try:
+        with SimulatedBTE(channel, rate_factor=rate_factor):
+            count = 0
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                message = bus.recv(0.01)
+                if message is not None and message.arbitration_id == msg.STATUS_MEAS_U_I["msg_id"]:
+                    count += 1
+    finally:
+        bus.shutdown()
+    return count
+
+
+def test_rate_factor_multiplies_the_status_rate():
+    normal = count_measurements("sim-rate-1", 1.0)
+    fast = count_measurements("sim-rate-4", 4.0)
+    # 100 Hz over 0.5 s, generous bounds for loaded test machines
+    assert 35 <= normal <= 60
+    assert 2.5 * normal <= fast <= 5.0 * normal
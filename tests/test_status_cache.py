@@ -0,0 +1,90 @@
+import pytest
+
+can = pytest.importorskip("can")
+
+import messages as msg
+import tas_protocol as tas
+from runner import CalibrationRunner
+from simulator import SimulatedBTE
+from status_cache import StaleStatus, StatusCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def status_frame(msg_info, **signals):
+    return msg.load_message(msg_info, **signals)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def cache(clock):
+    cache = StatusCache(clock=clock)
+    cache.on_message_received(status_frame(msg.STATUS_SYSTEM, op_state=tas.SWITCH_STANDBY, ctrl_mode=1, clearance=1,
+                                           rst_stop=0))
+    cache.on_message_received(status_frame(msg.STATUS_ERR_STANDBY, standby_errors=0x02))
+    cache.on_message_received(status_frame(msg.STATUS_ERR_CRITICAL, critical_errors=0))
+    return cache
+
+
+def test_snapshot_merges_latest_status(cache):
+    cache.on_message_received(status_frame(msg.STATUS_ERR_STANDBY, standby_errors=0x03))
+    snapshot = cache.snapshot(max_age=0.5)
+    assert snapshot["op_state"] == tas.SWITCH_STANDBY and snapshot["standby_errors"] == 0x03
+    assert cache.get(msg.STATUS_ERR_STANDBY["msg_id"]).sequence == 2
+
+
+def test_stale_status_is_refused(cache, clock):
+    clock.now += 0.6
+    assert not cache.is_fresh(msg.STATUS_SYSTEM["msg_id"], 0.5)
+    with pytest.raises(StaleStatus):
+        cache.snapshot(max_age=0.5)
+    assert tas.request_system_status(cache, max_age=0.5) is None
+    with pytest.raises(StaleStatus):
+        StatusCache(clock=clock).fields(msg.STATUS_SYSTEM["msg_id"])
+
+
+def test_malformed_frame_is_counted_and_keeps_last_entry(cache):
+    msg_id = msg.STATUS_ERR_CRITICAL["msg_id"]
+    cache.on_message_received(can.Message(arbitration_id=msg_id, data=b"\x01", extended_id=False))
+    assert cache.malformed[msg_id] == 1
+    assert cache.get(msg_id).fields == {"critical_errors": 0}
+
+
+def test_reset_is_checked_against_status_on_simulated_bus_only(cache):
+    virtual = can.interface.Bus(bustype="virtual", channel="status-cache")
+    try:
+        # Standby errors may be reset in SBY
+        assert tas.reset_stop(1, cache, bus=virtual).data[0] == 1
+        cache.on_message_received(status_frame(msg.STATUS_ERR_CRITICAL, critical_errors=0x01))
+        assert tas.reset_stop(1, cache, bus=virtual) is None
+    finally:
+        virtual.shutdown()
+    with pytest.raises(tas.UnverifiedProtocol):
+        tas.reset_stop(1, cache)
+    assert tas.reset_stop(1) is not None
+
+
+def test_runner_keeps_status_of_simulated_device():
+    bus = can.interface.Bus(bustype="virtual", channel="status-runner")
+
+    async def session(runner):
+        runner.apply_filters()
+        await runner.expect(msg.STATUS_ERR_CRITICAL["msg_id"], timeout=1.0)
+        return runner.status_cache.snapshot(max_age=0.5)
+
+    try:
+        with SimulatedBTE("status-runner"):
+            status = CalibrationRunner.run_session(bus, session)
+    finally:
+        bus.shutdown()
+    assert status["op_state"] == tas.SWITCH_OFF and status["critical_errors"] == 0